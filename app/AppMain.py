@@ -15,6 +15,7 @@
 
 import sys
 import os
+from functools import partial
 
 from ..SerialFlasher.StmDevice import STMInterface
 from ..SerialFlasher.constants import STM_BOOTLOADER_MAX_BAUD, STM_BOOTLOADER_MIN_BAUD
@@ -43,7 +44,45 @@ from textual.widgets import (
     Input,
 )
 
-from .chip_image import ChipImage, generateFlashImage
+from .chip_image import ChipImage, FlashMap
+from .flash_ops import (
+    PAGE_ERROR,
+    PAGE_VERIFIED,
+    FlashReader,
+    TransferError,
+    close_interface,
+    mapped_file,
+    scan_flash_pages,
+)
+from .page_cache import CachedSTMInterface
+from .transfer import RetryingSTMInterface
+from .instrumentation import InstrumentedSTMInterface, LinkMetrics
+from .flash_upload import FlashRecord, diff_segments, upload_segments
+from .flash_verify import PageCrcTracker, rewrite_pages, verify_segments
+from .device_info import DeviceSnapshot, capture_snapshot
+from .progress import IDLE_INTERVAL, ProgressChannel, format_progress
+from .image_loader import (
+    FORMAT_BIN,
+    ImageError,
+    detect_format,
+    image_length,
+    load_segments,
+)
+from .auto_baud import BaudRecord, negotiate_baud
+from .ram_loader import (
+    accelerated_upload,
+    check_ram_image,
+    free_ram,
+    load_ram_image,
+    run_from_ram,
+)
+from .op_log import (
+    LOG_FLUSH_INTERVAL,
+    LOG_HISTORY_LINES,
+    OperationLog,
+    session_log_path,
+)
+from .station import STATUS_FAIL, STATUS_PASS, FlashStation, StationImage
 from . import app_config as config
 
 DEBUG_MODE = False
@@ -259,11 +298,33 @@ class StringPutter(TextLog):
             classes=classes,
         )
 
+        # writes are queued & drawn in batches, see op_log
+        self.op_log = OperationLog()
+        # session log file, opened once the widget is mounted
+        self.log_path = None
+
+    def write(self, content, progress: str = None) -> None:
+        """! @brief queue content for the next flush, safe from any thread
+        @param progress see OperationLog.write
+        """
+        self.op_log.write(content, progress)
+
+    def flush_log(self) -> None:
+        for content in self.op_log.take():
+            super().write(content)
+
     def on_mount(self):
+        self.log_path = session_log_path()
+        self.op_log.open(self.log_path)
         self.write(f"Application Initialising....")
         self.write(f"{APPLICATION_NAME} v{APPLICATION_VERSION}")
+        self.set_interval(LOG_FLUSH_INTERVAL, self.flush_log)
         return super().on_mount()
 
+    def on_unmount(self):
+        # joins the writer thread, so the file is complete on exit
+        self.op_log.close()
+
 
 class InfoDisplays(Static):
     """class to display the top three columns of the app
@@ -316,8 +377,12 @@ class StmApp(App):
     # when to pay attention to the input box
     state = STATE_IDLE_DISCONNECTED
 
-    # Device model
-    stm_device = STMInterface()
+    # Device model, created on first use
+    _stm_device = None
+    # per-command link metrics for this session
+    metrics = None
+    # page cache over the device, rebuilt on each connection
+    flash = None
 
     # internal state variables
     # TODO: use less of these
@@ -331,30 +396,255 @@ class StmApp(App):
     length = 0
     offset = 0
     filepath = None
+    sparse_upload = True
+    diff_record = False
+    loader_path = None
+    station_ports = ""
 
     # Default tables & widget definitions
     conn_table = None
     dev_table = None
+    opts_panel = None
+    opts_raw_panel = None
+    device_info = None
     chip_image = ""
     chip = None
-    default_conn_info = Table("", "", **config.clear_table_format)
-
-    default_device_info = Panel(
-        Text.from_markup(
-            "No Device",
-            style=Style(color="red", bold=True, italic=True, blink=True),
-        ),
-        title="[bold orange]Device[/bold orange]",
-        **config.panel_format,
-    )
-
-    banner = Static(APPLICATION_BANNER, expand=True, id="banner")
-    msg_log = StringPutter(max_lines=8, name="msg_log", id="msg_log")
-    input = StringGetter(placeholder=">>>")
+    flash_map = None
+    default_conn_info = None
+    default_device_info = None
+
+    # widgets, built when the app composes
+    banner = None
+    msg_log = None
+    input = None
+
+    @property
+    def stm_device(self) -> STMInterface:
+        if self._stm_device is None:
+            self._stm_device = InstrumentedSTMInterface(STMInterface(), self.metrics)
+        return self._stm_device
+
+    ## initialise menus
+    def build_menu_items(self):
+        # build the keypress menu items
+        self.dc_menu_items = [
+            {
+                "key": config.KEY_PORT,
+                "description": "Set Port",
+                "state": STATE_IDLE_DISCONNECTED,
+                "action": self.handle_port_keypress,
+            },
+            {
+                "key": config.KEY_BAUD,
+                "description": "Set Baud",
+                "state": STATE_IDLE_DISCONNECTED,
+                "action": self.handle_baud_keypress,
+            },
+            {
+                "key": config.KEY_ABAUD,
+                "description": "Auto Baud & Connect",
+                "state": STATE_IDLE_DISCONNECTED,
+                "action": self.handle_autobaud_keypress,
+            },
+            {
+                "key": config.KEY_CONN,
+                "description": "Connect",
+                "state": STATE_IDLE_DISCONNECTED,
+                "action": self.handle_connect_keypress,
+            },
+            {
+                "key": config.KEY_STAT,
+                "description": "Station Mode",
+                "state": STATE_IDLE_DISCONNECTED,
+                "action": self.handle_station_keypress,
+            },
+        ]
+
+        self.any_menu_items = [
+            {
+                "key": config.KEY_EXIT,
+                "description": "Exit",
+                "state": STATE_ANY,
+                "action": self.handle_exit_keypress,
+            },
+            {
+                "key": config.KEY_CNCL,
+                "description": "Cancel",
+                "state": STATE_ANY,
+                "action": self.handle_cancel_keypress,
+            },
+            {
+                "key": config.KEY_VERS,
+                "description": "Print Version",
+                "state": STATE_ANY,
+                "action": self.handle_vers_keypress,
+            },
+        ]
+
+        self.read_menu = [
+            {
+                "key": config.KEY_FILE,
+                "description": "set file path",
+                "action": self.handle_filepath_keypress,
+                "state": STATE_READ_MEM,
+            },
+            {
+                "key": "o",
+                "description": "Configure offset",
+                "action": self.handle_offset_keypress,
+                "state": STATE_READ_MEM,
+            },
+            {
+                "key": "l",
+                "description": "Read length",
+                "action": self.handle_length_keypress,
+                "state": STATE_READ_MEM,
+            },
+            {
+                "key": config.KEY_RDFS,
+                "description": "Read memory",
+                "action": self.read_from_flash,
+                "state": STATE_READ_MEM,
+            },
+        ]
+
+        self.upload_menu_items = [
+            {
+                "key": config.KEY_FILE,
+                "description": "set file path",
+                "action": self.handle_filepath_keypress,
+                "state": STATE_UPLOAD_APP,
+            },
+            {
+                "key": "o",
+                "description": "Configure offset",
+                "action": self.handle_offset_keypress,
+                "state": STATE_UPLOAD_APP,
+            },
+            {
+                "key": "w",
+                "description": "Write file contents to flash",
+                "action": self.handle_upload_keypress,
+                "state": STATE_UPLOAD_APP,
+            },
+            {
+                "key": config.KEY_DIFF,
+                "description": "Write changed pages only",
+                "action": self.handle_diff_upload_keypress,
+                "state": STATE_UPLOAD_APP,
+            },
+            {
+                "key": config.KEY_RCRD,
+                "description": "Toggle diffing against the flash record",
+                "action": self.handle_record_keypress,
+                "state": STATE_UPLOAD_APP,
+            },
+            {
+                "key": config.KEY_LDR,
+                "description": "Write through the RAM loader",
+                "action": self.handle_loader_upload_keypress,
+                "state": STATE_UPLOAD_APP,
+            },
+            {
+                "key": config.KEY_SPRS,
+                "description": "Toggle skipping blank frames",
+                "action": self.handle_sparse_keypress,
+                "state": STATE_UPLOAD_APP,
+            },
+        ]
+
+        self.ram_menu_items = [
+            {
+                "key": config.KEY_FILE,
+                "description": "set file path",
+                "action": self.handle_filepath_keypress,
+                "state": STATE_WRITE_MEM,
+            },
+            {
+                "key": config.KEY_WRRM,
+                "description": "Write file to RAM & run it",
+                "action": self.handle_runram_keypress,
+                "state": STATE_WRITE_MEM,
+            },
+        ]
+
+        self.con_menu_items = [
+            {
+                "key": config.KEY_RDRM,
+                "description": "Read RAM to file",
+                "state": STATE_IDLE_CONNECTED,
+                "action": None,
+            },
+            {
+                "key": config.KEY_WRRM,
+                "description": "Write file data to ram",
+                "state": STATE_IDLE_CONNECTED,
+                "action": self.handle_writeram_keypress,
+            },
+            {
+                "key": config.KEY_UPLD,
+                "description": "Upload application to flash",
+                "state": STATE_IDLE_CONNECTED,
+                "action": self.handle_uploadmenu_keypress,
+            },
+            {
+                "key": config.KEY_ERFS,
+                "description": "Erase all flash",
+                "state": STATE_IDLE_CONNECTED,
+                "action": self.handle_erase_keypress,
+            },
+            {
+                "key": config.KEY_RDFS,
+                "description": "Read flash memory",
+                "state": STATE_IDLE_CONNECTED,
+                "action": self.handle_readflash_keypress,
+            },
+            {
+                "key": config.KEY_DCON,
+                "description": "Disconnect from device",
+                "state": STATE_IDLE_CONNECTED,
+                "action": self.handle_disconnect_keypress,
+            },
+            {
+                "key": config.KEY_RDPG,
+                "description": "Read flash pages",
+                "state": STATE_IDLE_CONNECTED,
+                "action": self.handle_readpages_keypress,
+            },
+            {
+                "key": config.KEY_OPTB,
+                "description": "Configure Option Bytes",
+                "action": self.handle_option_bytes,
+                "state": STATE_IDLE_CONNECTED,
+            },
+            {
+                "key": config.KEY_RFSH,
+                "description": "Refresh device info",
+                "action": self.handle_refresh_keypress,
+                "state": STATE_IDLE_CONNECTED,
+            },
+        ]
 
     ## initialise page info
     def build_items(self):
+        """build the widgets & menus, called from compose
+        so none of it is paid for until the app mounts
+        """
+        self.banner = Static(APPLICATION_BANNER, expand=True, id="banner")
+        self.msg_log = StringPutter(
+            max_lines=LOG_HISTORY_LINES, name="msg_log", id="msg_log"
+        )
+        self.input = StringGetter(placeholder=">>>")
 
+        self.default_device_info = Panel(
+            Text.from_markup(
+                "No Device",
+                style=Style(color="red", bold=True, italic=True, blink=True),
+            ),
+            title="[bold orange]Device[/bold orange]",
+            **config.panel_format,
+        )
+        self.default_conn_info = Table("", "", **config.clear_table_format)
         self.default_conn_info.add_row("", "")
         self.default_conn_info.add_row(
             "Connected    ",
@@ -363,8 +653,7 @@ class StmApp(App):
         self.default_conn_info.add_row("Port         ", f"{self.conn_port}")
         self.default_conn_info.add_row("Baud         ", f"{self.conn_baud}")
 
-
-
+        self.build_menu_items()
         self.active_menu = self.dc_menu_items
 
         # there's probably a more elegent way of doing this but it works
@@ -387,13 +676,16 @@ class StmApp(App):
 
     def __init__(self, driver_class=None, css_path=None, watch_css: bool = False):
 
-        self.build_items()
         self.msg_queue = Queue(10)
+        self.metrics = LinkMetrics()
+        # log & metrics files written this session
+        self.session_files = []
         super().__init__(driver_class, css_path, watch_css)
 
     ## Widgets & tables updates
 
     def compose(self) -> ComposeResult:
+        self.build_items()
         yield Header()
         yield self.banner
         yield self.main_display
@@ -401,7 +693,7 @@ class StmApp(App):
         yield self.input
 
     def dev_content_from_state(self):
-        if self.state == STATE_READ_MEM or self.state == STATE_WRITE_MEM:
+        if self.state in (STATE_READ_MEM, STATE_WRITE_MEM, STATE_UPLOAD_APP):
             return Group(
                 self.build_readwrite_table(),
                 self.build_device_table(),
@@ -430,14 +722,75 @@ class StmApp(App):
             )
         )
 
-        opts.update(
+        self.update_opts(opts_table, opts_raw)
+
+        menu.update(self.build_menu())
+
+    def update_opts(self, opts_table=None, opts_raw=None):
+        """redraw the option bytes & flash map column"""
+        if not self.connected:
+            opts_table = opts_raw = ""
+        opts_table = self.build_opts_table() if opts_table is None else opts_table
+        opts_raw = self.build_opts_raw() if opts_raw is None else opts_raw
+        flash_map = (
+            ""
+            if self.flash_map is None
+            else Panel(
+                self.flash_map.render(),
+                title="[bold cyan]Flash Map[/bold cyan]",
+                **config.panel_format,
+            )
+        )
+        self.get_widget_by_id("opts").update(
             Panel(
-                Group(opts_table, opts_raw),
+                Group(opts_table, opts_raw, flash_map, self.build_stats_panel()),
                 **config.panel_format,
             )
         )
 
-        menu.update(self.build_menu())
+    def build_stats_panel(self):
+        """per-command latency & throughput of the link"""
+        snapshot = self.metrics.snapshot()
+        if len(snapshot) == 0:
+            return ""
+        stats_table = Table(
+            "Command",
+            "Calls",
+            "p50 ms",
+            "p95 ms",
+            "Max ms",
+            "KB/s",
+            "Retry",
+            "Err",
+            box=None,
+            expand=True,
+        )
+        for name, s in snapshot:
+            stats_table.add_row(
+                name,
+                f"{s['calls']}",
+                f"{s['latency_p50_s'] * 1000:.1f}",
+                f"{s['latency_p95_s'] * 1000:.1f}",
+                f"{s['latency_max_s'] * 1000:.1f}",
+                f"{s['bytes_per_s'] / 1024:.1f}",
+                f"{s['retries']}",
+                f"{s['errors']}",
+            )
+        return Panel(
+            stats_table,
+            title="[bold cyan]Link Stats[/bold cyan]",
+            **config.panel_format,
+        )
+
+    def update_flash_map(self, states: dict):
+        """apply {page: state} changes to the flash map,
+        redrawing only if anything changed
+        """
+        if self.flash_map is None or len(states) == 0:
+            return
+        self.flash_map.set_states(states)
+        if self.flash_map.dirty:
+            self.update_opts()
 
     def build_menu(self):
         menu = config.menu_template
@@ -455,7 +808,20 @@ class StmApp(App):
             **config.panel_format,
         )
 
+    def set_device_info(self, snapshot: DeviceSnapshot):
+        """install a new device snapshot and drop the
+        tables rendered from the old one
+        """
+        self.device_info = snapshot
+        self.dev_table = None
+        self.opts_panel = None
+        self.opts_raw_panel = None
+
     def build_opts_table(self) -> Table:
+        if self.opts_panel is not None:
+            return self.opts_panel
+
+        info = self.device_info
         opts_table = Table(
             "Option Byte",
             "Value",
@@ -468,7 +834,7 @@ class StmApp(App):
         opts_table.add_row(
             "Read Protect",
             binary_colour(
-                self.stm_device.device.opt_bytes.readProtect,
+                info.read_protect,
                 true_str="enabled",
                 false_str="disabled",
                 false_fmt="blue",
@@ -477,7 +843,7 @@ class StmApp(App):
         opts_table.add_row(
             "Watchdog Type",
             binary_colour(
-                self.stm_device.device.opt_bytes.watchdogType,
+                info.watchdog_type,
                 false_str="Hardware",
                 true_str="Software",
                 false_fmt="blue",
@@ -486,7 +852,7 @@ class StmApp(App):
         opts_table.add_row(
             "Rst on Standby",
             binary_colour(
-                self.stm_device.device.opt_bytes.resetOnStandby,
+                info.reset_on_standby,
                 true_str="enabled",
                 false_str="disabled",
                 false_fmt="blue",
@@ -495,59 +861,46 @@ class StmApp(App):
         opts_table.add_row(
             "Rst on Stop",
             binary_colour(
-                self.stm_device.device.opt_bytes.resetOnStop,
+                info.reset_on_stop,
                 true_str="enabled",
                 false_str="disabled",
                 false_fmt="blue",
             ),
         )
-        opts_table.add_row(
-            "Data Byte 0", f"{hex(self.stm_device.device.opt_bytes.dataByte0)}"
-        )
-        opts_table.add_row(
-            "Data Byte 1", f"{hex(self.stm_device.device.opt_bytes.dataByte1)}"
-        )
-        opts_table.add_row(
-            "Write Prot 0", str(self.stm_device.device.opt_bytes.writeProtect0)
-        )
-        opts_table.add_row(
-            "Write Prot 1", str(self.stm_device.device.opt_bytes.writeProtect1)
-        )
-        opts_table.add_row(
-            "Write Prot 2", str(self.stm_device.device.opt_bytes.writeProtect2)
-        )
-        opts_table.add_row(
-            "Write Prot 3", str(self.stm_device.device.opt_bytes.writeProtect3)
-        )
+        opts_table.add_row("Data Byte 0", f"{hex(info.data_byte0)}")
+        opts_table.add_row("Data Byte 1", f"{hex(info.data_byte1)}")
+        for i, wp in enumerate(info.write_protect):
+            opts_table.add_row(f"Write Prot {i}", str(wp))
 
-        return Panel(
+        self.opts_panel = Panel(
             opts_table,
             title="[bold cyan]Flash Option bytes[/bold cyan]",
             **config.panel_format,
         )
+        return self.opts_panel
 
     def build_opts_raw(self):
-        raw_bytes_string = MARKUP(self.stm_device.device.opt_bytes.rawBytesToString())
-        return Panel(raw_bytes_string, **config.panel_format)
+        if self.opts_raw_panel is None:
+            raw_bytes_string = MARKUP(self.device_info.opt_bytes_raw)
+            self.opts_raw_panel = Panel(raw_bytes_string, **config.panel_format)
+        return self.opts_raw_panel
 
     def build_device_table(self) -> Table:
+        if self.dev_table is not None:
+            return self.dev_table
+
+        info = self.device_info
         device_table = Table("", "", **config.clear_table_format)
         device_table.add_row("", "")  # spacer
-        device_table.add_row("Device Type   ", f"{self.stm_device.device.name}")
-        device_table.add_row("Device ID     ", f"{hex(self.stm_device.getDeviceId())}")
-        device_table.add_row(
-            "Bootloader v  ", f"{str(self.stm_device.getDeviceBootloaderVersion())}"
-        )
-        device_table.add_row(
-            "Flash Size    ", f"{hex(self.stm_device.device.flash_memory.size)}"
-        )
+        device_table.add_row("Device Type   ", f"{info.name}")
+        device_table.add_row("Device ID     ", f"{hex(info.device_id)}")
+        device_table.add_row("Bootloader v  ", f"{str(info.bootloader_version)}")
+        device_table.add_row("Flash Size    ", f"{hex(info.flash_size)}")
         device_table.add_row(
             "Flash Pages   ",
-            f"{self.stm_device.device.flash_page_num} Pages of {self.stm_device.device.flash_page_size}b",
-        )
-        device_table.add_row(
-            "RAM Size      ", f"{hex(self.stm_device.device.ram.size)}"
+            f"{info.flash_page_num} Pages of {info.flash_page_size}b",
         )
+        device_table.add_row("RAM Size      ", f"{hex(info.ram_size)}")
         self.dev_table = Panel(
             device_table,
             title="[bold yellow]Device[/bold yellow]",
@@ -586,9 +939,19 @@ class StmApp(App):
             ),
         )
         rw_table.add_row("Address       ", f"{hex(self.address)}")
-        rw_table.add_row("Length        ", f"{self.read_len}")
+        rw_table.add_row("Length        ", f"{self.length}")
         rw_table.add_row("Offset        ", f"{self.offset}")
         rw_table.add_row("File path     ", f"{self.filepath}")
+        if self.state == STATE_UPLOAD_APP:
+            rw_table.add_row(
+                "Skip blank    ",
+                binary_colour(self.sparse_upload, "on", "off", false_fmt="blue"),
+            )
+            rw_table.add_row(
+                "Diff record   ",
+                binary_colour(self.diff_record, "on", "off", false_fmt="blue"),
+            )
+            rw_table.add_row("RAM loader    ", f"{self.loader_path}")
 
         return Panel(
             rw_table, title="[bold yellow]IO[/bold yellow]", **config.panel_format
@@ -612,7 +975,16 @@ class StmApp(App):
                 f"Flash size: {hex(self.stm_device.device.flash_memory.size)}"
             )
         )
+        self.set_device_info(capture_snapshot(self.stm_device))
         self.chip = ChipImage(self.stm_device.device.name)
+        self.flash = CachedSTMInterface(
+            RetryingSTMInterface(self.stm_device, metrics=self.metrics)
+        )
+        self.flash_map = FlashMap(
+            self.device_info.flash_page_num,
+            self.device_info.flash_start,
+            self.device_info.flash_page_size,
+        )
         self.active_menu = self.con_menu_items
         self.state = STATE_IDLE_CONNECTED
         self.update_tables()
@@ -633,34 +1005,77 @@ class StmApp(App):
         finally:
             return success
 
+    def device_disconnect(self):
+        """close the device's port & drop its model, the next
+        connection builds a fresh one
+        """
+        if self._stm_device is not None:
+            close_interface(self._stm_device)
+            self._stm_device = None
+        self.connected = False
+        self.flash = None
+        self.flash_map = None
+        self.active_menu = self.dc_menu_items
+        self.state = STATE_IDLE_DISCONNECTED
+
     ## OPERATIONS #
 
-    async def long_running_task(self, function, *func_args, colour: str = "red"):
+    def build_task_panel(self, chip, progress: str = "") -> Panel:
+        return Panel(
+            Group(
+                self.build_conn_table(),
+                self.build_device_table(),
+                chip,
+                progress,
+            ),
+            **config.panel_format,
+        )
+
+    async def long_running_task(
+        self,
+        function,
+        *func_args,
+        colour: str = "red",
+        channel: ProgressChannel = None,
+        operation: str = None,
+    ):
+        """run a blocking function in the executor
+        the device panel is redrawn when the function reports progress
+        through the channel, at a slow rate while it reports nothing so
+        the chip keeps animating, and once more when it finishes
+        progress also goes to the log as updates of the named operation,
+        which the log coalesces
+        """
         dev_info = self.get_widget_by_id("info")
+        link = None if self.flash is None else self.flash.stm_device
+        if link is not None:
+            link.stats.reset()
+        channel = ProgressChannel() if channel is None else channel
         task = asyncio.get_running_loop().run_in_executor(None, function, *func_args)
-        while not task.done():
+        task.add_done_callback(lambda _: channel.close())
+
+        # the builtin next takes no colour, set it on the chip instead
+        self.chip.colour = colour
+        dev_info.update(self.build_task_panel(next(self.chip)))
+        logged = None
+        async for event in channel.events(idle=IDLE_INTERVAL):
             dev_info.update(
-                Panel(
-                    Group(
-                        self.build_conn_table(),
-                        self.build_device_table(),
-                        next(self.chip, colour=colour),
-                    ),
-                    **config.panel_format,
-                )
+                self.build_task_panel(next(self.chip), format_progress(event))
             )
-            await asyncio.sleep(0.1)
-        dev_info.update(
-            Panel(
-                Group(
-                    self.build_conn_table(),
-                    self.build_device_table(),
-                    self.chip.chip_image,
-                ),
-                **config.panel_format,
-            )
-        )
-        return task.result()
+            if operation is not None and event is not None and event != logged:
+                logged = event
+                self.msg_log.write(
+                    InfoMessage(f"{operation}: {format_progress(event)}"),
+                    progress=operation,
+                )
+            self.update_flash_map(channel.take_pages())
+
+        dev_info.update(self.build_task_panel(self.chip.chip_image))
+        self.update_flash_map(channel.take_pages())
+        if link is not None and link.stats.retries:
+            self.msg_log.write(InfoMessage(f"Link: {link.stats}"))
+        self.update_opts()
+        return await task
 
     async def input_to_attribute(self, msg: str, attribute: str, ex_type=str):
         """!
@@ -695,6 +1110,13 @@ class StmApp(App):
     async def handle_port_keypress(self):
         """handle port input keypress"""
         await self.input_to_attribute("Enter connection port", "conn_port")
+        # looking up the adapter lists the system's ports, which can be slow
+        remembered = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: BaudRecord().get(self.conn_port)
+        )
+        if remembered is not None:
+            self.conn_baud = remembered
+            self.msg_log.write(InfoMessage(f"Using remembered baud {remembered}"))
         self.update_tables()
 
     async def handle_baud_keypress(self):
@@ -702,6 +1124,45 @@ class StmApp(App):
         await self.input_to_attribute("Enter connection baud", "conn_baud")
         self.update_tables()
 
+    async def handle_autobaud_keypress(self):
+        """handle the auto baud keypress
+        probes the port for the fastest reliable baud,
+        remembers it for the port & adapter then connects
+        """
+        if len(self.conn_port) == 0:
+            self.msg_log.write(FailMessage("Must configure port first"))
+            return
+
+        self.msg_log.write(InfoMessage(f"Negotiating baud on {self.conn_port}..."))
+        loop = asyncio.get_running_loop()
+
+        def on_probe(probe):
+            loop.call_soon_threadsafe(self.msg_log.write, InfoMessage(f"{probe}"))
+
+        def negotiate(port: str):
+            best = negotiate_baud(port, on_probe=on_probe)
+            if best is not None:
+                record = BaudRecord()
+                record.update(port, best)
+                record.save()
+            return best
+
+        try:
+            best = await loop.run_in_executor(None, negotiate, self.conn_port)
+        except OSError as e:
+            self.msg_log.write(
+                FailMessage(f"Unable to reset the target through DTR/RTS: {e}")
+            )
+            return
+        if best is None:
+            self.msg_log.write(FailMessage("No reliable baud found"))
+            return
+
+        self.conn_baud = best.baud
+        self.msg_log.write(SuccessMessage(f"Using {best}"))
+        self.update_tables()
+        await self.handle_connect_keypress()
+
     async def handle_connect_keypress(self):
         """handle the 'connect' keypress
         check parameters are set and connect to
@@ -723,6 +1184,15 @@ class StmApp(App):
             if self.connected == True:
                 self.handle_connected()
 
+    async def handle_disconnect_keypress(self):
+        """handle the 'disconnect' keypress
+        release the port, e.g. to reset the board or hand it
+        to another tool
+        """
+        self.device_disconnect()
+        self.msg_log.write(InfoMessage(f"Disconnected from {self.conn_port}"))
+        self.update_tables()
+
     async def handle_readflash_keypress(self):
         """handle the 'read flash' keypress
         update menu to readwrite and update tables
@@ -737,43 +1207,43 @@ class StmApp(App):
         calls the globalErase operation on the device
         """
         self.msg_log.write(InfoMessage("Erasing flash memory..."))
-        await self.long_running_task(self.stm_device.globalEraseFlash)
+        await self.long_running_task(self.flash.globalEraseFlash)
         self.msg_log.write(SuccessMessage("Succesfully erased all flash pages"))
 
+    async def handle_refresh_keypress(self):
+        """handle the refresh keypress
+        re-reads the device info snapshot
+        """
+        snapshot = await self.long_running_task(capture_snapshot, self.stm_device)
+        self.set_device_info(snapshot)
+        self.update_tables()
+        self.msg_log.write(SuccessMessage("Refreshed device info"))
+
     async def handle_readpages_keypress(self):
+        """handle the read pages keypress
+        scans the whole flash in one pass and reports
+        page occupancy
+        """
         self.msg_log.write(InfoMessage("Reading flash pages..."))
-        occupied = 0
-        empty = 0
-        errors = 0
-
-        for i in range(self.stm_device.device.flash_page_num):
-            self.msg_log.write(InfoMessage(f"Reading flash pages {i}"))
-            success, rx = await self.long_running_task(
-                self.stm_device.readFromFlash,
-                self.stm_device.device.flash_pages[i].start,
-                self.stm_device.device.flash_page_num,
-            )
-            if not success:
-                self.msg_log.write(FailMessage(f"Error reading flash page {i}"))
-                errors += 1
-            else:
-                page_empty = True
-                for b in rx:
-                    if b != 0xFF:
-                        page_empty = False
-                        occupied += 1
-                        break
-                if page_empty == True:
-                    empty += 1
+        channel = ProgressChannel()
+        result = await self.long_running_task(
+            scan_flash_pages,
+            self.flash,
+            channel.report,
+            channel.report_page,
+            channel=channel,
+            operation="Scanning flash",
+        )
 
         self.msg_log.write(
-            InfoMessage(
-                f"Read {self.stm_device.device.flash_page_num} pages (errors: {errors})"
-            )
+            InfoMessage(f"Read {result.page_num} pages (errors: {len(result.errors)})")
         )
         self.msg_log.write(
-            InfoMessage(f"Page status-> Occupied pages: {occupied} Free pages: {empty}")
+            InfoMessage(
+                f"Page status-> Occupied pages: {result.occupied} Free pages: {result.blank}"
+            )
         )
+        self.msg_log.write(InfoMessage(f"Page map: {result.bitmap_string()}"))
 
     async def handle_length_keypress(self):
         await self.input_to_attribute("Enter length", "length", int)
@@ -792,8 +1262,90 @@ class StmApp(App):
         await self.input_to_attribute("Enter offset from start address", "offset", int)
         self.update_tables()
 
-    async def handle_upload_keypress(self):
-        """run sanity checks then upload application"""
+    async def handle_uploadmenu_keypress(self):
+        """handle the 'upload' keypress
+        update menu to upload and update tables
+        """
+        self.state = STATE_UPLOAD_APP
+        self.active_menu = self.upload_menu_items
+        self.address = self.stm_device.device.flash_memory.start
+        self.update_tables()
+
+    async def handle_writeram_keypress(self):
+        """handle the 'write ram' keypress
+        update menu to write ram and update tables
+        """
+        self.state = STATE_WRITE_MEM
+        self.active_menu = self.ram_menu_items
+        self.address = free_ram(self.stm_device.device)[0]
+        self.update_tables()
+
+    async def handle_runram_keypress(self):
+        """write the file into RAM and jump to it, for test builds
+        linked to run from RAM. The bootloader stops answering once
+        the image runs, so the device is left disconnected
+        """
+        if not self.filepath or not os.path.isfile(self.filepath):
+            self.msg_log.write(FailMessage("Error - set a file path first"))
+            return
+
+        device = self.stm_device.device
+        try:
+            self.address, image = await self.long_running_task(
+                load_ram_image, self.filepath, device
+            )
+            check_ram_image(device, self.address, image)
+        except (TransferError, ImageError, OSError) as e:
+            self.msg_log.write(ErrorMessage(f"{e}"))
+            return
+
+        self.length = len(image)
+        self.msg_log.write(
+            InfoMessage(f"Writing {self.length} bytes to RAM @ {hex(self.address)}...")
+        )
+        # run_from_ram opens the port itself, & whether it gets as far
+        # as the jump or not the bootloader needs a reset afterwards
+        self.device_disconnect()
+        channel = ProgressChannel()
+        try:
+            await self.long_running_task(
+                partial(
+                    run_from_ram,
+                    on_progress=channel.units("bytes"),
+                    port=self.conn_port,
+                    baud=self.conn_baud,
+                ),
+                device,
+                self.address,
+                image,
+                colour="green",
+                channel=channel,
+            )
+            self.msg_log.write(
+                SuccessMessage(
+                    f"Running from RAM @ {hex(self.address)}, reset the board to reconnect"
+                )
+            )
+        except (TransferError, OSError) as e:
+            self.msg_log.write(ErrorMessage(f"{e}"))
+        self.update_tables()
+
+    async def upload_checks(self) -> bool:
+        """run sanity checks on the upload file & offset
+        the length checked is what the image programs, for HEX, SREC
+        & ELF files that is the decoded data rather than the file size
+        """
+        fmt = None
+        self.length = 0
+        if self.filepath is not None and os.path.isfile(self.filepath):
+            fmt = detect_format(self.filepath)
+            try:
+                self.length = await asyncio.get_running_loop().run_in_executor(
+                    None, image_length, self.filepath, fmt
+                )
+            except (ImageError, OSError) as e:
+                self.msg_log.write(ErrorMessage(f"{e}"))
+                return False
         if (
             self.length > config.MAX_UPLOAD_FILE_LEN
             or self.length < config.MIN_UPLOAD_FILE_LEN
@@ -805,19 +1357,273 @@ class StmApp(App):
             )
             self.length = 0
             self.update_tables()
-            return
+            return False
 
-        if not self.stm_device.device.flash_memory.is_valid(self.address + self.offset):
+        # only raw binaries are placed by offset, other formats carry addresses
+        flash_memory = self.stm_device.device.flash_memory
+        if fmt == FORMAT_BIN and not (
+            flash_memory.is_valid(self.address + self.offset)
+            and flash_memory.is_valid(self.address + self.offset + self.length - 1)
+        ):
             self.msg_log.write(FailMessage(f"Error - invalid address with offset"))
             self.offset = 0
             self.update_tables()
+            return False
+
+        self.update_tables()
+        return True
+
+    async def handle_upload_keypress(self):
+        """run sanity checks then upload application"""
+        if not await self.upload_checks():
+            return
+
+        self.msg_log.write(InfoMessage(f"Uploading {self.filepath}..."))
+        await self.run_upload(upload_segments)
+
+    async def handle_diff_upload_keypress(self):
+        """run sanity checks then upload only the pages
+        which differ from the device
+        """
+        if not await self.upload_checks():
             return
 
-        status = await self.long_running_task(
-            self.stm_device.writeApplicationFileToFlash,
-            self.filepath,
-            self.offset,
+        if self.diff_record:
+            # compare against what this app last flashed to the device
+            self.msg_log.write(InfoMessage("Comparing image against flash record..."))
+            function = partial(
+                diff_segments,
+                record=FlashRecord(),
+                record_key=f"{self.conn_port}:{self.stm_device.device.name}",
+            )
+        else:
+            self.msg_log.write(InfoMessage("Comparing image against device..."))
+            function = diff_segments
+        await self.run_upload(function)
+
+    async def handle_loader_upload_keypress(self):
+        """run sanity checks then upload through the RAM loader,
+        which falls back to the bootloader if it can't be used
+        the loader binary is built per target, so ask for it first
+        """
+        if not self.loader_path:
+            await self.input_to_attribute(
+                "Enter the RAM loader binary built for this target", "loader_path"
+            )
+            if not self.loader_path:
+                self.msg_log.write(FailMessage("Must configure a loader binary first"))
+                return
+        if not await self.upload_checks():
+            return
+
+        self.msg_log.write(InfoMessage(f"Uploading {self.filepath} via RAM loader..."))
+        loop = asyncio.get_running_loop()
+
+        def on_fallback(e):
+            loop.call_soon_threadsafe(
+                self.msg_log.write,
+                InfoMessage(f"RAM loader unavailable: {e}, using the bootloader"),
+            )
+
+        await self.run_upload(
+            partial(
+                accelerated_upload,
+                port=self.conn_port,
+                baud=self.conn_baud,
+                loader_path=self.loader_path,
+                on_fallback=on_fallback,
+            )
+        )
+
+    async def run_upload(self, function):
+        """load the upload file and run an upload function
+        taking (flash, segments) off the event loop
+        raw binaries are mapped & placed at the offset, other
+        formats are streamed into segments at their own addresses
+        """
+        try:
+            fmt = detect_format(self.filepath)
+            if fmt == FORMAT_BIN:
+                with mapped_file(self.filepath) as image:
+                    await self.upload_and_verify(
+                        function, [(self.address + self.offset, image)]
+                    )
+            else:
+                segments = await self.long_running_task(
+                    load_segments, self.filepath, fmt
+                )
+                self.msg_log.write(
+                    InfoMessage(
+                        f"Loaded {len(segments)} segments, {sum(len(s.data) for s in segments)} bytes"
+                    )
+                )
+                await self.upload_and_verify(function, segments)
+        except (TransferError, ImageError, OSError) as e:
+            self.msg_log.write(ErrorMessage(f"{e}"))
+
+    async def upload_and_verify(self, function, segments):
+        """upload the segments then verify them by CRC,
+        re-writing any pages which fail once before giving up
+        """
+        channel = ProgressChannel()
+        result = await self.long_running_task(
+            partial(
+                function,
+                sparse=self.sparse_upload,
+                on_progress=channel.units("pages"),
+                on_page=channel.report_page,
+            ),
+            self.flash,
+            segments,
             colour="green",
+            channel=channel,
+            operation="Uploading",
+        )
+        self.msg_log.write(SuccessMessage(f"Upload complete: {result}"))
+
+        channel = ProgressChannel()
+        verify = await self.long_running_task(
+            verify_segments,
+            self.flash,
+            segments,
+            channel.report,
+            colour="blue",
+            channel=channel,
+            operation="Verifying",
+        )
+        self.show_verify(verify)
+        if not verify.ok:
+            self.msg_log.write(FailMessage(f"Verify failed: {verify}"))
+            bad_pages = verify.bad_pages
+            await self.long_running_task(
+                rewrite_pages, self.flash, segments, bad_pages, colour="green"
+            )
+            verify = await self.long_running_task(
+                verify_segments, self.flash, segments, None, bad_pages, colour="blue"
+            )
+            self.show_verify(verify)
+
+        if verify.ok:
+            self.msg_log.write(SuccessMessage(f"Verified: {verify}"))
+        else:
+            self.msg_log.write(ErrorMessage(f"Verify failed: {verify}"))
+
+    def show_verify(self, verify):
+        """mark verified & failed pages on the flash map"""
+        self.update_flash_map(
+            {
+                page: PAGE_ERROR if page in verify.bad_pages else PAGE_VERIFIED
+                for page in verify.expected.pages
+            }
+        )
+
+    async def handle_sparse_keypress(self):
+        """toggle skipping all 0xFF frames on upload"""
+        self.sparse_upload = not self.sparse_upload
+        self.msg_log.write(
+            InfoMessage(f"Skip blank frames: {'on' if self.sparse_upload else 'off'}")
+        )
+        self.update_tables()
+
+    async def handle_record_keypress(self):
+        """toggle diff uploads comparing against the local
+        record of the last upload instead of a readback
+        """
+        self.diff_record = not self.diff_record
+        self.msg_log.write(
+            InfoMessage(
+                f"Diff against flash record: {'on' if self.diff_record else 'off'}"
+            )
+        )
+        self.update_tables()
+
+    def build_station_table(self, sessions) -> Panel:
+        station_table = Table(
+            "Port",
+            "Device",
+            "Status",
+            "Progress",
+            "KB/s",
+            "Retries",
+            "Time",
+            box=None,
+            expand=True,
+        )
+        for s in sessions:
+            status = s.status
+            if s.status == STATUS_PASS:
+                status = f"[green]{s.status}[/green]"
+            elif s.status == STATUS_FAIL:
+                status = f"[red]{s.status}[/red]"
+            station_table.add_row(
+                s.port,
+                s.device_name,
+                status,
+                f"{s.bytes_done}/{s.bytes_total}",
+                f"{s.throughput / 1024:.1f}",
+                f"{s.retries}",
+                f"{s.elapsed:.1f}s",
+            )
+        return Panel(
+            station_table,
+            title="[bold yellow]Station[/bold yellow]",
+            **config.panel_format,
+        )
+
+    async def handle_station_keypress(self):
+        """handle the station keypress
+        flashes & verifies the same image on every listed
+        port at once, one worker per port
+        """
+        await self.input_to_attribute(
+            "Enter station ports (comma separated)", "station_ports"
+        )
+        ports = [p.strip() for p in self.station_ports.split(",") if p.strip()]
+        if len(ports) == 0:
+            self.msg_log.write(FailMessage("Must enter at least one port"))
+            return
+        await self.handle_filepath_keypress()
+        if not self.filepath:
+            return
+
+        dev_info = self.get_widget_by_id("info")
+        station = FlashStation(ports, self.conn_baud)
+        channel = ProgressChannel()
+        self.msg_log.write(
+            InfoMessage(f"Station flashing {self.filepath} on {len(ports)} ports...")
+        )
+        try:
+            with StationImage(self.filepath, self.offset) as image:
+                task = asyncio.get_running_loop().run_in_executor(
+                    None,
+                    partial(
+                        station.run,
+                        image,
+                        sparse=self.sparse_upload,
+                        on_update=lambda _: channel.report(0, 0),
+                    ),
+                )
+                task.add_done_callback(lambda _: channel.close())
+                dev_info.update(self.build_station_table(station.sessions))
+                async for _ in channel.events():
+                    dev_info.update(self.build_station_table(station.sessions))
+                await task
+        except (ImageError, OSError) as e:
+            self.msg_log.write(ErrorMessage(f"{e}"))
+            return
+
+        dev_info.update(self.build_station_table(station.sessions))
+        for s in station.sessions:
+            if s.passed:
+                self.msg_log.write(
+                    SuccessMessage(f"{s.port}: pass in {s.elapsed:.1f}s")
+                )
+            else:
+                self.msg_log.write(FailMessage(f"{s.port}: fail - {s.error}"))
+        self.msg_log.write(
+            InfoMessage(
+                f"Station done: {station.passed} passed, {station.failed} failed"
+            )
         )
 
     async def handle_cancel_keypress(self):
@@ -829,9 +1635,18 @@ class StmApp(App):
     async def handle_option_bytes(self):
         pass
 
-    def handle_exit_keypress(self):
-        print("Bye!")
-        sys.exit()
+    async def handle_exit_keypress(self):
+        self.exit()
+
+    def on_unmount(self):
+        """save the session's link metrics however the app exits,
+        the cli reports the files written once the screen is restored
+        """
+        # the log widget has already unmounted & closed its file
+        if self.msg_log is not None and self.msg_log.log_path is not None:
+            self.session_files.append(self.msg_log.log_path)
+        if len(self.metrics.commands):
+            self.session_files.extend(self.metrics.save_session())
 
     async def handle_key(self, key: str):
 
@@ -844,7 +1659,7 @@ class StmApp(App):
                 await self.long_running_task(sleep, 5)
 
         # menu commands
-        for command in self.active_menu:
+        for command in self.active_menu + self.any_menu_items:
             if key == command["key"] and command["action"] is not None:
                 asyncio.create_task(command["action"]())
 
@@ -853,49 +1668,52 @@ class StmApp(App):
         await self.handle_key(event.char)
 
     async def read_from_flash(self):
-        if self.filepath is not None and self.read_len > 0:
-            success = True
-            chunks = int(self.read_len / 256)
-            rem = int(self.read_len % 256)
-
-            with open(self.filepath, "wb") as f:
-                for i in range(chunks):
-                    self.msg_log.write(InfoMessage(f"Reading chunk {i+1}"))
-                    success, rx = self.stm_device.readFromFlash(
-                        self.stm_device.device.flash_memory.start + self.offset,
-                        256,
-                    )
-                    if success:
-                        f.write(rx)
-                    else:
-                        self.msg_log.write(ErrorMessage(f"Error Reading chunk {i+1}"))
-                        break
-
-                if rem > 0 and success == True:
-                    self.msg_log.write(InfoMessage(f"Reading chunk {chunks+1}"))
-                    success, rx = self.stm_device.readFromFlash(
-                        self.stm_device.device.flash_memory.start
-                        + self.offset
-                        + (chunks * 256),
-                        rem,
-                    )
-                    if success:
-                        f.write(rx)
-                    else:
-                        self.msg_log.write(
-                            ErrorMessage(f"Error Reading chunk {chunks+1}")
-                        )
-            if success:
+        """read the configured flash range into a file
+        runs the bulk reader off the event loop, reading
+        the whole flash from offset if no length is set
+        """
+        flash = self.stm_device.device.flash_memory
+        length = self.length if self.length > 0 else flash.size - self.offset
+
+        if self.filepath is None or len(self.filepath) == 0:
+            self.msg_log.write(FailMessage("Must configure file path first"))
+        elif self.offset < 0 or length <= 0 or self.offset + length > flash.size:
+            self.msg_log.write(FailMessage("Error - read range outside of flash"))
+        else:
+            channel = ProgressChannel()
+            reader = FlashReader(
+                self.flash,
+                flash.start + self.offset,
+                length,
+                on_progress=channel.report,
+            )
+            crcs = PageCrcTracker(flash.start, self.stm_device.device.flash_page_size)
+            reader.observers.append(crcs.update)
+            self.msg_log.write(
+                InfoMessage(f"Reading {length} bytes from {hex(reader.address)}")
+            )
+            try:
+                await self.long_running_task(
+                    reader.read_to_file,
+                    self.filepath,
+                    channel=channel,
+                    operation="Reading flash",
+                )
+                crcs.save(self.filepath + ".crc", reader.address)
                 self.msg_log.write(
                     SuccessMessage(
-                        f"Succesfully read {self.read_len} bytes from flash into file {self.filepath}"
+                        f"Succesfully read {length} bytes from flash into file {self.filepath}"
                     )
                 )
+                self.msg_log.write(InfoMessage(f"Image crc32: {crcs.crc:08x}"))
+            except (TransferError, OSError) as e:
+                self.msg_log.write(ErrorMessage(f"{e}"))
 
         # clear the self variables
-        self.read_len = 0
+        self.length = 0
         self.filepath = None
         self.offset = 0
+        self.update_tables()
 
     async def on_input_submitted(self, message: Input.Submitted) -> None:
         if self.state != STATE_AWAITING_INPUT:
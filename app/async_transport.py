@@ -0,0 +1,374 @@
+#
+#   asyncio native STM32 USART bootloader transport
+#
+#   Talks the bootloader protocol (ST AN3155) straight over the tty
+#   file descriptor. Reads are driven by the event loop's reader
+#   callback rather than a thread per call, so short commands finish
+#   as soon as the bytes arrive and any number of ports can be kept
+#   busy from one loop.
+#
+#   Only the commands the RAM loader session needs are here: sync,
+#   get, get id, read / write memory and go (see ram_loader). The app,
+#   cli & station still drive STMInterface, which owns the device
+#   model & erases, on executor threads. The protocol constants are
+#   shared with the bootloader simulator.
+#
+
+import asyncio
+import os
+from functools import reduce
+from time import monotonic
+
+from .transfer import RetryPolicy, RttEstimator, TransferStats
+
+BL_ACK = 0x79
+BL_NACK = 0x1F
+BL_SYNC = 0x7F
+
+CMD_GET = 0x00
+CMD_GET_VERSION = 0x01
+CMD_GET_ID = 0x02
+CMD_READ_MEMORY = 0x11
+CMD_GO = 0x21
+CMD_WRITE_MEMORY = 0x31
+CMD_ERASE = 0x43
+CMD_EXTENDED_ERASE = 0x44
+
+BL_MAX_FRAME = 256  # max bytes per read / write memory command
+
+ACK_TIMEOUT = 1.0  # seconds to wait for an ack
+ERASE_TIMEOUT = 30.0  # erases can take a long time, e.g. the loader's
+READ_CHUNK = 4096
+BITS_PER_BYTE = 11  # 8E1 framing, start + 8 data + parity + stop
+FRAME_MARGIN = 0.05  # flash programming time on top of the link time
+
+
+class BootloaderError(Exception):
+    """!@class BootloaderError
+    @brief raised on a NACK, timeout or malformed response
+    """
+
+    def __init__(self, msg: str, command: int = None):
+        self.command = command
+        super().__init__(msg if command is None else f"{msg} (cmd {hex(command)})")
+
+
+def checksum(data) -> int:
+    """! @function checksum
+    @brief bootloader xor checksum of a byte sequence
+    """
+    return reduce(lambda a, b: a ^ b, data, 0)
+
+
+def address_bytes(address: int) -> bytes:
+    raw = address.to_bytes(4, "big")
+    return raw + bytes([checksum(raw)])
+
+
+class AsyncSerialTransport:
+    """!@class AsyncSerialTransport
+    @brief non-blocking byte stream over a tty file descriptor
+
+    Incoming bytes are buffered by a loop reader callback and handed
+    out to awaiting reads. Writes go straight to the fd and fall back
+    to a loop writer callback if the kernel buffer is full.
+    """
+
+    def __init__(self, fd: int, loop=None, owner=None):
+        """! @param loop loop to read on, the running loop if None"""
+        self.fd = fd
+        self.loop = loop or asyncio.get_running_loop()
+        # keep the object which owns the fd (e.g. a serial.Serial) alive
+        self.owner = owner
+        self.buffer = bytearray()
+        self.waiter = None
+        self.wanted = 0
+        self.closed = False
+        os.set_blocking(fd, False)
+        self.loop.add_reader(fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, READ_CHUNK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._wake(e)
+            return
+        self.buffer.extend(data)
+        if self.waiter is not None and len(self.buffer) >= self.wanted:
+            self._wake()
+
+    def _wake(self, error: Exception = None):
+        waiter, self.waiter = self.waiter, None
+        if waiter is not None and not waiter.done():
+            if error is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(error)
+
+    async def read(self, n: int, timeout: float = ACK_TIMEOUT) -> bytes:
+        """! @brief read exactly n bytes
+        @raise BootloaderError on timeout
+        """
+        if len(self.buffer) < n:
+            self.wanted = n
+            self.waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            except asyncio.TimeoutError:
+                self.waiter = None
+                raise BootloaderError(
+                    f"Timed out waiting for {n} bytes (got {len(self.buffer)})"
+                )
+        out = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return out
+
+    async def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            try:
+                n = os.write(self.fd, view)
+                view = view[n:]
+            except (BlockingIOError, InterruptedError):
+                ready = self.loop.create_future()
+                self.loop.add_writer(self.fd, ready.set_result, None)
+                try:
+                    await ready
+                finally:
+                    self.loop.remove_writer(self.fd)
+
+    def set_baud(self, baud: int):
+        """! @brief change the line rate. Only a port opened through
+        open_serial can change, a bare fd keeps the rate it has
+        """
+        if self.owner is not None and hasattr(self.owner, "baudrate"):
+            self.owner.baudrate = baud
+
+    def flush_input(self):
+        self.buffer.clear()
+
+    async def drain(self, quiet: float):
+        """! @brief discard input until the line has been quiet for
+        quiet seconds, so a late reply can't be taken for the next one
+        """
+        while True:
+            self.flush_input()
+            try:
+                await self.read(1, quiet)
+            except BootloaderError:
+                return
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.fd)
+        self._wake(BootloaderError("Transport closed"))
+        if self.owner is not None:
+            self.owner.close()
+
+
+class AsyncBootloader:
+    """!@class AsyncBootloader
+    @brief awaitable STM32 bootloader commands over an AsyncSerialTransport
+
+    Commands on one port are serialised by a lock, commands on
+    different ports can run concurrently. Ack timeouts follow the
+    measured round-trip time of the port and failed read / write
+    frames are retried on their own.
+    """
+
+    def __init__(self, transport: AsyncSerialTransport, baud: int = None, policy=None):
+        self.transport = transport
+        # made on first use, so it belongs to the loop running the commands
+        self._lock = None
+        self.version = None
+        self.commands = []
+        self.device_id = None
+        self.baud = baud
+        self.byte_time = BITS_PER_BYTE / baud if baud else 0.0
+        self.rtt = RttEstimator()
+        self.policy = policy or RetryPolicy()
+        self.stats = TransferStats()
+
+    @classmethod
+    def open_serial(cls, port: str, baud: int, loop=None):
+        """! @brief open a serial port in the bootloader's 8E1 framing.
+        DTR & RTS are released before the port opens, so adapters wired
+        to reset the target (see auto_baud.reset_target) leave it in
+        the bootloader
+        """
+        import serial
+
+        ser = serial.Serial(
+            baudrate=baud,
+            bytesize=serial.EIGHTBITS,
+            parity=serial.PARITY_EVEN,
+            stopbits=serial.STOPBITS_ONE,
+            timeout=0,
+        )
+        ser.port = port
+        ser.dtr = False
+        ser.rts = False
+        ser.open()
+        try:
+            transport = AsyncSerialTransport(ser.fileno(), loop, owner=ser)
+        except RuntimeError:
+            # no loop given and none running
+            ser.close()
+            raise
+        return cls(transport, baud)
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def close(self):
+        self.transport.close()
+
+    def set_baud(self, baud: int):
+        """! @brief switch the port & the timeouts to a new baud"""
+        self.baud = baud
+        self.byte_time = BITS_PER_BYTE / baud if baud else 0.0
+        self.transport.set_baud(baud)
+
+    ## protocol helpers
+
+    def data_timeout(self, n: int) -> float:
+        """! @brief timeout for an ack or reply after n bytes on the wire"""
+        if not self.byte_time:
+            return ACK_TIMEOUT
+        return self.rtt.timeout + n * self.byte_time + FRAME_MARGIN
+
+    async def wait_ack(self, command: int = None, timeout: float = None):
+        if timeout is None:
+            timeout = self.rtt.timeout
+        rx = (await self.transport.read(1, timeout))[0]
+        if rx == BL_NACK:
+            raise BootloaderError("NACK", command)
+        if rx != BL_ACK:
+            raise BootloaderError(f"Unexpected response {hex(rx)}", command)
+
+    async def send_command(self, command: int):
+        start = monotonic()
+        await self.transport.write(bytes([command, command ^ 0xFF]))
+        await self.wait_ack(command)
+        self.rtt.sample(monotonic() - start)
+
+    async def send_with_checksum(self, data, command: int, timeout=None):
+        await self.transport.write(bytes(data) + bytes([checksum(data)]))
+        if timeout is None:
+            timeout = self.data_timeout(len(data) + 1)
+        await self.wait_ack(command, timeout)
+
+    async def retry(self, attempt, before_retry=None):
+        """! @brief run a frame transfer, retrying just that frame with
+        a bounded backoff on a NACK or timeout
+        @param attempt coroutine function doing one try
+        @param before_retry optional coroutine function run before each
+        retry, returning True if the frame turns out to have succeeded
+        """
+        self.stats.frames += 1
+        for n in range(self.policy.max_retries + 1):
+            if n:
+                self.stats.retries += 1
+                await asyncio.sleep(self.policy.delay(n - 1, self.rtt.srtt or 0.0))
+                await self.transport.drain(self.rtt.timeout)
+                if before_retry is not None and await before_retry():
+                    return None
+            try:
+                return await attempt()
+            except BootloaderError as e:
+                error = e
+        self.stats.failures += 1
+        raise error
+
+    ## commands
+
+    async def sync(self, attempts: int = 3) -> bool:
+        """! @brief send the autobaud sync byte and wait for the ack.
+        A NACK means the bootloader is already synced
+        """
+        async with self.lock:
+            self.transport.flush_input()
+            for _ in range(attempts):
+                await self.transport.write(bytes([BL_SYNC]))
+                try:
+                    rx = (await self.transport.read(1, ACK_TIMEOUT))[0]
+                except BootloaderError:
+                    continue
+                if rx in (BL_ACK, BL_NACK):
+                    return True
+            return False
+
+    async def get(self):
+        """! @brief GET command
+        @return (bootloader version, list of supported commands)
+        """
+        async with self.lock:
+            await self.send_command(CMD_GET)
+            n = (await self.transport.read(1))[0]
+            rx = await self.transport.read(n + 1)
+            await self.wait_ack(CMD_GET)
+            self.version = rx[0]
+            self.commands = list(rx[1:])
+            return self.version, self.commands
+
+    async def get_id(self) -> int:
+        async with self.lock:
+            await self.send_command(CMD_GET_ID)
+            n = (await self.transport.read(1))[0]
+            rx = await self.transport.read(n + 1)
+            await self.wait_ack(CMD_GET_ID)
+            self.device_id = int.from_bytes(rx, "big")
+            return self.device_id
+
+    async def read_memory(self, address: int, length: int) -> bytes:
+        """! @brief read up to BL_MAX_FRAME bytes from memory"""
+        if not 0 < length <= BL_MAX_FRAME:
+            raise BootloaderError(f"Invalid read length {length}", CMD_READ_MEMORY)
+        return await self.retry(lambda: self._read_memory(address, length))
+
+    async def _read_memory(self, address: int, length: int) -> bytes:
+        async with self.lock:
+            await self.send_command(CMD_READ_MEMORY)
+            await self.transport.write(address_bytes(address))
+            await self.wait_ack(CMD_READ_MEMORY)
+            n = length - 1
+            await self.transport.write(bytes([n, n ^ 0xFF]))
+            await self.wait_ack(CMD_READ_MEMORY)
+            return await self.transport.read(length, self.data_timeout(length))
+
+    async def write_memory(self, address: int, data):
+        """! @brief write up to BL_MAX_FRAME bytes to memory"""
+        if not 0 < len(data) <= BL_MAX_FRAME:
+            raise BootloaderError(f"Invalid write length {len(data)}", CMD_WRITE_MEMORY)
+
+        async def landed() -> bool:
+            # the ack may have been lost rather than the write
+            try:
+                return await self._read_memory(address, len(data)) == bytes(data)
+            except BootloaderError:
+                return False
+
+        await self.retry(lambda: self._write_memory(address, data), landed)
+
+    async def _write_memory(self, address: int, data):
+        async with self.lock:
+            await self.send_command(CMD_WRITE_MEMORY)
+            await self.transport.write(address_bytes(address))
+            await self.wait_ack(CMD_WRITE_MEMORY)
+            await self.send_with_checksum(
+                bytes([len(data) - 1]) + bytes(data), CMD_WRITE_MEMORY
+            )
+
+    async def go(self, address: int):
+        """! @brief jump to address, the bootloader stops responding after"""
+        async with self.lock:
+            await self.send_command(CMD_GO)
+            await self.transport.write(address_bytes(address))
+            await self.wait_ack(CMD_GO)
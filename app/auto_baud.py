@@ -0,0 +1,226 @@
+#
+#   Automatic baud negotiation
+#
+#   Probes increasing baud rates with short read round-trips and picks
+#   the fastest one which is error free and not measurably slower. The
+#   bootloader autobauds on its first sync after a reset and NACKs any
+#   later sync (AN3155), so the target is reset before every probe,
+#   by default through the adapter's DTR & RTS lines. Results are
+#   remembered per port and USB-UART adapter so later connections
+#   start at the fast rate.
+#
+
+import json
+import os
+from time import monotonic, sleep
+
+from ..SerialFlasher.StmDevice import STMInterface
+from ..SerialFlasher.constants import STM_BOOTLOADER_MAX_BAUD, STM_BOOTLOADER_MIN_BAUD
+
+from .flash_ops import BOOTLOADER_MAX_FRAME, close_interface
+
+STANDARD_BAUDS = (9600, 19200, 38400, 57600, 115200, 230400, 460800, 921600)
+PROBE_FRAMES = 16  # read round-trips per probed rate
+MAX_ERROR_RATE = 0.0  # any failed frame makes a rate unreliable
+THROUGHPUT_MARGIN = 0.1  # a faster rate may measure this much slower, it's noise
+RESET_PULSE = 0.05  # NRST held low
+BOOT_TIME = 0.1  # bootloader start up after NRST is released
+BAUD_RECORD_PATH = os.path.join(
+    os.path.expanduser("~"), ".stmflasher", "baud_record.json"
+)
+
+
+def candidate_bauds(
+    min_baud: int = STM_BOOTLOADER_MIN_BAUD, max_baud: int = STM_BOOTLOADER_MAX_BAUD
+) -> list:
+    return [b for b in STANDARD_BAUDS if min_baud <= b <= max_baud]
+
+
+def adapter_id(port: str) -> str:
+    """! @function adapter_id
+    @brief identify the USB-UART adapter behind a port, so a record
+    follows the cable rather than whichever port name it got
+    @return "vid:pid:serial" or the port's hwid, empty if unknown
+    """
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return ""
+    for info in list_ports.comports():
+        if info.device == port:
+            if info.vid is not None:
+                return f"{info.vid:04x}:{info.pid:04x}:{info.serial_number or ''}"
+            return info.hwid or ""
+    return ""
+
+
+def reset_target(port: str):
+    """! @function reset_target
+    @brief reset the target into its bootloader with the adapter's
+    modem lines, wired as for the ST flash loader: DTR asserted pulls
+    NRST low and RTS released leaves BOOT0 high
+    @raise OSError if the port has no modem lines to drive
+    """
+    import serial
+
+    ser = serial.Serial()
+    ser.port = port
+    # set before opening, so opening doesn't glitch the lines
+    ser.dtr = False
+    ser.rts = False
+    ser.open()
+    try:
+        ser.dtr = True
+        sleep(RESET_PULSE)
+        ser.dtr = False
+        sleep(BOOT_TIME)
+    finally:
+        ser.close()
+
+
+class BaudRecord:
+    """!@class BaudRecord
+    @brief json record of the negotiated baud per port & adapter
+    """
+
+    def __init__(self, path: str = BAUD_RECORD_PATH):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            self.records = {}
+
+    @staticmethod
+    def key(port: str, adapter: str = None) -> str:
+        return f"{port}|{adapter_id(port) if adapter is None else adapter}"
+
+    def get(self, port: str, adapter: str = None) -> int:
+        record = self.records.get(self.key(port, adapter))
+        return None if record is None else record["baud"]
+
+    def update(self, port: str, probe, adapter: str = None):
+        self.records[self.key(port, adapter)] = {
+            "baud": probe.baud,
+            "throughput": round(probe.throughput),
+        }
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.records, f, indent=1)
+
+
+class BaudProbe:
+    """!@class BaudProbe
+    @brief outcome of probing one baud rate
+    """
+
+    def __init__(self, baud: int):
+        self.baud = baud
+        self.connected = False
+        self.frames = 0
+        self.errors = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.frames if self.frames else 1.0
+
+    @property
+    def throughput(self) -> float:
+        """! @return effective bytes per second of the read round-trips"""
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def reliable(self) -> bool:
+        return self.connected and self.error_rate <= MAX_ERROR_RATE
+
+    def __str__(self):
+        if not self.connected:
+            return f"{self.baud}bps: no connection"
+        return (
+            f"{self.baud}bps: {self.errors}/{self.frames} errors, "
+            f"{self.throughput / 1024:.1f} KB/s"
+        )
+
+
+def probe_baud(
+    port: str,
+    baud: int,
+    frames: int = PROBE_FRAMES,
+    interface_factory=STMInterface,
+) -> BaudProbe:
+    """! @function probe_baud
+    @brief connect at baud and time a few max size flash reads. The
+    target must have been reset since its last sync
+    @return BaudProbe
+    """
+    probe = BaudProbe(baud)
+    stm_device = interface_factory()
+    try:
+        try:
+            probe.connected = bool(
+                stm_device.connectAndReadInfo(port, baud=baud, readOptBytes=False)
+            )
+        except Exception:
+            return probe
+        if not probe.connected:
+            return probe
+
+        address = stm_device.device.flash_memory.start
+        start = monotonic()
+        for _ in range(frames):
+            probe.frames += 1
+            try:
+                success, data = stm_device.readFromFlash(address, BOOTLOADER_MAX_FRAME)
+            except Exception:
+                success, data = False, b""
+            if success and len(data) == BOOTLOADER_MAX_FRAME:
+                probe.bytes += len(data)
+            else:
+                probe.errors += 1
+        probe.elapsed = monotonic() - start
+        return probe
+    finally:
+        close_interface(stm_device)
+
+
+def negotiate_baud(
+    port: str,
+    bauds=None,
+    frames: int = PROBE_FRAMES,
+    on_probe=None,
+    interface_factory=STMInterface,
+    reset=reset_target,
+) -> BaudProbe:
+    """! @function negotiate_baud
+    @brief find the fastest reliable baud on a port
+
+    Rates are tried slowest first and probing stops at the first
+    unreliable one, past that point the link only gets worse. The
+    target is reset before each probe and once more at the end, so
+    it is left waiting for a sync at whichever rate is chosen.
+    @param bauds optional list of rates, defaults to the standard rates
+    the bootloader accepts
+    @param on_probe optional callback taking each BaudProbe
+    @param reset callable taking the port which resets the target
+    into its bootloader, reset_target by default
+    @raise OSError if the target can't be reset
+    @return the best BaudProbe, or None if no rate was reliable
+    """
+    best = None
+    for baud in sorted(bauds or candidate_bauds()):
+        reset(port)
+        probe = probe_baud(port, baud, frames, interface_factory)
+        if on_probe is not None:
+            on_probe(probe)
+        if not probe.reliable:
+            break
+        if best is None or probe.throughput >= best.throughput * (
+            1 - THROUGHPUT_MARGIN
+        ):
+            best = probe
+    reset(port)
+    return best
@@ -0,0 +1,261 @@
+#
+#   Transfer & UI benchmark suite
+#
+#   Runs the real operation code through STMInterface against the
+#   simulated bootloader, so transfer numbers move when the transfer
+#   code does and not with whatever board is on the bench. UI costs are
+#   timed per call inside a headless app connected to the simulator.
+#   Every run also times references: a bare frame by frame read
+#   through STMInterface for each link, and a fixed piece of python for
+#   the UI. Results are compared as ratios to the reference from the
+#   same run, so a faster or slower machine moves both sides and only a
+#   change in the code moves the ratio. Ratios are checked against the
+#   baseline stored next to this file, bench_baseline.json, and the
+#   exit status is 1 if any is worse than the tolerance allows. Run it
+#   before merging transfer or UI changes, and refresh the baseline
+#   with --save when a change is meant to move the numbers:
+#
+#       python -m <pkg>.app.bench
+#       python -m <pkg>.app.bench --save <pkg>/app/bench_baseline.json
+#       python -m <pkg>.app.bench --baseline other.json
+#
+
+import argparse
+import json
+import os
+import sys
+from functools import partial
+import tempfile
+import timeit
+from time import monotonic
+
+from ..SerialFlasher.StmDevice import STMInterface
+
+from .bench_startup import DEFAULT_TOLERANCE, compare
+from .bootloader_sim import DENSITIES, BootloaderSimulator, loader_image
+from .flash_ops import FlashReader, scan_flash_pages, split_frames
+from .flash_upload import upload_segments
+from .page_cache import CachedSTMInterface
+from .ram_loader import loader_upload
+from .transfer import RetryingSTMInterface
+
+DEFAULT_DENSITY = "low"  # 32KB keeps a full run to a few minutes
+DEFAULT_BAUDS = (115200, 460800)
+DEFAULT_SIZES = (1024, 8192, 32768)
+UI_CALLS = 200  # calls per timing of the ui benchmarks
+REFERENCE_BYTES = 8192  # read through the bare interface as each link's reference
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+
+
+def timed(func, *args) -> float:
+    start = monotonic()
+    func(*args)
+    return monotonic() - start
+
+
+def per_call(func, number: int = UI_CALLS, repeat: int = 5) -> float:
+    """! @return best seconds per call over repeat runs of number calls"""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def cpu_reference():
+    """! @function cpu_reference
+    @brief fixed python work the ui benchmarks are measured against
+    """
+    return sorted(str(i * 7919 % 1000) for i in range(200))
+
+
+def read_reference(stm_device, address: int) -> float:
+    """! @function read_reference
+    @brief seconds to read REFERENCE_BYTES a frame at a time straight
+    through the interface, with none of the app's transfer code
+    """
+    start = monotonic()
+    for frame, size in split_frames(address, REFERENCE_BYTES):
+        success, _ = stm_device.readFromFlash(frame, size)
+        if not success:
+            raise ConnectionError(f"Reference read failed @ {hex(frame)}")
+    return monotonic() - start
+
+
+def ratios(results: dict) -> dict:
+    """! @function ratios
+    @brief each result over the reference timed in the same run,
+    transfers over their link's read reference and ui costs over the
+    cpu reference
+    """
+    out = {}
+    for name, value in results.items():
+        group, _, tag = name.partition("/")
+        if group == "reference":
+            continue
+        out[name] = value / results[f"reference/{tag or 'ui'}"]
+    return out
+
+
+def connect(port: str, baud: int):
+    """! @brief connect to the simulator as the app does
+    @return (CachedSTMInterface, seconds taken to connect)
+    """
+    stm_device = STMInterface()
+    start = monotonic()
+    if not stm_device.connectAndReadInfo(port, baud=baud, readOptBytes=True):
+        raise ConnectionError(f"Unable to connect to simulator on {port}")
+    elapsed = monotonic() - start
+    return CachedSTMInterface(RetryingSTMInterface(stm_device)), elapsed
+
+
+def bench_transfers(density: str, baud: int, sizes) -> dict:
+    """! @function bench_transfers
+    @brief connect, upload at each size through the bootloader & the
+    RAM loader, dump & scan the whole flash
+    @return dict of benchmark name to seconds
+    """
+    tag = f"{density}@{baud}"
+    results = {}
+    with BootloaderSimulator(density, baud) as sim:
+        flash, results[f"connect/{tag}"] = connect(sim.port, baud)
+        device = flash.device
+        start = device.flash_memory.start
+        results[f"reference/{tag}"] = read_reference(flash.stm_device.stm_device, start)
+        for size in sizes:
+            if size > device.flash_memory.size:
+                continue
+            # random data so no frame is skipped as blank
+            image = os.urandom(size)
+            results[f"upload_{size}/{tag}"] = timed(
+                upload_segments, flash, [(start, image)], None, True
+            )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            loader_path = os.path.join(tmp, "loader.bin")
+            with open(loader_path, "wb") as f:
+                f.write(loader_image(density))
+            for size in sizes:
+                if size > device.flash_memory.size:
+                    continue
+                image = os.urandom(size)
+                results[f"loader_upload_{size}/{tag}"] = timed(
+                    partial(
+                        loader_upload,
+                        port=sim.port,
+                        baud=baud,
+                        loader_path=loader_path,
+                    ),
+                    flash,
+                    [(start, image)],
+                    None,
+                    True,
+                )
+
+        # straight through the link, the page cache would hide it
+        link = flash.stm_device
+        reader = FlashReader(link, start, device.flash_memory.size)
+        results[f"dump/{tag}"] = timed(reader.read_all)
+        results[f"scan/{tag}"] = timed(scan_flash_pages, link)
+    return results
+
+
+def bench_ui(density: str, baud: int, number: int = UI_CALLS) -> dict:
+    """! @function bench_ui
+    @brief per call cost of the TUI's redraw paths, measured in a
+    headless app connected to the simulator
+    @return dict of benchmark name to seconds per call
+    """
+    from .AppMain import StmApp
+
+    results = {}
+    errors = []
+
+    with BootloaderSimulator(density, baud) as sim:
+
+        class Probe(StmApp):
+            def on_mount(self):
+                self.call_after_refresh(self.measure)
+
+            def measure(self):
+                try:
+                    self.conn_port = sim.port
+                    self.conn_baud = baud
+                    if not self.device_connect():
+                        raise ConnectionError("Unable to connect to simulator")
+                    self.handle_connected()
+                    results["reference/ui"] = per_call(cpu_reference, number)
+                    results["update_tables"] = per_call(self.update_tables, number)
+                    results["build_menu"] = per_call(self.build_menu, number)
+                    results["chip_next_frame"] = per_call(
+                        lambda: next(self.chip), number
+                    )
+                    results["chip_render_frame"] = per_call(
+                        lambda: self.chip.renderFrame(0, "red"), number
+                    )
+
+                    def flash_map():
+                        self.flash_map.set_all(0)
+                        self.flash_map.render()
+
+                    results["flash_map_render"] = per_call(flash_map, number)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    self.exit()
+
+        Probe().run(headless=True)
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def run_benchmarks(density: str, bauds, sizes, ui: bool = True) -> dict:
+    results = {}
+    for baud in bauds:
+        results.update(bench_transfers(density, baud, sizes))
+    if ui:
+        results.update(bench_ui(density, max(bauds)))
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="transfer & ui benchmarks")
+    parser.add_argument("--density", choices=list(DENSITIES), default=DEFAULT_DENSITY)
+    parser.add_argument("--bauds", type=int, nargs="+", default=list(DEFAULT_BAUDS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--no-ui", action="store_true", help="skip the ui benchmarks")
+    parser.add_argument("--save", help="write results to a json file")
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE_PATH,
+        help="json results to compare against (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-compare", action="store_true", help="don't compare against a baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.density, args.bauds, args.sizes, not args.no_ui)
+    relative = ratios(results)
+    for name, value in results.items():
+        ratio = f"{relative[name]:10.3f} x ref" if name in relative else ""
+        if value < 0.01:
+            print(f"{name:<32}{value * 1e6:10.1f} us{ratio}")
+        else:
+            print(f"{name:<32}{value:10.3f} s {ratio}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"seconds": results, "ratios": relative}, f, indent=1)
+
+    if not args.no_compare:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["ratios"]
+        slower = compare(relative, baseline, args.tolerance)
+        for name, was, now in slower:
+            print(f"REGRESSION {name}: {was:.3f} -> {now:.3f} x ref")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
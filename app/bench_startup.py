@@ -0,0 +1,114 @@
+#
+#   Startup benchmark
+#
+#   Times a cold import of the cli & the TUI and the TUI's time to
+#   first frame, each in a fresh interpreter so nothing is cached.
+#   Results can be saved as json and compared against a saved baseline
+#   to catch startup regressions:
+#
+#       python -m <pkg>.app.bench_startup --save startup.json
+#       python -m <pkg>.app.bench_startup --baseline startup.json
+#
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+PACKAGE = __package__ or "app"
+
+DEFAULT_RUNS = 5
+DEFAULT_TOLERANCE = 0.25  # allowed slowdown against the baseline
+
+IMPORT_SNIPPET = """
+import time
+t0 = time.perf_counter()
+import {module}
+print(time.perf_counter() - t0)
+"""
+
+FIRST_FRAME_SNIPPET = """
+import time
+t0 = time.perf_counter()
+from {package}.AppMain import StmApp
+
+class Probe(StmApp):
+    def on_mount(self):
+        self.call_after_refresh(self.first_frame)
+
+    def first_frame(self):
+        print(time.perf_counter() - t0)
+        self.exit()
+
+Probe().run(headless=True)
+"""
+
+BENCHMARKS = {
+    "import_cli": IMPORT_SNIPPET.format(module=f"{PACKAGE}.cli"),
+    "import_tui": IMPORT_SNIPPET.format(module=f"{PACKAGE}.AppMain"),
+    "first_frame": FIRST_FRAME_SNIPPET.format(package=PACKAGE),
+}
+
+
+def time_snippet(snippet: str) -> float:
+    """! @function time_snippet
+    @brief run a snippet in a fresh interpreter
+    @return the seconds it prints on its last line
+    """
+    out = subprocess.run(
+        [sys.executable, "-c", snippet], capture_output=True, text=True, check=True
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def run_benchmarks(runs: int = DEFAULT_RUNS, names=None) -> dict:
+    """! @function run_benchmarks
+    @return dict of benchmark name to median seconds over the runs
+    """
+    results = {}
+    for name, snippet in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        results[name] = statistics.median(time_snippet(snippet) for _ in range(runs))
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """! @return list of (name, baseline, result) slower than tolerance allows"""
+    return [
+        (name, baseline[name], value)
+        for name, value in results.items()
+        if name in baseline and value > baseline[name] * (1 + tolerance)
+    ]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="startup benchmark")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS))
+    parser.add_argument("--save", help="write results to a json file")
+    parser.add_argument("--baseline", help="json results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.runs, args.only)
+    for name, value in results.items():
+        print(f"{name:<16}{value * 1000:8.1f} ms")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.tolerance)
+        for name, was, now in slower:
+            print(f"REGRESSION {name}: {was * 1000:.1f} ms -> {now * 1000:.1f} ms")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
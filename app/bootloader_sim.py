@@ -0,0 +1,794 @@
+#
+#   Simulated STM32F1 USART bootloader on a pty
+#
+#   Speaks the bootloader protocol (ST AN3155) on the master side of a
+#   pseudo terminal, so anything which opens the slave path, the app,
+#   the cli or STMInterface itself, can be driven end to end without a
+#   board. Link speed, erase & program times and faults are all
+#   configurable so CI runs at realistic speeds and exercises the
+#   retry paths.
+#
+#       python -m <pkg>.app.bootloader_sim --density high --baud 115200
+#
+#   Jumping with go to a RAM image carrying the loader signature runs
+#   the RAM loader protocol (see ram_loader) until it resets the device.
+#   --write-loader writes a stand-in loader binary which does so.
+#
+#   Like the real bootloader the line rate is locked at the first sync
+#   byte, to whatever rate the host set on the slave end. Bytes sent at
+#   any other rate until the next reset come through as garbage, both
+#   ways. --baud is the rate the slave starts at.
+#
+
+import argparse
+import os
+import pty
+import random
+import select
+import struct
+import termios
+import threading
+import tty
+import zlib
+from collections import namedtuple
+from time import monotonic, sleep
+
+from .async_transport import (
+    BL_ACK,
+    BL_NACK,
+    BL_SYNC,
+    CMD_ERASE,
+    CMD_EXTENDED_ERASE,
+    CMD_GET,
+    CMD_GET_ID,
+    CMD_GET_VERSION,
+    CMD_GO,
+    CMD_READ_MEMORY,
+    CMD_WRITE_MEMORY,
+    BITS_PER_BYTE,
+    checksum,
+)
+from .ram_loader import (
+    BAUD_REVERT_TIME,
+    LDR_BAUD,
+    LDR_ERASE,
+    LDR_HELLO,
+    LDR_RESET,
+    LDR_SYNC,
+    LDR_WRITE,
+    LOADER_BLOCK,
+    LOADER_IDLE,
+    LOADER_SIGNATURE,
+    LOADER_SIGNATURE_OFFSET,
+    LOADER_VERSION,
+    LOADER_WINDOW,
+)
+
+CMD_WRITE_PROTECT = 0x63
+CMD_WRITE_UNPROTECT = 0x73
+CMD_READOUT_PROTECT = 0x82
+CMD_READOUT_UNPROTECT = 0x92
+
+BOOTLOADER_VERSION = 0x22
+FLASH_START = 0x08000000
+RAM_START = 0x20000000
+RAM_RESERVED = 0x200  # used by the bootloader itself (AN2606)
+SYSTEM_MEMORY_START = 0x1FFFF000
+OPT_BYTES_START = 0x1FFFF800
+OPT_BYTES_SIZE = 16
+RDP_KEY = 0xA5  # read protection level 0
+
+Density = namedtuple(
+    "Density", ["pid", "flash_size", "page_size", "ram_size", "extended_erase"]
+)
+
+# STM32F1 line densities (RM0008)
+DENSITIES = {
+    "low": Density(0x412, 32 * 1024, 1024, 10 * 1024, False),
+    "medium": Density(0x410, 128 * 1024, 1024, 20 * 1024, False),
+    "high": Density(0x414, 512 * 1024, 2048, 64 * 1024, False),
+    "connectivity": Density(0x418, 256 * 1024, 2048, 64 * 1024, False),
+    "xl": Density(0x430, 1024 * 1024, 2048, 96 * 1024, True),
+}
+
+DEFAULT_LATENCY = 0.001  # USB-UART turnaround per response
+PAGE_ERASE_TIME = 0.02  # RM0008 tERASE
+MASS_ERASE_TIME = 0.04  # RM0008 tME
+HALFWORD_PROGRAM_TIME = 52.5e-6  # RM0008 tPROG
+LOADER_CODE_SIZE = 0x400  # size of the stand-in loader binary
+LOADER_RESERVED = 0x800  # RAM the loader's code & stack take
+# idle line after which a part command is dropped, so a host retrying
+# from the start after a timeout isn't read as the rest of the old one
+LINE_IDLE = 0.02
+GARBAGE = 0x00  # what a byte sent at the wrong rate comes through as
+
+# termios speed constants to line rates
+LINE_RATES = {
+    getattr(termios, f"B{rate}"): rate
+    for rate in (
+        1200,
+        2400,
+        4800,
+        9600,
+        19200,
+        38400,
+        57600,
+        115200,
+        230400,
+        460800,
+        500000,
+        576000,
+        921600,
+        1000000,
+        2000000,
+    )
+    if hasattr(termios, f"B{rate}")
+}
+
+# loader frame header length by command, after the command byte
+LOADER_HEADERS = {LDR_SYNC: 0, LDR_BAUD: 4, LDR_ERASE: 2, LDR_WRITE: 7, LDR_RESET: 0}
+
+
+class LineIdle(Exception):
+    """!@class LineIdle
+    @brief the host stopped sending part way through a command
+    """
+
+
+class Faults:
+    """!@class Faults
+    @brief rates of injected faults, each checked per response
+    """
+
+    def __init__(
+        self,
+        nack_rate: float = 0.0,
+        drop_rate: float = 0.0,
+        corrupt_rate: float = 0.0,
+        seed: int = None,
+    ):
+        # NACK a command which would have succeeded
+        self.nack_rate = nack_rate
+        # swallow an ACK so the host times out
+        self.drop_rate = drop_rate
+        # flip a bit in read data
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+
+    def hit(self, rate: float) -> bool:
+        return rate > 0 and self.random.random() < rate
+
+
+class SimulatedTarget:
+    """!@class SimulatedTarget
+    @brief memory of a simulated STM32F1: flash, RAM & option bytes
+    """
+
+    def __init__(self, density: str = "medium"):
+        self.density_name = density
+        self.density = DENSITIES[density]
+        self.flash = bytearray(b"\xff" * self.density.flash_size)
+        self.ram = bytearray(self.density.ram_size)
+        self.opt_bytes = bytearray(
+            [RDP_KEY, RDP_KEY ^ 0xFF, 0xFF, 0x00, 0xFF, 0x00, 0xFF, 0x00]
+            + [0xFF, 0x00] * 4
+        )
+        self.jumped_to = None
+
+    @property
+    def page_num(self) -> int:
+        return self.density.flash_size // self.density.page_size
+
+    @property
+    def read_protected(self) -> bool:
+        return self.opt_bytes[0] != RDP_KEY
+
+    def region(self, address: int, length: int):
+        """! @return (buffer, offset) holding the range, or None"""
+        for start, buf in (
+            (FLASH_START, self.flash),
+            (RAM_START, self.ram),
+            (OPT_BYTES_START, self.opt_bytes),
+        ):
+            if start <= address and address + length <= start + len(buf):
+                return buf, address - start
+        return None
+
+    def read(self, address: int, length: int) -> bytes:
+        found = self.region(address, length)
+        if found is None or self.read_protected:
+            return None
+        buf, offset = found
+        return bytes(buf[offset : offset + length])
+
+    def write(self, address: int, data: bytes) -> bool:
+        found = self.region(address, len(data))
+        if found is None or self.read_protected:
+            return False
+        buf, offset = found
+        if buf is self.flash:
+            return self.program(offset, data)
+        if buf is self.ram and address < RAM_START + RAM_RESERVED:
+            return False
+        buf[offset : offset + len(data)] = data
+        return True
+
+    def program(self, offset: int, data: bytes) -> bool:
+        """! @brief program flash a half word at a time as the F1 does.
+        A half word which isn't erased can only be cleared to 0x0000,
+        anything else, even the same data, fails with PGERR and leaves
+        the half words before it programmed (RM0008 3.3.3)
+        """
+        for i in range(0, len(data), 2):
+            at = offset + i
+            new = data[i : i + 2]
+            if self.flash[at : at + len(new)].count(0xFF) != len(new) and any(new):
+                return False
+            self.flash[at : at + len(new)] = new
+        return True
+
+    def erase_pages(self, pages) -> bool:
+        size = self.density.page_size
+        if any(p >= self.page_num for p in pages):
+            return False
+        for page in pages:
+            self.flash[page * size : (page + 1) * size] = b"\xff" * size
+        return True
+
+    def mass_erase(self):
+        self.flash[:] = b"\xff" * len(self.flash)
+
+    def is_loader(self, address: int) -> bool:
+        start = address + LOADER_SIGNATURE_OFFSET
+        return self.read(start, len(LOADER_SIGNATURE)) == LOADER_SIGNATURE
+
+
+class BootloaderSimulator:
+    """!@class BootloaderSimulator
+    @brief serves the bootloader protocol on a pty from a thread
+
+    The slave end is at .port once started. Timings are simulated by
+    holding each response back for as long as the real link & flash
+    would take, at the line rate locked at the last sync.
+    """
+
+    def __init__(
+        self,
+        density: str = "medium",
+        baud: int = 115200,
+        latency: float = DEFAULT_LATENCY,
+        page_erase_time: float = PAGE_ERASE_TIME,
+        mass_erase_time: float = MASS_ERASE_TIME,
+        program_time: float = HALFWORD_PROGRAM_TIME,
+        faults: Faults = None,
+        extended_erase: bool = None,
+    ):
+        self.target = SimulatedTarget(density)
+        self.baud = baud
+        self.byte_time = BITS_PER_BYTE / baud if baud else 0.0
+        self.latency = latency
+        self.page_erase_time = page_erase_time
+        self.mass_erase_time = mass_erase_time
+        self.program_time = program_time
+        self.faults = faults or Faults()
+        if extended_erase is None:
+            extended_erase = self.target.density.extended_erase
+        self.commands = [
+            CMD_GET,
+            CMD_GET_VERSION,
+            CMD_GET_ID,
+            CMD_READ_MEMORY,
+            CMD_GO,
+            CMD_WRITE_MEMORY,
+            CMD_EXTENDED_ERASE if extended_erase else CMD_ERASE,
+            CMD_WRITE_PROTECT,
+            CMD_WRITE_UNPROTECT,
+            CMD_READOUT_PROTECT,
+            CMD_READOUT_UNPROTECT,
+        ]
+        self.synced = False
+        # rate locked at the sync byte, None until then
+        self.line_baud = None
+        # (old rate, deadline) while a loader baud change is unconfirmed
+        self.revert = None
+        # set while a command is part received, see LineIdle
+        self.idle = None
+        self.running = False
+        self.counts = {}
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+
+    ## lifecycle
+
+    def start(self) -> str:
+        """! @brief open the pty & start serving
+        @return path of the slave end to connect to
+        """
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        speed = {rate: speed for speed, rate in LINE_RATES.items()}.get(self.baud)
+        if speed is not None:
+            attrs = termios.tcgetattr(self.slave)
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(self.slave, termios.TCSANOW, attrs)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.serve, name="bootloader-sim", daemon=True
+        )
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset(self):
+        """! @brief system reset back into the bootloader, which then
+        waits for a fresh sync byte
+        """
+        self.synced = False
+        self.target.jumped_to = None
+        self.revert = None
+        self.lock_line(None)
+
+    ## link
+
+    def host_baud(self) -> int:
+        """! @return the rate the host has set on the slave end, the
+        termios of both ends of a pty are shared
+        """
+        try:
+            speed = termios.tcgetattr(self.master)[5]
+        except termios.error:
+            return self.line_baud
+        return LINE_RATES.get(speed, speed)
+
+    def lock_line(self, baud: int):
+        """! @brief lock the line at baud, or unlock it with None"""
+        self.line_baud = baud
+        baud = baud or self.baud
+        self.byte_time = BITS_PER_BYTE / baud if self.baud and baud else 0.0
+
+    def garble(self, data: bytes) -> bytes:
+        """! @brief what data turns into if the host isn't at the locked rate"""
+        if self.line_baud is None or self.host_baud() == self.line_baud:
+            return data
+        return bytes([GARBAGE] * len(data))
+
+    def check_revert(self) -> float:
+        """! @brief go back to the old rate if a loader baud change
+        wasn't confirmed in time
+        @return seconds until the revert is due, or None
+        """
+        if self.revert is None:
+            return None
+        old, deadline = self.revert
+        left = deadline - monotonic()
+        if left > 0:
+            return left
+        self.revert = None
+        self.lock_line(old)
+        return None
+
+    def recv(self, n: int) -> bytes:
+        """! @brief block for n bytes from the host
+        @raise EOFError when the simulator is stopped
+        """
+        out = b""
+        while len(out) < n:
+            if not self.running:
+                raise EOFError
+            revert = self.check_revert()
+            wait = self.idle or min(0.1, revert or 0.1)
+            ready, _, _ = select.select([self.master], [], [], wait)
+            if ready:
+                try:
+                    out += os.read(self.master, n - len(out))
+                except OSError:
+                    # no slave open yet / any more
+                    sleep(0.01)
+            elif self.idle:
+                raise LineIdle
+        # the bytes took this long on the wire
+        sleep(n * self.byte_time)
+        return self.garble(out)
+
+    def send(self, data: bytes, busy: float = 0.0):
+        """! @brief reply after the turnaround, wire & busy time"""
+        sleep(self.latency + len(data) * self.byte_time + busy)
+        os.write(self.master, self.garble(data))
+
+    def stream(self, data: bytes):
+        """! @brief send straight on from the last reply, wire time only"""
+        sleep(len(data) * self.byte_time)
+        os.write(self.master, self.garble(data))
+
+    def ack(self, busy: float = 0.0) -> bool:
+        if self.faults.hit(self.faults.drop_rate):
+            return False
+        if self.faults.hit(self.faults.nack_rate):
+            self.nack()
+            return False
+        self.send(bytes([BL_ACK]), busy)
+        return True
+
+    def nack(self):
+        self.send(bytes([BL_NACK]))
+
+    def recv_checked(self, n: int) -> bytes:
+        """! @brief receive n bytes plus their xor checksum
+        @return the bytes, or None if the checksum is wrong
+        """
+        rx = self.recv(n + 1)
+        return rx[:-1] if checksum(rx[:-1]) == rx[-1] else None
+
+    def recv_address(self) -> int:
+        rx = self.recv_checked(4)
+        return None if rx is None else int.from_bytes(rx, "big")
+
+    ## protocol
+
+    def serve(self):
+        try:
+            while self.running:
+                self.serve_one()
+        except EOFError:
+            pass
+
+    def serve_one(self):
+        first = self.recv(1)[0]
+        if self.target.jumped_to is not None:
+            # running the user program, the bootloader is gone
+            return
+        if not self.synced:
+            if first == BL_SYNC:
+                # autobaud works at any rate, the rest of the session
+                # has to stay at that rate
+                self.synced = True
+                self.lock_line(self.host_baud())
+                self.send(bytes([BL_ACK]))
+            return
+        if first == BL_SYNC:
+            # already synced, as the real bootloader does
+            self.nack()
+            return
+        self.idle = LINE_IDLE
+        try:
+            self.serve_command(first)
+        except LineIdle:
+            # the host gave up part way, start over with its next byte
+            pass
+        finally:
+            self.idle = None
+
+    def serve_command(self, command: int):
+        if self.recv(1)[0] != command ^ 0xFF or command not in self.commands:
+            self.nack()
+            return
+        self.counts[command] = self.counts.get(command, 0) + 1
+        if not self.ack():
+            return
+        handler = {
+            CMD_GET: self.cmd_get,
+            CMD_GET_VERSION: self.cmd_get_version,
+            CMD_GET_ID: self.cmd_get_id,
+            CMD_READ_MEMORY: self.cmd_read_memory,
+            CMD_GO: self.cmd_go,
+            CMD_WRITE_MEMORY: self.cmd_write_memory,
+            CMD_ERASE: self.cmd_erase,
+            CMD_EXTENDED_ERASE: self.cmd_extended_erase,
+            CMD_WRITE_PROTECT: self.cmd_write_protect,
+            CMD_WRITE_UNPROTECT: self.cmd_write_unprotect,
+            CMD_READOUT_PROTECT: self.cmd_readout_protect,
+            CMD_READOUT_UNPROTECT: self.cmd_readout_unprotect,
+        }[command]
+        handler()
+
+    def cmd_get(self):
+        self.send(
+            bytes([len(self.commands), BOOTLOADER_VERSION] + self.commands + [BL_ACK])
+        )
+
+    def cmd_get_version(self):
+        self.send(bytes([BOOTLOADER_VERSION, 0x00, 0x00, BL_ACK]))
+
+    def cmd_get_id(self):
+        self.send(bytes([1]) + self.target.density.pid.to_bytes(2, "big") + b"\x79")
+
+    def cmd_read_memory(self):
+        address = self.recv_address()
+        if address is None or self.target.read_protected:
+            self.nack()
+            return
+        if not self.ack():
+            return
+        rx = self.recv(2)
+        n = rx[0] + 1
+        data = None if rx[0] ^ rx[1] != 0xFF else self.target.read(address, n)
+        if data is None:
+            self.nack()
+            return
+        if self.faults.hit(self.faults.corrupt_rate):
+            data = bytearray(data)
+            data[self.faults.random.randrange(n)] ^= 1 << self.faults.random.randrange(
+                8
+            )
+        if self.ack():
+            self.stream(bytes(data))
+
+    def cmd_write_memory(self):
+        address = self.recv_address()
+        if address is None or self.target.read_protected:
+            self.nack()
+            return
+        if not self.ack():
+            return
+        n = self.recv(1)[0] + 1
+        rx = self.recv(n + 1)
+        if checksum(bytes([n - 1]) + rx[:-1]) != rx[-1]:
+            self.nack()
+            return
+        if not self.target.write(address, rx[:-1]):
+            self.nack()
+            return
+        buf = self.target.region(address, n)[0]
+        busy = (n + 1) // 2 * self.program_time if buf is self.target.flash else 0.0
+        if self.ack(busy) and buf is self.target.opt_bytes:
+            # option byte writes reset the device
+            self.reset()
+
+    def cmd_erase(self):
+        n = self.recv(1)[0]
+        if n == 0xFF:
+            if self.recv(1)[0] != 0x00:
+                self.nack()
+                return
+            self.target.mass_erase()
+            self.ack(self.mass_erase_time)
+            return
+        rx = self.recv(n + 2)
+        if checksum(bytes([n]) + rx[:-1]) != rx[-1]:
+            self.nack()
+            return
+        self.erase(list(rx[:-1]))
+
+    def cmd_extended_erase(self):
+        rx = self.recv(2)
+        n = int.from_bytes(rx, "big")
+        if n >= 0xFFF0:
+            # special erases: 0xFFFF mass, 0xFFFE bank 1, 0xFFFD bank 2
+            if self.recv(1)[0] != checksum(rx) or n < 0xFFFD:
+                self.nack()
+                return
+            half = self.target.page_num // 2
+            pages = {
+                0xFFFF: range(self.target.page_num),
+                0xFFFE: range(half),
+                0xFFFD: range(half, self.target.page_num),
+            }[n]
+            self.target.erase_pages(pages)
+            self.ack(self.mass_erase_time)
+            return
+        body = self.recv(2 * (n + 1) + 1)
+        if checksum(rx + body[:-1]) != body[-1]:
+            self.nack()
+            return
+        self.erase(
+            [int.from_bytes(body[i : i + 2], "big") for i in range(0, 2 * (n + 1), 2)]
+        )
+
+    def erase(self, pages):
+        if not self.target.erase_pages(pages):
+            self.nack()
+            return
+        self.ack(len(pages) * self.page_erase_time)
+
+    def cmd_go(self):
+        address = self.recv_address()
+        if address is None or self.target.region(address, 4) is None:
+            self.nack()
+            return
+        if self.ack():
+            self.target.jumped_to = address
+            if self.target.is_loader(address):
+                self.run_loader()
+
+    def cmd_write_protect(self):
+        n = self.recv(1)[0]
+        rx = self.recv(n + 2)
+        if checksum(bytes([n]) + rx[:-1]) != rx[-1]:
+            self.nack()
+            return
+        for sector in rx[:-1]:
+            byte = 8 + 2 * (sector // 8)
+            if byte < OPT_BYTES_SIZE:
+                self.target.opt_bytes[byte] &= ~(1 << (sector % 8)) & 0xFF
+                self.target.opt_bytes[byte + 1] = self.target.opt_bytes[byte] ^ 0xFF
+        if self.ack():
+            self.reset()
+
+    def cmd_write_unprotect(self):
+        for byte in range(8, OPT_BYTES_SIZE, 2):
+            self.target.opt_bytes[byte] = 0xFF
+            self.target.opt_bytes[byte + 1] = 0x00
+        if self.ack():
+            self.reset()
+
+    def cmd_readout_protect(self):
+        self.target.opt_bytes[0:2] = b"\x00\xff"
+        if self.ack():
+            self.reset()
+
+    def cmd_readout_unprotect(self):
+        # removing read protection mass erases the flash
+        self.target.mass_erase()
+        self.target.opt_bytes[0:2] = bytes([RDP_KEY, RDP_KEY ^ 0xFF])
+        if self.ack(self.mass_erase_time):
+            self.reset()
+
+    ## RAM loader, see ram_loader
+
+    def loader_block(self) -> int:
+        free = self.target.density.ram_size - RAM_RESERVED - LOADER_RESERVED
+        return min(LOADER_BLOCK, free // LOADER_WINDOW // 256 * 256)
+
+    def recv_frame(self, n: int) -> bytes:
+        """! @brief receive n bytes of a loader frame
+        @return the bytes, or None if the line went idle part way
+        """
+        out = b""
+        while len(out) < n:
+            if not self.running:
+                raise EOFError
+            ready, _, _ = select.select([self.master], [], [], LOADER_IDLE)
+            if not ready:
+                return None
+            out += os.read(self.master, n - len(out))
+        sleep(n * self.byte_time)
+        return self.garble(out)
+
+    def drop_input(self):
+        """! @brief discard input until the line has gone idle"""
+        while select.select([self.master], [], [], LOADER_IDLE)[0]:
+            os.read(self.master, 4096)
+
+    def loader_reply(self, status: int, tag: int, busy: float = 0.0):
+        if self.faults.hit(self.faults.drop_rate):
+            return
+        if status == BL_ACK and self.faults.hit(self.faults.nack_rate):
+            status = BL_NACK
+        self.send(bytes([status, tag]), busy)
+        if status == BL_NACK:
+            self.drop_input()
+
+    def run_loader(self):
+        """! @brief act as the RAM loader until it resets the device"""
+        self.idle = None
+        self.send(
+            bytes([LDR_HELLO, LOADER_VERSION]) + struct.pack("<H", self.loader_block())
+        )
+        while True:
+            command = self.recv(1)[0]
+            if command not in LOADER_HEADERS:
+                self.drop_input()
+                continue
+            header = self.recv_frame(LOADER_HEADERS[command])
+            if header is None:
+                continue
+            body_len = 0
+            if command == LDR_ERASE:
+                body_len = 2 * struct.unpack("<H", header)[0]
+            elif command == LDR_WRITE:
+                body_len = struct.unpack("<BIH", header)[2]
+            body = self.recv_frame(body_len + 4)
+            if body is None:
+                continue
+            frame = bytes([command]) + header + body[:-4]
+            tag = header[0] if command == LDR_WRITE else command
+            crc = struct.unpack("<I", body[-4:])[0]
+            if zlib.crc32(frame) != crc or self.faults.hit(self.faults.corrupt_rate):
+                self.loader_reply(BL_NACK, tag)
+                continue
+            self.counts[command] = self.counts.get(command, 0) + 1
+            # a good frame at a new rate confirms the change
+            self.revert = None
+
+            if command == LDR_BAUD:
+                self.loader_reply(BL_ACK, tag)
+                self.revert = (self.line_baud, monotonic() + BAUD_REVERT_TIME)
+                self.lock_line(struct.unpack("<I", header)[0])
+            elif command == LDR_ERASE:
+                pages = struct.unpack(f"<{body_len // 2}H", body[:-4])
+                if self.target.erase_pages(pages):
+                    self.loader_reply(BL_ACK, tag, len(pages) * self.page_erase_time)
+                else:
+                    self.loader_reply(BL_NACK, tag)
+            elif command == LDR_WRITE:
+                self.loader_write(header, body[:-4], len(frame) + 4)
+            elif command == LDR_RESET:
+                self.loader_reply(BL_ACK, tag)
+                self.reset()
+                return
+            else:
+                self.loader_reply(BL_ACK, tag)
+
+    def loader_write(self, header: bytes, data: bytes, frame_len: int):
+        seq, address, length = struct.unpack("<BIH", header)
+        found = self.target.region(address, length)
+        if self.target.read(address, length) == data:
+            # a resend of a block which did land
+            self.loader_reply(BL_ACK, seq)
+        elif (
+            found is None
+            or found[0] is not self.target.flash
+            or not self.target.write(address, data)
+        ):
+            self.loader_reply(BL_NACK, seq)
+        else:
+            # double buffered, programming overlaps the next block arriving
+            program = (length + 1) // 2 * self.program_time
+            self.loader_reply(BL_ACK, seq, max(program - frame_len * self.byte_time, 0))
+
+
+def loader_image(density: str = "medium") -> bytes:
+    """! @function loader_image
+    @brief a stand-in loader binary which the simulator runs as the
+    RAM loader, for trying the loader path without a target build
+    """
+    stack = RAM_START + DENSITIES[density].ram_size
+    reset = RAM_START + RAM_RESERVED + 0x101  # thumb bit set
+    head = struct.pack("<II", stack, reset) + LOADER_SIGNATURE
+    return head.ljust(LOADER_CODE_SIZE, b"\x00")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="simulated STM32F1 bootloader")
+    parser.add_argument("--density", choices=list(DENSITIES), default="medium")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY)
+    parser.add_argument("--nack-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--write-loader", help="write a stand-in RAM loader here")
+    args = parser.parse_args(argv)
+
+    if args.write_loader:
+        with open(args.write_loader, "wb") as f:
+            f.write(loader_image(args.density))
+
+    sim = BootloaderSimulator(
+        args.density,
+        args.baud,
+        args.latency,
+        faults=Faults(args.nack_rate, args.drop_rate, args.corrupt_rate, args.seed),
+    )
+    print(sim.start(), flush=True)
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,15 @@ from ..SerialFlasher.StmDevice import STMInterface
 
 from rich.text import Text
 
+from .flash_ops import (
+    PAGE_BLANK,
+    PAGE_ERROR,
+    PAGE_OCCUPIED,
+    PAGE_UNKNOWN,
+    PAGE_VERIFIED,
+    PAGE_WRITING,
+)
+
 CHIP_IMG_OFFSET = 12
 FLASH_IMG_OFFSET = 4
 CHIP_VALUE_WIDTH = 13
@@ -35,24 +44,121 @@ FLASH_IMAGE = """
 """
 
 
+FLASH_MAP_ROW_PAGES = 32  # pages drawn per flash map row
+FLASH_MAP_CELL = "▄"
+
+PAGE_STATE_COLOURS = {
+    PAGE_UNKNOWN: "grey42",
+    PAGE_BLANK: "white",
+    PAGE_OCCUPIED: "blue",
+    PAGE_WRITING: "yellow",
+    PAGE_VERIFIED: "green",
+    PAGE_ERROR: "red",
+}
+
+
+def flashMapRow(states, row_addr: int) -> str:
+    """! @brief markup for one row of the flash map, one cell per page"""
+    cells = ""
+    run_state = None
+    for state in states:
+        if state != run_state:
+            if run_state is not None:
+                cells += f"[/{PAGE_STATE_COLOURS[run_state]}]"
+            cells += f"[{PAGE_STATE_COLOURS[state]}]"
+            run_state = state
+        cells += FLASH_MAP_CELL
+    if run_state is not None:
+        cells += f"[/{PAGE_STATE_COLOURS[run_state]}]"
+    return f"{' ' * FLASH_IMG_OFFSET}{cells}  {hex(row_addr)}"
+
+
 def generateFlashImage(
-    num_pages: int, start_addr: int = 0x20000000, end_addr: int = 0x20001FFF
+    num_pages: int,
+    start_addr: int = 0x20000000,
+    end_addr: int = 0x20001FFF,
+    states=None,
+    row_pages: int = FLASH_MAP_ROW_PAGES,
 ):
-    fa = start_addr
-    fe = end_addr
-    out = ""
-    block = "▄ ▄ ▄ ▄ ▄ ▄ ▄ ▄\n"
-    out += f"{' ' * FLASH_IMG_OFFSET}▄ ▄ ▄ ▄ ▄ ▄ ▄ ▄  {hex(fe)}\n"
-    out += (" " * FLASH_IMG_OFFSET + block) * (num_pages - 16)
-    out += f"{' ' * FLASH_IMG_OFFSET}▄ ▄ ▄ ▄ ▄ ▄ ▄ ▄  {hex(fa)}\n"
-
-    return out
+    """! @brief markup for the whole flash map, highest address at the top
+    @param states optional sequence of PAGE_ states, all unknown if None
+    """
+    states = bytes(num_pages) if states is None else states
+    page_size = (end_addr + 1 - start_addr) // max(num_pages, 1)
+    rows = [
+        flashMapRow(states[i : i + row_pages], start_addr + i * page_size)
+        for i in range(0, num_pages, row_pages)
+    ]
+    return "\n".join(reversed(rows))
+
+
+class FlashMap:
+    """!@class FlashMap
+    @brief live per-page flash map
+
+    Page states live in a compact bytearray. Each row is rendered to a
+    Text once and kept until one of its pages changes, so updating a
+    few pages only re-renders the rows they sit in.
+    """
+
+    def __init__(
+        self,
+        num_pages: int,
+        start_addr: int,
+        page_size: int,
+        row_pages: int = FLASH_MAP_ROW_PAGES,
+    ):
+        self.num_pages = num_pages
+        self.start_addr = start_addr
+        self.page_size = page_size
+        self.row_pages = row_pages
+        self.states = bytearray(num_pages)
+        self.rows = [None] * ((num_pages + row_pages - 1) // row_pages)
+        self.image = None
+
+    def set_state(self, page: int, state: int):
+        if 0 <= page < self.num_pages and self.states[page] != state:
+            self.states[page] = state
+            self.rows[page // self.row_pages] = None
+            self.image = None
+
+    def set_states(self, states: dict):
+        """! @brief apply a {page: state} dict of changes"""
+        for page, state in states.items():
+            self.set_state(page, state)
+
+    def set_all(self, state: int):
+        for page in range(self.num_pages):
+            self.set_state(page, state)
+
+    @property
+    def dirty(self) -> bool:
+        return self.image is None
+
+    def render(self) -> Text:
+        if self.image is not None:
+            return self.image
+        for row, text in enumerate(self.rows):
+            if text is None:
+                first = row * self.row_pages
+                self.rows[row] = Text.from_markup(
+                    flashMapRow(
+                        self.states[first : first + self.row_pages],
+                        self.start_addr + first * self.page_size,
+                    )
+                )
+        self.image = Text("\n").join(reversed(self.rows))
+        return self.image
 
 
 class ChipImage:
 
     step = 0
 
+    # rendered animation frames, shared by every instance
+    # keyed by (device name, colour)
+    frame_cache = {}
+
     def __init__(self, name: str, colour: str = "red"):
         self.colour = colour
         self.name = name
@@ -107,56 +213,72 @@ class ChipImage:
         density = self.name.split("xxx")[1].split("Density")
         return density[0] + ("VAL" if len(density) > 1 and len(density[1]) > 1 else "")
 
-    def __next__(self, colour: str = None):
-
-        if colour is not None:
-            self.colour = colour
+    def renderFrame(self, step: int, colour: str) -> str:
+        """! @brief markup for one animation step
+        steps 0-23 light up one pin each going round the chip,
+        any other step is the plain chip
+        """
         lines = self.chip_image.split("\n")
-        if self.step < 5:
+        if step < 5:
             line = lines[0]
             elements = line.split(" ")
             # ['', '', '█', '█', '█', '█', '█', '█', '', '']
-            elements[
-                CHIP_IMG_OFFSET + self.step + 2
-            ] = f"[{self.colour}]{elements[CHIP_IMG_OFFSET + self.step + 2]}[/{self.colour}]"
+            elements[CHIP_IMG_OFFSET + step + 2] = (
+                f"[{colour}]{elements[CHIP_IMG_OFFSET + step + 2]}[/{colour}]"
+            )
 
             newline = " ".join(elements)
 
             lines[0] = newline
 
-        elif self.step < 12:
-            line = lines[self.step - 5]
+        elif step < 12:
+            line = lines[step - 5]
             elements = line.split(" ")
-            elements[-1] = f"[{self.colour}]{elements[-1]}[/{self.colour}]"
+            elements[-1] = f"[{colour}]{elements[-1]}[/{colour}]"
 
             newline = " ".join(elements)
-            lines[self.step - 5] = newline
+            lines[step - 5] = newline
 
-        elif self.step < 18:
+        elif step < 18:
             line = lines[-2]
             elements = line.split(" ")
             # ['', '', '█', '█', '█', '█', '█', '█', '', '']
-            elements[
-                -(self.step - 11)
-            ] = f"[{self.colour}]{elements[-(self.step - 11)]}[/{self.colour}]"
+            elements[-(step - 11)] = f"[{colour}]{elements[-(step - 11)]}[/{colour}]"
             newline = " ".join(elements)
 
             lines[-2] = newline
 
-        elif self.step < 24:
-            line = lines[-(self.step - 17) - 2]
+        elif step < 24:
+            line = lines[-(step - 17) - 2]
             elements = line.split(" ")
-            elements[
-                CHIP_IMG_OFFSET
-            ] = f"[{self.colour}]{elements[CHIP_IMG_OFFSET]}[/{self.colour}]"
+            elements[CHIP_IMG_OFFSET] = (
+                f"[{colour}]{elements[CHIP_IMG_OFFSET]}[/{colour}]"
+            )
 
             newline = " ".join(elements)
-            lines[-(self.step - 17) - 2] = newline
+            lines[-(step - 17) - 2] = newline
+
+        return "\n".join(lines)
+
+    def frames(self, colour: str) -> list:
+        """! @brief the animation frames in a colour as Text objects
+        built on first use then shared through the class cache
+        """
+        key = (self.name, colour)
+        frames = self.frame_cache.get(key)
+        if frames is None:
+            # 24 lit frames then the plain chip
+            frames = [
+                Text.from_markup(self.renderFrame(step, colour)) for step in range(25)
+            ]
+            self.frame_cache[key] = frames
+        return frames
 
-        else:
-            self.step = -1
-
-        self.step += 1
+    def __next__(self, colour: str = None):
 
-        out = "\n".join(lines)
-        return Text.from_markup(out)
+        if colour is not None:
+            self.colour = colour
+        frames = self.frames(self.colour)
+        frame = frames[self.step]
+        self.step = (self.step + 1) % len(frames)
+        return frame
@@ -0,0 +1,376 @@
+#
+#   Headless command line entry point
+#
+#   Runs connect / erase / upload / verify / dump / run / station jobs with
+#   the same operation code as the TUI, for CI & production line
+#   scripts. Nothing here imports textual or rich, the TUI (and with it
+#   both of those) is only imported when the tui command is run.
+#
+
+import argparse
+import sys
+from time import monotonic
+
+from ..SerialFlasher.StmDevice import STMInterface
+from ..SerialFlasher.constants import STM_BOOTLOADER_MAX_BAUD, STM_BOOTLOADER_MIN_BAUD
+
+from .auto_baud import BaudRecord, negotiate_baud, reset_target
+from .device_info import capture_snapshot
+from .flash_ops import FlashReader, TransferError, close_interface
+from .flash_upload import (
+    MAX_UPLOAD_FILE_LEN,
+    MIN_UPLOAD_FILE_LEN,
+    FlashRecord,
+    diff_segments,
+    upload_segments,
+)
+from .flash_verify import PageCrcTracker, rewrite_pages, verify_segments
+from .image_loader import ImageError
+from .page_cache import CachedSTMInterface
+from .ram_loader import (
+    LOADER_BAUD,
+    accelerated_upload,
+    check_ram_image,
+    load_ram_image,
+    run_from_ram,
+)
+from .transfer import RetryingSTMInterface
+from .instrumentation import InstrumentedSTMInterface, LinkMetrics
+from .station import FlashStation, StationImage, format_session
+
+DEFAULT_BAUD = 115200
+
+EXIT_OK = 0
+EXIT_FAIL = 1
+EXIT_USAGE = 2
+
+
+def log(msg: str):
+    print(msg, file=sys.stderr)
+
+
+def progress_printer(unit: str):
+    """! @function progress_printer
+    @brief an on_progress callback which redraws one stderr line
+    """
+
+    def report(done: int, total: int):
+        end = "\n" if done >= total else ""
+        print(f"\r  {done}/{total} {unit}", end=end, file=sys.stderr, flush=True)
+
+    return report
+
+
+def port_baud(port: str, baud: int = None) -> int:
+    """! @return baud if given, else the negotiated baud remembered for
+    the port, else the default
+    """
+    return baud or BaudRecord().get(port) or DEFAULT_BAUD
+
+
+def connect(args, read_opt_bytes: bool = False) -> CachedSTMInterface:
+    """! @function connect
+    @brief connect to the bootloader on args.port
+    @return CachedSTMInterface of the connected device
+    """
+    args.baud = port_baud(args.port, args.baud)
+    if not STM_BOOTLOADER_MIN_BAUD <= args.baud <= STM_BOOTLOADER_MAX_BAUD:
+        raise ValueError(
+            f"Invalid baud - min: {STM_BOOTLOADER_MIN_BAUD} max: {STM_BOOTLOADER_MAX_BAUD}"
+        )
+    log(f"Connecting to device on {args.port} at {args.baud}bps")
+    # kept on args so main can report the link on exit
+    args.metrics = LinkMetrics()
+    stm_device = InstrumentedSTMInterface(STMInterface(), args.metrics)
+    if not stm_device.connectAndReadInfo(
+        args.port, baud=args.baud, readOptBytes=read_opt_bytes
+    ):
+        raise ConnectionError(f"Unable to connect on {args.port}")
+    log(f"Connected to {stm_device.device.name}")
+    link = RetryingSTMInterface(stm_device, metrics=args.metrics)
+    args.link = link
+    return CachedSTMInterface(link)
+
+
+def check_image_size(image: StationImage):
+    if not MIN_UPLOAD_FILE_LEN <= image.length <= MAX_UPLOAD_FILE_LEN:
+        raise ValueError(
+            f"Invalid image length {image.length} (min {MIN_UPLOAD_FILE_LEN} max {MAX_UPLOAD_FILE_LEN})"
+        )
+
+
+def verify_and_repair(flash, segments, sparse: bool) -> bool:
+    verify = verify_segments(flash, segments, progress_printer("bytes"))
+    if not verify.ok:
+        log(f"Verify failed: {verify}, re-writing bad pages")
+        bad_pages = verify.bad_pages
+        rewrite_pages(flash, segments, bad_pages, sparse)
+        verify = verify_segments(flash, segments, pages=bad_pages)
+    log(f"Verified: {verify}" if verify.ok else f"Verify failed: {verify}")
+    return verify.ok
+
+
+## COMMANDS ##
+
+
+def cmd_info(args) -> int:
+    flash = connect(args, read_opt_bytes=True)
+    for field, value in capture_snapshot(flash.stm_device)._asdict().items():
+        if isinstance(value, int) and not isinstance(value, bool):
+            value = hex(value)
+        print(f"{field:<20}{value}")
+    return EXIT_OK
+
+
+def manual_reset(port: str):
+    """! @brief stand in for reset_target on boards without DTR/RTS wired"""
+    log(f"Reset the board on {port} into its bootloader, then press enter")
+    input()
+
+
+def cmd_autobaud(args) -> int:
+    log(f"Negotiating baud on {args.port}...")
+    reset = manual_reset if args.manual_reset else reset_target
+    best = negotiate_baud(
+        args.port, on_probe=lambda probe: log(f"  {probe}"), reset=reset
+    )
+    if best is None:
+        log("No reliable baud found")
+        return EXIT_FAIL
+    record = BaudRecord()
+    record.update(args.port, best)
+    record.save()
+    print(best.baud)
+    return EXIT_OK
+
+
+def cmd_erase(args) -> int:
+    flash = connect(args)
+    log("Erasing flash memory...")
+    if not flash.globalEraseFlash():
+        log("Erase failed")
+        return EXIT_FAIL
+    log("Succesfully erased all flash pages")
+    return EXIT_OK
+
+
+def cmd_upload(args) -> int:
+    with StationImage(args.file, args.offset) as image:
+        check_image_size(image)
+        flash = connect(args)
+        segments = image.segments(flash.device)
+        sparse = not args.no_sparse
+        log(f"Uploading {args.file}...")
+        if args.diff:
+            record = FlashRecord(args.record) if args.record else None
+            result = diff_segments(
+                flash,
+                segments,
+                record,
+                f"{args.port}:{flash.device.name}",
+                progress_printer("pages"),
+                sparse,
+            )
+        elif args.loader:
+            result = accelerated_upload(
+                flash,
+                segments,
+                progress_printer("pages"),
+                sparse,
+                on_fallback=lambda e: log(f"RAM loader unavailable: {e}"),
+                port=args.port,
+                baud=args.baud,
+                loader_path=args.loader,
+                loader_baud=args.loader_baud,
+            )
+        else:
+            result = upload_segments(flash, segments, progress_printer("pages"), sparse)
+        log(f"Upload complete: {result}")
+        if args.no_verify:
+            return EXIT_OK
+        return EXIT_OK if verify_and_repair(flash, segments, sparse) else EXIT_FAIL
+
+
+def cmd_verify(args) -> int:
+    with StationImage(args.file, args.offset) as image:
+        flash = connect(args)
+        verify = verify_segments(
+            flash, image.segments(flash.device), progress_printer("bytes")
+        )
+        log(f"Verified: {verify}" if verify.ok else f"Verify failed: {verify}")
+        return EXIT_OK if verify.ok else EXIT_FAIL
+
+
+def cmd_dump(args) -> int:
+    flash = connect(args)
+    memory = flash.device.flash_memory
+    length = args.length if args.length > 0 else memory.size - args.offset
+    if args.offset < 0 or length <= 0 or args.offset + length > memory.size:
+        log("Error - read range outside of flash")
+        return EXIT_USAGE
+
+    reader = FlashReader(
+        flash, memory.start + args.offset, length, on_progress=progress_printer("bytes")
+    )
+    crcs = PageCrcTracker(memory.start, flash.device.flash_page_size)
+    reader.observers.append(crcs.update)
+    log(f"Reading {length} bytes from {hex(reader.address)}")
+    reader.read_to_file(args.file)
+    crcs.save(args.file + ".crc", reader.address)
+    log(f"Succesfully read {length} bytes from flash into file {args.file}")
+    print(f"{crcs.crc:08x}")
+    return EXIT_OK
+
+
+def cmd_run(args) -> int:
+    flash = connect(args)
+    address, image = load_ram_image(args.file, flash.device)
+    check_ram_image(flash.device, address, image)
+    log(f"Writing {len(image)} bytes to RAM @ {hex(address)}...")
+    # run_from_ram opens the port itself
+    close_interface(flash)
+    run_from_ram(
+        flash.device,
+        address,
+        image,
+        progress_printer("bytes"),
+        port=args.port,
+        baud=args.baud,
+    )
+    log(f"Running from RAM @ {hex(address)}")
+    return EXIT_OK
+
+
+def cmd_station(args) -> int:
+    ports = [p.strip() for p in args.ports.split(",") if p.strip()]
+    if len(ports) == 0:
+        log("Must give at least one port")
+        return EXIT_USAGE
+
+    station = FlashStation(ports, {p: port_baud(p, args.baud) for p in ports})
+    with StationImage(args.file, args.offset) as image:
+        check_image_size(image)
+        log(f"Station flashing {args.file} on {len(ports)} ports...")
+        station.run(
+            image,
+            sparse=not args.no_sparse,
+            on_update=lambda s: s.done and log(format_session(s)),
+        )
+    log(f"Station done: {station.passed} passed, {station.failed} failed")
+    return EXIT_OK if station.failed == 0 else EXIT_FAIL
+
+
+def cmd_tui(args) -> int:
+    # the only place textual & rich get imported
+    from .AppMain import StmApp
+
+    app = StmApp()
+    app.run()
+    for path in app.session_files:
+        log(f"Saved {path}")
+    return EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="stmflasher", description="STM32 bootloader flasher"
+    )
+    sub = parser.add_subparsers(dest="command")
+
+    def device_cmd(name: str, func, help: str):
+        p = sub.add_parser(name, help=help)
+        p.add_argument("-p", "--port", required=True, help="serial port")
+        p.add_argument(
+            "-b", "--baud", type=int, help="defaults to the remembered auto baud"
+        )
+        p.add_argument(
+            "--metrics-file",
+            help="write per-command link metrics, OpenMetrics for .prom/.txt else json",
+        )
+        p.set_defaults(func=func)
+        return p
+
+    def image_args(p):
+        p.add_argument("file", help="bin, hex, srec or elf image")
+        p.add_argument(
+            "-o",
+            "--offset",
+            type=lambda v: int(v, 0),
+            default=0,
+            help="offset from the flash start, raw binaries only",
+        )
+
+    device_cmd("info", cmd_info, "connect and print device info")
+    p = device_cmd(
+        "autobaud", cmd_autobaud, "find & remember the fastest reliable baud"
+    )
+    p.add_argument(
+        "--manual-reset",
+        action="store_true",
+        help="prompt for a reset between probes instead of pulsing DTR/RTS",
+    )
+    device_cmd("erase", cmd_erase, "erase all flash")
+
+    p = device_cmd("upload", cmd_upload, "upload & verify an image")
+    image_args(p)
+    p.add_argument("--diff", action="store_true", help="write changed pages only")
+    p.add_argument("--record", help="flash record file to diff against")
+    p.add_argument("--no-sparse", action="store_true", help="write blank frames")
+    p.add_argument("--no-verify", action="store_true")
+    p.add_argument(
+        "--loader",
+        metavar="BIN",
+        help="program through the RAM loader binary BIN, built for the target",
+    )
+    p.add_argument("--loader-baud", type=int, default=LOADER_BAUD)
+
+    image_args(device_cmd("verify", cmd_verify, "verify flash against an image"))
+
+    p = device_cmd("dump", cmd_dump, "read flash into a file")
+    p.add_argument("file", help="output file")
+    p.add_argument("-o", "--offset", type=lambda v: int(v, 0), default=0)
+    p.add_argument(
+        "-l", "--length", type=lambda v: int(v, 0), default=0, help="0 reads to the end"
+    )
+
+    p = device_cmd("run", cmd_run, "write an image to RAM & jump to it")
+    p.add_argument(
+        "file", help="image linked to run from RAM, raw binaries at its start"
+    )
+
+    p = sub.add_parser("station", help="upload & verify on many ports at once")
+    p.add_argument("--ports", required=True, help="comma separated serial ports")
+    p.add_argument(
+        "-b", "--baud", type=int, help="defaults to the remembered auto baud"
+    )
+    image_args(p)
+    p.add_argument("--no-sparse", action="store_true", help="write blank frames")
+    p.set_defaults(func=cmd_station)
+
+    sub.add_parser("tui", help="run the interactive app (default)").set_defaults(
+        func=cmd_tui
+    )
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    func = getattr(args, "func", cmd_tui)
+    start = monotonic()
+    try:
+        code = func(args)
+    except (TransferError, ImageError, ConnectionError, ValueError, OSError) as e:
+        log(f"Error: {e}")
+        code = EXIT_FAIL
+    if func is not cmd_tui:
+        log(f"Done in {monotonic() - start:.2f}s")
+        if getattr(args, "link", None) is not None:
+            log(f"Link: {args.link.stats}")
+        if getattr(args, "metrics_file", None) and getattr(args, "metrics", None):
+            args.metrics.save(args.metrics_file)
+            log(f"Link metrics saved to {args.metrics_file}")
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
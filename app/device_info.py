@@ -0,0 +1,67 @@
+#
+#   Immutable snapshot of the connected device
+#
+#   Taken once at connect time (or on an explicit refresh) so the UI
+#   can render device details without going back to the serial port.
+#
+
+from collections import namedtuple
+
+DeviceSnapshot = namedtuple(
+    "DeviceSnapshot",
+    [
+        "name",
+        "device_id",
+        "bootloader_version",
+        "flash_start",
+        "flash_size",
+        "flash_page_num",
+        "flash_page_size",
+        "ram_start",
+        "ram_size",
+        "read_protect",
+        "watchdog_type",
+        "reset_on_standby",
+        "reset_on_stop",
+        "data_byte0",
+        "data_byte1",
+        "write_protect",
+        "opt_bytes_raw",
+    ],
+)
+
+
+def capture_snapshot(stm_device) -> DeviceSnapshot:
+    """! @function capture_snapshot
+    @brief read everything the UI shows about a device in one go.
+    Talks to the device for the id & bootloader version, everything
+    else comes from the device model filled in at connect
+    @param stm_device connected STMInterface
+    @return DeviceSnapshot
+    """
+    device = stm_device.device
+    opt_bytes = device.opt_bytes
+    return DeviceSnapshot(
+        name=device.name,
+        device_id=stm_device.getDeviceId(),
+        bootloader_version=stm_device.getDeviceBootloaderVersion(),
+        flash_start=device.flash_memory.start,
+        flash_size=device.flash_memory.size,
+        flash_page_num=device.flash_page_num,
+        flash_page_size=device.flash_page_size,
+        ram_start=device.ram.start,
+        ram_size=device.ram.size,
+        read_protect=opt_bytes.readProtect,
+        watchdog_type=opt_bytes.watchdogType,
+        reset_on_standby=opt_bytes.resetOnStandby,
+        reset_on_stop=opt_bytes.resetOnStop,
+        data_byte0=opt_bytes.dataByte0,
+        data_byte1=opt_bytes.dataByte1,
+        write_protect=(
+            opt_bytes.writeProtect0,
+            opt_bytes.writeProtect1,
+            opt_bytes.writeProtect2,
+            opt_bytes.writeProtect3,
+        ),
+        opt_bytes_raw=opt_bytes.rawBytesToString(),
+    )
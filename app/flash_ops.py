@@ -0,0 +1,365 @@
+#
+#   Flash operations which run off the event loop
+#
+#   These are plain blocking functions & classes which drive an
+#   STMInterface. The app hands them to an executor so the UI keeps
+#   drawing while the serial link is busy.
+#
+
+import mmap
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+BOOTLOADER_MAX_FRAME = 256  # max payload of a single bootloader read/write
+PROGRESS_INTERVAL = 0.25  # min seconds between progress reports
+WRITE_QUEUE_DEPTH = 64  # frames buffered between the serial & file threads
+
+# per-page states, as reported through on_page callbacks
+PAGE_UNKNOWN = 0
+PAGE_BLANK = 1
+PAGE_OCCUPIED = 2
+PAGE_WRITING = 3
+PAGE_VERIFIED = 4
+PAGE_ERROR = 5
+
+
+class TransferError(Exception):
+    """!@class TransferError
+    @brief raised when a bulk transfer can not be completed
+    """
+
+    def __init__(self, msg: str, address: int = None):
+        self.address = address
+        super().__init__(msg if address is None else f"{msg} @ {hex(address)}")
+
+
+def close_interface(stm_device):
+    """! @function close_interface
+    @brief release the serial port held by a connected STMInterface,
+    or by any of the wrappers, which pass the call through. A port
+    which has already gone away is not an error
+    """
+    close = getattr(stm_device, "disconnect", None) or getattr(
+        stm_device, "close", None
+    )
+    if close is None:
+        return
+    try:
+        close()
+    except OSError:
+        pass
+
+
+def split_frames(address: int, length: int, frame_size: int = BOOTLOADER_MAX_FRAME):
+    """! @function split_frames
+    @brief yield (address, size) tuples covering a memory range
+    @param address start address of the range
+    @param length number of bytes in the range
+    @param frame_size max bytes per frame
+    """
+    end = address + length
+    while address < end:
+        size = min(frame_size, end - address)
+        yield address, size
+        address += size
+
+
+def page_of(device, address: int) -> int:
+    """! @function page_of
+    @brief index of the flash page holding address. F1 pages are all
+    flash_page_size, so this is the one page to address mapping used
+    """
+    return (address - device.flash_memory.start) // device.flash_page_size
+
+
+def page_bounds(device, page: int):
+    """! @function page_bounds
+    @brief (start, end) address of a flash page
+    """
+    start = device.flash_memory.start + page * device.flash_page_size
+    end = min(
+        start + device.flash_page_size,
+        device.flash_memory.start + device.flash_memory.size,
+    )
+    return start, end
+
+
+def pages_for_range(device, address: int, length: int) -> range:
+    """! @function pages_for_range
+    @brief the exact range of page indexes an address range touches
+    """
+    if length <= 0:
+        return range(0)
+    first = max(page_of(device, address), 0)
+    last = min(page_of(device, address + length - 1), device.flash_page_num - 1)
+    return range(first, last + 1)
+
+
+@contextmanager
+def mapped_file(filepath: str):
+    """! @function mapped_file
+    @brief map a file read-only and yield a memoryview of it, so
+    frames can be sliced out without copying the file into memory
+    @param filepath path of the file to map
+    """
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b"")
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mm)
+        try:
+            yield view
+        finally:
+            view.release()
+            try:
+                mm.close()
+            except BufferError:
+                # a caller still holds a slice, mapping goes with it
+                pass
+
+
+class ProgressThrottle:
+    """!@class ProgressThrottle
+    @brief calls a progress callback at most once per interval,
+    always passing through the final update
+    """
+
+    def __init__(
+        self, callback=None, total: int = 0, interval: float = PROGRESS_INTERVAL
+    ):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.last = 0.0
+
+    def update(self, done: int):
+        if self.callback is None:
+            return
+        now = monotonic()
+        if done >= self.total or now - self.last >= self.interval:
+            self.last = now
+            self.callback(done, self.total)
+
+
+class FlashReader:
+    """!@class FlashReader
+    @brief bulk flash reader
+
+    Walks a flash range in max-size bootloader frames. Serial reads
+    happen on the calling thread while received frames are handed to
+    a writer thread through a bounded queue, so file I/O overlaps the
+    next serial round-trip.
+    """
+
+    def __init__(
+        self,
+        stm_device,
+        address: int,
+        length: int,
+        frame_size: int = BOOTLOADER_MAX_FRAME,
+        on_progress=None,
+        progress_interval: float = PROGRESS_INTERVAL,
+        on_error=None,
+    ):
+        self.stm_device = stm_device
+        self.on_error = on_error
+        self.address = address
+        self.length = length
+        self.frame_size = frame_size
+        self.progress = ProgressThrottle(on_progress, length, progress_interval)
+        self.bytes_read = 0
+        # extra (address, data) callbacks run alongside the sink, e.g. CRCs
+        self.observers = []
+
+    def frames(self):
+        return split_frames(self.address, self.length, self.frame_size)
+
+    def read_frame(self, address: int, size: int) -> bytes:
+        success, rx = self.stm_device.readFromFlash(address, size)
+        if not success or rx is None or len(rx) != size:
+            raise TransferError("Error reading flash", address)
+        return rx
+
+    def read(self, sink) -> int:
+        """! @brief read the range, passing each frame to sink
+        @param sink callable which takes (address, data). Runs on a
+        separate thread to the serial reads
+        If on_error is set, failed frames are passed to it as
+        (address, size) and the read carries on. It runs on the sink
+        thread, in order with the frames, so neither needs a lock
+        @return number of bytes read
+        """
+        frames = queue.Queue(WRITE_QUEUE_DEPTH)
+        sink_error = []
+
+        def drain():
+            while True:
+                item = frames.get()
+                if item is None:
+                    return
+                if sink_error:
+                    continue
+                address, data, size = item
+                try:
+                    if data is None:
+                        self.on_error(address, size)
+                        continue
+                    sink(address, data)
+                    for observer in self.observers:
+                        observer(address, data)
+                except Exception as e:
+                    sink_error.append(e)
+
+        writer = threading.Thread(target=drain, name="flash-reader-sink", daemon=True)
+        writer.start()
+        self.bytes_read = 0
+        try:
+            for address, size in self.frames():
+                if sink_error:
+                    break
+                try:
+                    rx = self.read_frame(address, size)
+                except TransferError:
+                    if self.on_error is None:
+                        raise
+                    rx = None
+                frames.put((address, rx, size))
+                self.bytes_read += size
+                self.progress.update(self.bytes_read)
+        finally:
+            frames.put(None)
+            writer.join()
+
+        if sink_error:
+            raise sink_error[0]
+        return self.bytes_read
+
+    def read_to_file(self, filepath: str) -> int:
+        """! @brief dump the range into a file
+        The dump goes to filepath + ".part", sized up front and memory
+        mapped so frames are copied straight into the mapping. It only
+        replaces filepath once the whole range is read, so a failed
+        dump leaves no file behind
+        @param filepath path of the output file
+        @return number of bytes read
+        """
+        part_path = filepath + ".part"
+        try:
+            with open(part_path, "w+b") as f:
+                f.truncate(self.length)
+                if self.length:
+                    mm = mmap.mmap(f.fileno(), self.length)
+                    try:
+
+                        def sink(address, data):
+                            offset = address - self.address
+                            mm[offset : offset + len(data)] = data
+
+                        self.read(sink)
+                    finally:
+                        mm.flush()
+                        mm.close()
+            os.replace(part_path, filepath)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.unlink(part_path)
+            raise
+        return self.bytes_read
+
+    def read_all(self) -> bytearray:
+        """! @brief read the range into memory
+        @return bytearray of the range contents
+        """
+        out = bytearray()
+        self.read(lambda address, data: out.extend(data))
+        return out
+
+
+class FlashScanResult:
+    """!@class FlashScanResult
+    @brief per-page occupancy of the flash
+
+    Occupancy is held as a bitmap, one bit per page (set = occupied).
+    Pages which could not be read are tracked separately in errors.
+    """
+
+    def __init__(self, page_num: int):
+        self.page_num = page_num
+        self.bitmap = bytearray((page_num + 7) // 8)
+        self.errors = set()
+
+    def set_occupied(self, page: int):
+        self.bitmap[page >> 3] |= 1 << (page & 7)
+
+    def is_occupied(self, page: int) -> bool:
+        return bool(self.bitmap[page >> 3] & (1 << (page & 7)))
+
+    @property
+    def occupied(self) -> int:
+        return sum(bin(b).count("1") for b in self.bitmap)
+
+    @property
+    def blank(self) -> int:
+        return self.page_num - self.occupied - len(self.errors)
+
+    def bitmap_string(self) -> str:
+        return self.bitmap.hex()
+
+
+def scan_flash_pages(stm_device, on_progress=None, on_page=None) -> FlashScanResult:
+    """! @function scan_flash_pages
+    @brief stream the whole flash in one pass and mark each page
+    as blank or occupied
+    @param stm_device connected STMInterface
+    @param on_progress optional callback taking (done, total) bytes
+    @param on_page optional callback taking (page, PAGE_ state) as
+    each page completes
+    @return FlashScanResult
+    """
+    device = stm_device.device
+    start = device.flash_memory.start
+    page_size = device.flash_page_size
+    result = FlashScanResult(device.flash_page_num)
+    blank = bytes([0xFF]) * BOOTLOADER_MAX_FRAME
+
+    def check(address: int, data: bytes):
+        view = memoryview(data)
+        while len(view):
+            page = page_of(device, address)
+            page_end = page_bounds(device, page)[1]
+            span = min(len(view), page_end - address)
+            # compare against a blank block rather than byte by byte
+            if not result.is_occupied(page) and view[:span] != blank[:span]:
+                result.set_occupied(page)
+            view = view[span:]
+            address += span
+            if on_page is not None and address == page_end:
+                if page in result.errors:
+                    on_page(page, PAGE_ERROR)
+                else:
+                    on_page(
+                        page, PAGE_OCCUPIED if result.is_occupied(page) else PAGE_BLANK
+                    )
+
+    def error(address: int, size: int):
+        result.errors.update(pages_for_range(device, address, size))
+        if on_page is not None:
+            for page in pages_for_range(device, address, size):
+                on_page(page, PAGE_ERROR)
+
+    reader = FlashReader(
+        stm_device,
+        start,
+        device.flash_page_num * page_size,
+        on_progress=on_progress,
+        on_error=error,
+    )
+    reader.read(check)
+    # a page with a failed frame is unknown, not occupied
+    for page in result.errors:
+        result.bitmap[page >> 3] &= ~(1 << (page & 7)) & 0xFF
+    return result
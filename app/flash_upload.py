@@ -0,0 +1,335 @@
+#
+#   Flash upload operations
+#
+#   Like flash_ops these are blocking and are run in an executor by
+#   the app. They expect the page cached interface from page_cache so
+#   erases & writes keep the cache honest.
+#
+
+import hashlib
+import json
+import os
+
+from .flash_ops import (
+    BOOTLOADER_MAX_FRAME,
+    PAGE_OCCUPIED,
+    PAGE_WRITING,
+    ProgressThrottle,
+    TransferError,
+    page_bounds,
+    pages_for_range,
+    split_frames,
+)
+
+# pages per extended erase request, keeps each under the ack timeout
+ERASE_BATCH_PAGES = 32
+BLANK_FRAME = bytes([0xFF]) * BOOTLOADER_MAX_FRAME
+MIN_UPLOAD_FILE_LEN = 32  # 32b min file upload size
+MAX_UPLOAD_FILE_LEN = 8000000  # 8MB max file upload size
+FLASH_RECORD_PATH = os.path.join(
+    os.path.expanduser("~"), ".stmflasher", "flash_record.json"
+)
+
+
+def page_spans(flash, address: int, length: int):
+    """! @function page_spans
+    @brief yield (page, lo, hi, image_offset) for each page an image
+    placed at address touches. lo/hi are the byte range inside the page
+    covered by the image
+    """
+    device = flash.device
+    end = address + length
+    for page in pages_for_range(device, address, length):
+        page_start, page_end = page_bounds(device, page)
+        lo = max(address, page_start)
+        hi = min(end, page_end)
+        yield page, lo - page_start, hi - page_start, lo - address
+
+
+class ErasePlan:
+    """!@class ErasePlan
+    @brief set of flash pages to erase, issued as batched
+    extended erase requests rather than a global erase
+    """
+
+    def __init__(self, pages, batch_size: int = ERASE_BATCH_PAGES):
+        self.pages = sorted(set(pages))
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.pages)
+
+    def batches(self):
+        for i in range(0, len(self.pages), self.batch_size):
+            yield self.pages[i : i + self.batch_size]
+
+    def execute(self, flash):
+        """! @brief erase the planned pages
+        @param flash CachedSTMInterface of the connected device
+        """
+        for batch in self.batches():
+            if not flash.eraseFlashPages(batch):
+                raise TransferError(
+                    "Error erasing flash pages",
+                    page_bounds(flash.device, batch[0])[0],
+                )
+
+
+class FlashRecord:
+    """!@class FlashRecord
+    @brief local record of the page contents last flashed to a device
+
+    Stored as json, keyed by a caller supplied device key (port and
+    device name in the app) then page index.
+    """
+
+    def __init__(self, path: str = FLASH_RECORD_PATH):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            self.records = {}
+
+    def get(self, key: str, page: int) -> str:
+        return self.records.get(key, {}).get(str(page))
+
+    def update(self, key: str, digests: dict):
+        record = self.records.setdefault(key, {})
+        record.update({str(p): d for p, d in digests.items()})
+
+    def forget(self, key: str, pages=None):
+        if pages is None:
+            self.records.pop(key, None)
+        else:
+            for page in pages:
+                self.records.get(key, {}).pop(str(page), None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.records, f)
+
+
+class UploadResult:
+    """!@class UploadResult
+    @brief summary of an upload
+    """
+
+    def __init__(self):
+        self.pages_total = 0
+        self.pages_written = []
+        self.pages_skipped = []
+        self.bytes_written = 0
+        self.frames_written = 0
+        self.bytes_skipped = 0
+        self.frames_skipped = 0
+
+    def __str__(self):
+        out = (
+            f"{len(self.pages_written)}/{self.pages_total} pages written, "
+            f"{len(self.pages_skipped)} unchanged, {self.bytes_written} bytes"
+        )
+        if self.frames_skipped:
+            out += f" ({self.bytes_skipped} blank bytes in {self.frames_skipped} frames skipped)"
+        return out
+
+
+def write_page(
+    flash, page: int, data: bytes, result: UploadResult, sparse: bool = False
+):
+    """! @function write_page
+    @brief program a whole page in bootloader sized frames
+    @param sparse skip frames which are all 0xFF. Only honoured if the
+    page is known to be erased
+    """
+    view = memoryview(data)
+    base = page_bounds(flash.device, page)[0]
+    sparse = sparse and flash.is_blank(page)
+    for address, size in split_frames(base, len(view), BOOTLOADER_MAX_FRAME):
+        frame = view[address - base : address - base + size]
+        if sparse and frame == BLANK_FRAME[:size]:
+            result.frames_skipped += 1
+            result.bytes_skipped += size
+            continue
+        if not flash.writeToFlash(address, frame):
+            raise TransferError("Error writing flash", address)
+        result.frames_written += 1
+        result.bytes_written += size
+
+
+def check_fits(flash, address: int, length: int):
+    flash_memory = flash.device.flash_memory
+    if (
+        length <= 0
+        or not flash_memory.is_valid(address)
+        or not flash_memory.is_valid(address + length - 1)
+    ):
+        raise TransferError("Image does not fit in flash", address)
+
+
+def page_chunks(flash, segments):
+    """! @function page_chunks
+    @brief group segment data by the pages it lands on
+    @param segments iterable of (address, data)
+    @return sorted list of (page, [(lo, hi, chunk), ...]) where lo/hi
+    are offsets inside the page and chunk is a view into the segment
+    """
+    pages = {}
+    for address, data in segments:
+        check_fits(flash, address, len(data))
+        view = memoryview(data)
+        for page, lo, hi, off in page_spans(flash, address, len(view)):
+            pages.setdefault(page, []).append((lo, hi, view[off : off + hi - lo]))
+    return [(page, pages[page]) for page in sorted(pages)]
+
+
+def chunks_digest(chunks) -> str:
+    digest = hashlib.sha1()
+    for lo, hi, chunk in chunks:
+        digest.update(b"%d:%d:" % (lo, hi))
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def merged_page(flash, page: int, chunks) -> bytes:
+    """! @function merged_page
+    @brief contents of a page once image chunks are written over it.
+    Partly covered pages keep the device contents outside the chunks
+    """
+    start, end = page_bounds(flash.device, page)
+    if len(chunks) == 1 and chunks[0][0] == 0 and chunks[0][1] == end - start:
+        return chunks[0][2]
+    current = flash.fetch_page(page)
+    if current is None:
+        raise TransferError("Error reading flash page", start)
+    wanted = bytearray(current)
+    for lo, hi, chunk in chunks:
+        wanted[lo:hi] = chunk
+    return bytes(wanted)
+
+
+def program_pages(
+    flash,
+    pages: list,
+    result: UploadResult,
+    on_progress=None,
+    sparse: bool = False,
+    on_page=None,
+):
+    """! @function program_pages
+    @brief erase then program a list of (page, data)
+    @param on_page optional callback taking (page, PAGE_ state)
+    """
+    ErasePlan([p for p, _ in pages]).execute(flash)
+    progress = ProgressThrottle(on_progress, len(pages))
+    for i, (page, data) in enumerate(pages):
+        if on_page is not None:
+            on_page(page, PAGE_WRITING)
+        try:
+            write_page(flash, page, data, result, sparse)
+        except TransferError:
+            # a frame which part programmed can't be written again
+            # until its page is erased, so redo the page once
+            if not flash.eraseFlashPages([page]):
+                raise
+            write_page(flash, page, data, result, sparse)
+        if on_page is not None:
+            on_page(page, PAGE_OCCUPIED)
+        # keep only the digest so host memory doesn't grow with the image
+        flash.store_hash(page, hashlib.sha1(data).digest())
+        result.pages_written.append(page)
+        progress.update(i + 1)
+
+
+def upload_segments(
+    flash, segments, on_progress=None, sparse: bool = False, on_page=None
+):
+    """! @function upload_segments
+    @brief erase just the pages the segments touch and program them
+
+    Upload time scales with the image rather than the device as only
+    the planned pages are erased. Gaps between segments are never
+    sent unless they share a page with image data.
+    @param flash CachedSTMInterface of the connected device
+    @param segments iterable of (address, data)
+    @param on_progress optional callback taking (done, total) pages
+    @param sparse skip all 0xFF frames on the freshly erased pages
+    @param on_page optional callback taking (page, PAGE_ state)
+    @return UploadResult
+    """
+    result = UploadResult()
+    pages = [
+        (page, merged_page(flash, page, chunks))
+        for page, chunks in page_chunks(flash, segments)
+    ]
+    result.pages_total = len(pages)
+    program_pages(flash, pages, result, on_progress, sparse, on_page)
+    return result
+
+
+def diff_segments(
+    flash,
+    segments,
+    record: FlashRecord = None,
+    record_key: str = None,
+    on_progress=None,
+    sparse: bool = False,
+    on_page=None,
+) -> UploadResult:
+    """! @function diff_segments
+    @brief erase & program only the pages of an image which differ
+    from the device
+
+    Pages are compared by hash, either against the local record of the
+    last upload or against the page cache's hash index, which reads
+    back any page it has no digest for. Pages the
+    image only partly covers are merged with the device contents so the
+    rest of the page survives the erase.
+    @param flash CachedSTMInterface of the connected device
+    @param segments iterable of (address, data)
+    @param record optional FlashRecord to compare against instead of a readback
+    @param record_key key of this device in the record
+    @param on_progress optional callback taking (done, total) pages
+    @param sparse skip all 0xFF frames on the freshly erased pages
+    @param on_page optional callback taking (page, PAGE_ state)
+    @return UploadResult
+    """
+    result = UploadResult()
+    pages = page_chunks(flash, segments)
+    result.pages_total = len(pages)
+    digests = {}
+    changed = []
+
+    for page, chunks in pages:
+        digests[page] = chunks_digest(chunks)
+        if record is not None and record.get(record_key, page) == digests[page]:
+            result.pages_skipped.append(page)
+            continue
+
+        wanted = merged_page(flash, page, chunks)
+        # pages programmed this session are in the hash index, only
+        # the others are read back
+        current = flash.page_hash(page)
+        if current is None:
+            raise TransferError(
+                "Error reading flash page", page_bounds(flash.device, page)[0]
+            )
+        if hashlib.sha1(wanted).digest() == current:
+            result.pages_skipped.append(page)
+            if on_page is not None:
+                on_page(page, PAGE_OCCUPIED)
+        else:
+            changed.append((page, wanted))
+
+    if changed:
+        if record is not None:
+            # the device is in an unknown state until we finish
+            record.forget(record_key, [p for p, _ in changed])
+            record.save()
+        program_pages(flash, changed, result, on_progress, sparse, on_page)
+
+    if record is not None:
+        record.update(record_key, digests)
+        record.save()
+    return result
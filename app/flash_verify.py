@@ -0,0 +1,172 @@
+#
+#   Streaming CRC verification
+#
+#   CRCs are worked out frame by frame as data comes off the serial
+#   link, both per page and over the whole image, so nothing has to be
+#   buffered for a compare afterwards. A mismatch names the bad pages
+#   so only those are re-written.
+#
+#   zlib.crc32 is the same CRC-32 as crc.Crc32.CRC32 but runs in C,
+#   which keeps the checksum well ahead of the serial link.
+#
+
+import json
+import zlib
+
+from .flash_ops import FlashReader, page_bounds
+from .flash_upload import UploadResult, merged_page, page_chunks, program_pages
+
+
+class PageCrcTracker:
+    """!@class PageCrcTracker
+    @brief running CRC-32 of a stream of (address, data), kept per
+    flash page and over everything seen
+    """
+
+    def __init__(self, flash_start: int, page_size: int):
+        self.flash_start = flash_start
+        self.page_size = page_size
+        self.pages = {}
+        self.crc = 0
+        self.length = 0
+
+    def update(self, address: int, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.length += len(data)
+        view = memoryview(data)
+        while len(view):
+            page = (address - self.flash_start) // self.page_size
+            span = min(
+                len(view), self.flash_start + (page + 1) * self.page_size - address
+            )
+            self.pages[page] = zlib.crc32(view[:span], self.pages.get(page, 0))
+            view = view[span:]
+            address += span
+
+    def pages_of(self, address: int, length: int) -> range:
+        """! @brief range of pages an address range touches"""
+        first = (address - self.flash_start) // self.page_size
+        last = (address + length - 1 - self.flash_start) // self.page_size
+        return range(first, last + 1)
+
+    def to_dict(self) -> dict:
+        return {
+            "length": self.length,
+            "crc32": f"{self.crc:08x}",
+            "pages": {str(p): f"{c:08x}" for p, c in sorted(self.pages.items())},
+        }
+
+    def save(self, filepath: str, address: int):
+        """! @brief write the CRCs as a json sidecar file"""
+        out = {"address": hex(address)}
+        out.update(self.to_dict())
+        with open(filepath, "w") as f:
+            json.dump(out, f, indent=1)
+
+
+class VerifyResult:
+    """!@class VerifyResult
+    @brief outcome of a verify pass
+    """
+
+    def __init__(self, expected: PageCrcTracker, actual: PageCrcTracker, unread=()):
+        """! @param unread pages which couldn't be read back"""
+        self.expected = expected
+        self.actual = actual
+        self.unread = sorted(unread)
+        self.bad_pages = sorted(
+            set(p for p, c in expected.pages.items() if actual.pages.get(p) != c)
+            | set(unread)
+        )
+
+    @property
+    def ok(self) -> bool:
+        return len(self.bad_pages) == 0 and self.expected.crc == self.actual.crc
+
+    def __str__(self):
+        if self.ok:
+            return f"image crc32 {self.actual.crc:08x} over {len(self.expected.pages)} pages"
+        out = (
+            f"crc32 expected {self.expected.crc:08x} got {self.actual.crc:08x}, "
+            f"bad pages: {self.bad_pages}"
+        )
+        if self.unread:
+            out += f", unreadable pages: {self.unread}"
+        return out
+
+
+def clip_segments(flash, segments, pages) -> list:
+    """! @function clip_segments
+    @brief the parts of the segments which land on the listed pages
+    """
+    pages = set(pages)
+    return [
+        (page_bounds(flash.device, page)[0] + lo, chunk)
+        for page, chunks in page_chunks(flash, segments)
+        if page in pages
+        for lo, hi, chunk in chunks
+    ]
+
+
+def verify_segments(flash, segments, on_progress=None, pages=None) -> VerifyResult:
+    """! @function verify_segments
+    @brief read back the flash under each segment and compare CRCs
+
+    Reads bypass the page cache so the device itself is checked. A
+    frame which can't be read marks its pages bad and the check carries
+    on, so rewrite_pages can repair them along with any mismatches.
+    @param flash CachedSTMInterface of the connected device
+    @param segments iterable of (address, data)
+    @param on_progress optional callback taking (done, total) bytes
+    @param pages optional list of pages to limit the check to
+    @return VerifyResult
+    """
+    device = flash.device
+    if pages is not None:
+        segments = clip_segments(flash, segments, pages)
+    segments = sorted(segments, key=lambda s: s[0])
+    expected = PageCrcTracker(device.flash_memory.start, device.flash_page_size)
+    actual = PageCrcTracker(device.flash_memory.start, device.flash_page_size)
+    for address, data in segments:
+        expected.update(address, data)
+
+    unread = set()
+
+    def unreadable(address: int, size: int):
+        unread.update(actual.pages_of(address, size))
+
+    done = 0
+    for address, data in segments:
+
+        def progress(seg_done, seg_total):
+            if on_progress is not None:
+                on_progress(done + seg_done, expected.length)
+
+        FlashReader(
+            flash.stm_device,
+            address,
+            len(data),
+            on_progress=progress,
+            on_error=unreadable,
+        ).read(actual.update)
+        done += len(data)
+
+    return VerifyResult(expected, actual, unread)
+
+
+def rewrite_pages(flash, segments, pages, sparse: bool = False) -> UploadResult:
+    """! @function rewrite_pages
+    @brief erase & program just the listed pages from the segments,
+    used to repair pages which failed verification
+    """
+    pages = set(pages)
+    flash.invalidate(pages)
+    result = UploadResult()
+    todo = [
+        (page, merged_page(flash, page, chunks))
+        for page, chunks in page_chunks(flash, segments)
+        if page in pages
+    ]
+    result.pages_total = len(todo)
+    program_pages(flash, todo, result, sparse=sparse)
+    return result
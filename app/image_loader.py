@@ -0,0 +1,284 @@
+#
+#   Streaming firmware image loader
+#
+#   Reads Intel HEX, Motorola SREC and ELF files a record at a time
+#   and coalesces the records into contiguous segments. Raw binaries
+#   have no addresses, so they are left to the caller to place with
+#   an offset.
+#
+#   A file is read twice: once keeping only the extent of each segment,
+#   then again decoding every record straight into one buffer the size
+#   of the image. Host memory is the decoded image and nothing more,
+#   with no growing per segment buffers or copies when segments merge.
+#
+
+import bisect
+import os
+import struct
+from collections import namedtuple
+from itertools import accumulate
+
+FORMAT_BIN = "bin"
+FORMAT_IHEX = "ihex"
+FORMAT_SREC = "srec"
+FORMAT_ELF = "elf"
+
+IHEX_EXTENSIONS = (".hex", ".ihex", ".ihx")
+SREC_EXTENSIONS = (".srec", ".s19", ".s28", ".s37", ".mot")
+ELF_EXTENSIONS = (".elf", ".axf", ".out")
+
+ELF_MAGIC = b"\x7fELF"
+ELF_PT_LOAD = 1
+ELF_READ_CHUNK = 4096
+
+
+Segment = namedtuple("Segment", ["address", "data"])
+
+
+class ImageError(Exception):
+    """!@class ImageError
+    @brief raised for malformed or unsupported image files
+    """
+
+    def __init__(self, msg: str, line: int = None):
+        self.line = line
+        super().__init__(msg if line is None else f"{msg} (line {line})")
+
+
+def detect_format(filepath: str) -> str:
+    """! @function detect_format
+    @brief work out an image format from the extension, falling back
+    to the first bytes of the file
+    """
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext in IHEX_EXTENSIONS:
+        return FORMAT_IHEX
+    if ext in SREC_EXTENSIONS:
+        return FORMAT_SREC
+    if ext in ELF_EXTENSIONS:
+        return FORMAT_ELF
+
+    with open(filepath, "rb") as f:
+        head = f.read(4)
+    if head == ELF_MAGIC:
+        return FORMAT_ELF
+    if head[:1] == b":":
+        return FORMAT_IHEX
+    if head[:1] == b"S" and head[1:2].isdigit():
+        return FORMAT_SREC
+    return FORMAT_BIN
+
+
+def _hex_bytes(line: str, lineno: int) -> bytes:
+    try:
+        return bytes.fromhex(line)
+    except ValueError:
+        raise ImageError("Invalid hex digits", lineno)
+
+
+def iter_ihex_records(f):
+    """! @function iter_ihex_records
+    @brief yield (address, data) for each data record of an Intel HEX file
+    @param f text file object, read a line at a time
+    """
+    base = 0
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if line[0] != ":":
+            raise ImageError("Missing record mark", lineno)
+        raw = _hex_bytes(line[1:], lineno)
+        if len(raw) < 5 or len(raw) != raw[0] + 5:
+            raise ImageError("Bad record length", lineno)
+        if sum(raw) & 0xFF:
+            raise ImageError("Bad checksum", lineno)
+
+        count, rtype = raw[0], raw[3]
+        offset = (raw[1] << 8) | raw[2]
+        data = raw[4 : 4 + count]
+        if rtype == 0x00:
+            yield base + offset, data
+        elif rtype == 0x01:
+            return
+        elif rtype == 0x02:
+            base = int.from_bytes(data, "big") << 4
+        elif rtype == 0x04:
+            base = int.from_bytes(data, "big") << 16
+        elif rtype in (0x03, 0x05):
+            # start address records, nothing to program
+            pass
+        else:
+            raise ImageError(f"Unknown record type {rtype}", lineno)
+
+
+def iter_srec_records(f):
+    """! @function iter_srec_records
+    @brief yield (address, data) for each data record of an SREC file
+    @param f text file object, read a line at a time
+    """
+    addr_len = {"1": 2, "2": 3, "3": 4}
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if len(line) < 4 or line[0] != "S":
+            raise ImageError("Missing record mark", lineno)
+        rtype = line[1]
+        raw = _hex_bytes(line[2:], lineno)
+        if len(raw) != raw[0] + 1:
+            raise ImageError("Bad record length", lineno)
+        if (sum(raw[:-1]) & 0xFF) ^ 0xFF != raw[-1]:
+            raise ImageError("Bad checksum", lineno)
+
+        if rtype in addr_len:
+            n = addr_len[rtype]
+            yield int.from_bytes(raw[1 : 1 + n], "big"), raw[1 + n : -1]
+        elif rtype in "789":
+            return
+        elif rtype not in "0456":
+            raise ImageError(f"Unknown record type S{rtype}", lineno)
+
+
+def iter_elf_records(f):
+    """! @function iter_elf_records
+    @brief yield (address, data) for the loadable program headers of
+    an ELF file, read in small chunks. Addresses are the physical (load)
+    addresses so initialised data lands in flash
+    @param f binary file object
+    """
+    ident = f.read(16)
+    if ident[:4] != ELF_MAGIC:
+        raise ImageError("Not an ELF file")
+    if ident[4] not in (1, 2) or ident[5] not in (1, 2):
+        raise ImageError("Unsupported ELF class or encoding")
+    is64 = ident[4] == 2
+    endian = "<" if ident[5] == 1 else ">"
+
+    if is64:
+        header = struct.unpack(endian + "HHIQQQIHHHHHH", f.read(48))
+    else:
+        header = struct.unpack(endian + "HHIIIIIHHHHHH", f.read(36))
+    phoff, phentsize, phnum = header[4], header[8], header[9]
+    ph_fmt = endian + ("IIQQQQQQ" if is64 else "IIIIIIII")
+
+    headers = []
+    for i in range(phnum):
+        f.seek(phoff + i * phentsize)
+        ph = struct.unpack(ph_fmt, f.read(struct.calcsize(ph_fmt)))
+        if is64:
+            p_type, p_offset, p_paddr, p_filesz = ph[0], ph[2], ph[4], ph[5]
+        else:
+            p_type, p_offset, p_paddr, p_filesz = ph[0], ph[1], ph[3], ph[4]
+        if p_type == ELF_PT_LOAD and p_filesz > 0:
+            headers.append((p_paddr, p_offset, p_filesz))
+
+    for paddr, offset, size in sorted(headers):
+        f.seek(offset)
+        done = 0
+        while done < size:
+            data = f.read(min(ELF_READ_CHUNK, size - done))
+            if len(data) == 0:
+                raise ImageError("Truncated ELF segment")
+            yield paddr + done, data
+            done += len(data)
+
+
+def read_records(filepath: str, fmt: str):
+    """! @function read_records
+    @brief yield (address, data) for each data record of an image file
+    @param fmt one of FORMAT_IHEX, FORMAT_SREC or FORMAT_ELF
+    """
+    if fmt == FORMAT_ELF:
+        with open(filepath, "rb") as f:
+            yield from iter_elf_records(f)
+    else:
+        parse = iter_ihex_records if fmt == FORMAT_IHEX else iter_srec_records
+        with open(filepath, "r") as f:
+            yield from parse(f)
+
+
+def coalesce(records):
+    """! @function coalesce
+    @brief merge a stream of (address, data) records into maximal
+    contiguous runs, yielding the (address, length) of each run as soon
+    as the stream moves away from it
+    """
+    address = None
+    length = 0
+    for rec_address, data in records:
+        if address is not None and rec_address == address + length:
+            length += len(data)
+            continue
+        if length:
+            yield address, length
+        address, length = rec_address, len(data)
+    if length:
+        yield address, length
+
+
+def merge_extents(extents) -> list:
+    """! @function merge_extents
+    @brief sort (address, length) extents and merge any which touch or
+    overlap
+    @return sorted list of (address, length)
+    """
+    out = []
+    for address, length in sorted(extents):
+        if out and address <= out[-1][0] + out[-1][1]:
+            last_address, last_length = out[-1]
+            end = max(last_address + last_length, address + length)
+            out[-1] = (last_address, end - last_address)
+        else:
+            out.append((address, length))
+    return out
+
+
+def image_extents(filepath: str, fmt: str = None) -> list:
+    """! @function image_extents
+    @brief the contiguous segments of an image file, without their data
+    @return sorted list of (address, length), or None for raw binaries
+    """
+    fmt = detect_format(filepath) if fmt is None else fmt
+    if fmt == FORMAT_BIN:
+        return None
+    return merge_extents(coalesce(read_records(filepath, fmt)))
+
+
+def image_length(filepath: str, fmt: str = None) -> int:
+    """! @function image_length
+    @brief bytes an image programs: the file size of a raw binary,
+    otherwise the bytes its records cover
+    """
+    extents = image_extents(filepath, fmt)
+    if extents is None:
+        return os.path.getsize(filepath)
+    return sum(length for _, length in extents)
+
+
+def load_segments(filepath: str, fmt: str = None) -> list:
+    """! @function load_segments
+    @brief stream an image file into a sorted list of contiguous segments
+    Every segment's data is a view into one buffer holding the whole
+    image, where records overlap the later one wins
+    @param filepath path of the image
+    @param fmt one of the FORMAT_ constants, detected if None
+    @return list of Segment, or None for raw binaries
+    """
+    fmt = detect_format(filepath) if fmt is None else fmt
+    extents = image_extents(filepath, fmt)
+    if extents is None:
+        return None
+    starts = [address for address, _ in extents]
+    offsets = list(accumulate([0] + [length for _, length in extents]))
+    image = memoryview(bytearray(offsets[-1]))
+    for address, data in read_records(filepath, fmt):
+        i = bisect.bisect_right(starts, address) - 1
+        offset = offsets[i] + address - starts[i]
+        if i < 0 or offset + len(data) > offsets[i + 1]:
+            raise ImageError(f"{filepath} changed while it was loaded")
+        image[offset : offset + len(data)] = data
+    return [
+        Segment(address, image[offset : offset + length])
+        for (address, length), offset in zip(extents, offsets)
+    ]
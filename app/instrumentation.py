@@ -0,0 +1,325 @@
+#
+#   Per-command link instrumentation
+#
+#   Every bootloader command issued through the STMInterface is timed
+#   and its bytes on the wire counted. Latency histograms & effective
+#   bytes per second per command type show where a slow flash goes:
+#   wire time is bound by the baud, the rest of a command's time is
+#   ack & adapter latency, and the time between commands is the host.
+#
+
+import json
+import os
+import threading
+from time import monotonic, strftime
+
+from .async_transport import BITS_PER_BYTE
+
+# histogram bucket upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.002,
+    0.005,
+    0.01,
+    0.02,
+    0.05,
+    0.1,
+    0.2,
+    0.5,
+    1.0,
+    2.0,
+    5.0,
+)
+METRICS_DIR = os.path.join(os.path.expanduser("~"), ".stmflasher", "metrics")
+METRICS_PREFIX = "stm_command"
+
+# bytes on the wire per command (ST AN3155), beyond any payload:
+# command + complement, address + checksum, count + complement etc.
+READ_TX = 2 + 5 + 2
+READ_RX = 3
+WRITE_TX = 2 + 5 + 1 + 1
+WRITE_RX = 3
+
+
+class Histogram:
+    """!@class Histogram
+    @brief fixed bucket latency histogram
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """! @return upper bound of the bucket holding the q quantile"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def cumulative(self):
+        """! @return list of (le, cumulative count) ending with +Inf"""
+        out = []
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            out.append((bound, seen))
+        return out
+
+
+class CommandStats:
+    """!@class CommandStats
+    @brief totals for one command type
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_tx = 0
+        self.bytes_rx = 0
+        self.wire_time = 0.0
+        self.latency = Histogram()
+
+    @property
+    def busy_time(self) -> float:
+        return self.latency.sum
+
+    @property
+    def ack_wait(self) -> float:
+        """! @return time spent waiting beyond the wire time"""
+        return max(self.busy_time - self.wire_time, 0.0)
+
+    @property
+    def throughput(self) -> float:
+        """! @return effective bytes per second while the command ran"""
+        busy = self.busy_time
+        return (self.bytes_tx + self.bytes_rx) / busy if busy > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "bytes_tx": self.bytes_tx,
+            "bytes_rx": self.bytes_rx,
+            "busy_s": self.busy_time,
+            "wire_s": self.wire_time,
+            "ack_wait_s": self.ack_wait,
+            "bytes_per_s": self.throughput,
+            "latency_p50_s": self.latency.quantile(0.5),
+            "latency_p95_s": self.latency.quantile(0.95),
+            "latency_max_s": self.latency.max,
+            "latency_buckets": {
+                ("+Inf" if le == float("inf") else str(le)): n
+                for le, n in self.latency.cumulative()
+            },
+        }
+
+
+class LinkMetrics:
+    """!@class LinkMetrics
+    @brief thread-safe per-command metrics for one session
+    """
+
+    def __init__(self, baud: int = None):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.baud = baud
+        self.started = monotonic()
+        self.started_at = strftime("%Y%m%d-%H%M%S")
+
+    def stats(self, name: str) -> CommandStats:
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = CommandStats(name)
+        return stats
+
+    def record(self, name: str, latency: float, tx: int, rx: int, ok: bool):
+        with self.lock:
+            stats = self.stats(name)
+            stats.calls += 1
+            stats.errors += 0 if ok else 1
+            stats.bytes_tx += tx
+            stats.bytes_rx += rx
+            if self.baud:
+                stats.wire_time += (tx + rx) * BITS_PER_BYTE / self.baud
+            stats.latency.observe(latency)
+
+    def retry(self, name: str):
+        with self.lock:
+            self.stats(name).retries += 1
+
+    def snapshot(self) -> list:
+        """! @return copy of the stats, safe to render from another thread"""
+        with self.lock:
+            return [(name, s.to_dict()) for name, s in sorted(self.commands.items())]
+
+    @property
+    def host_time(self) -> float:
+        """! @return session time not spent in a command"""
+        with self.lock:
+            busy = sum(s.busy_time for s in self.commands.values())
+        return max(monotonic() - self.started - busy, 0.0)
+
+    def to_dict(self) -> dict:
+        return {
+            "started": self.started_at,
+            "elapsed_s": monotonic() - self.started,
+            "host_s": self.host_time,
+            "baud": self.baud,
+            "commands": dict(self.snapshot()),
+        }
+
+    def to_openmetrics(self) -> str:
+        """! @return the metrics in OpenMetrics text format"""
+        p = METRICS_PREFIX
+        snapshot = self.snapshot()
+        lines = [
+            f"# TYPE {p}_latency_seconds histogram",
+            f"# UNIT {p}_latency_seconds seconds",
+        ]
+        for name, s in snapshot:
+            for le, n in s["latency_buckets"].items():
+                lines.append(
+                    f'{p}_latency_seconds_bucket{{command="{name}",le="{le}"}} {n}'
+                )
+            lines.append(f'{p}_latency_seconds_count{{command="{name}"}} {s["calls"]}')
+            lines.append(f'{p}_latency_seconds_sum{{command="{name}"}} {s["busy_s"]}')
+
+        for metric, key, unit in (
+            ("sent_bytes", "bytes_tx", "bytes"),
+            ("received_bytes", "bytes_rx", "bytes"),
+            ("retries", "retries", None),
+            ("errors", "errors", None),
+        ):
+            lines.append(f"# TYPE {p}_{metric} counter")
+            if unit:
+                lines.append(f"# UNIT {p}_{metric} {unit}")
+            for name, s in snapshot:
+                lines.append(f'{p}_{metric}_total{{command="{name}"}} {s[key]}')
+
+        lines.append(f"# TYPE {p}_throughput_bytes_per_second gauge")
+        for name, s in snapshot:
+            lines.append(
+                f'{p}_throughput_bytes_per_second{{command="{name}"}} {s["bytes_per_s"]}'
+            )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def save(self, path: str):
+        """! @brief write the metrics, OpenMetrics text for a .prom or
+        .txt path and json otherwise
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            if path.endswith((".prom", ".txt")):
+                f.write(self.to_openmetrics())
+            else:
+                json.dump(self.to_dict(), f, indent=1)
+
+    def save_session(self, directory: str = METRICS_DIR) -> list:
+        """! @brief write the session as both json & OpenMetrics
+        @return the paths written
+        """
+        base = os.path.join(directory, f"session-{self.started_at}")
+        paths = [base + ".json", base + ".prom"]
+        for path in paths:
+            self.save(path)
+        return paths
+
+
+class InstrumentedSTMInterface:
+    """!@class InstrumentedSTMInterface
+    @brief STMInterface wrapper recording every bootloader command
+
+    Bytes are counted from the AN3155 framing of each command. Erases
+    are counted as the standard erase command, composite calls such as
+    connect only record their time.
+    """
+
+    def __init__(self, stm_device, metrics: LinkMetrics):
+        self.stm_device = stm_device
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the wrapper
+        return getattr(self.stm_device, name)
+
+    def _call(self, name: str, tx: int, rx: int, func, *args):
+        start = monotonic()
+        ok = False
+        try:
+            result = func(*args)
+            ok = bool(result[0] if isinstance(result, tuple) else result)
+            return result
+        finally:
+            self.metrics.record(name, monotonic() - start, tx, rx if ok else 0, ok)
+
+    def connectAndReadInfo(self, port: str, baud: int, **kwargs):
+        self.metrics.baud = baud
+        return self._call(
+            "connect",
+            0,
+            0,
+            lambda: self.stm_device.connectAndReadInfo(port, baud=baud, **kwargs),
+        )
+
+    def getDeviceId(self):
+        return self._call("get_id", 2, 5, self.stm_device.getDeviceId)
+
+    def getDeviceBootloaderVersion(self):
+        return self._call(
+            "get_version", 2, 5, self.stm_device.getDeviceBootloaderVersion
+        )
+
+    def readFromFlash(self, address: int, length: int):
+        return self._call(
+            "read",
+            READ_TX,
+            READ_RX + length,
+            self.stm_device.readFromFlash,
+            address,
+            length,
+        )
+
+    def writeToFlash(self, address: int, data):
+        return self._call(
+            "write",
+            WRITE_TX + len(data),
+            WRITE_RX,
+            self.stm_device.writeToFlash,
+            address,
+            data,
+        )
+
+    def eraseFlashPages(self, pages):
+        pages = list(pages)
+        return self._call(
+            "erase", 2 + len(pages) + 2, 2, self.stm_device.eraseFlashPages, pages
+        )
+
+    def globalEraseFlash(self):
+        return self._call("global_erase", 4, 2, self.stm_device.globalEraseFlash)
@@ -0,0 +1,174 @@
+#
+#   Batched, bounded operation log
+#
+#   Messages are queued rather than written straight to the log widget.
+#   The widget drains the queue a few times a second, so a burst of
+#   messages costs one redraw. The queue is a fixed size ring. Progress
+#   updates are held back and only the newest of an operation is shown,
+#   at most once a second, so a long transfer adds a handful of lines
+#   rather than one per report. Every message also goes to a log file
+#   written from a background thread through a bounded queue.
+#
+
+import os
+import queue
+import threading
+from collections import deque
+from time import monotonic, strftime
+
+LOG_FLUSH_INTERVAL = 0.25  # seconds between widget flushes
+LOG_PENDING_LINES = 64  # lines held between flushes, oldest dropped first
+LOG_HISTORY_LINES = 200  # lines kept in the widget's scrollback
+LOG_PROGRESS_INTERVAL = 1.0  # min seconds between shown updates of an operation
+LOG_FILE_QUEUE_LINES = 4096  # lines waiting for the file, later ones dropped
+LOG_DIR = os.path.join(os.path.expanduser("~"), ".stmflasher", "logs")
+
+
+def plain_text(msg) -> str:
+    """! @return the text of a message, rich Text or anything else"""
+    return getattr(msg, "plain", None) or str(msg)
+
+
+class LogFileWriter:
+    """!@class LogFileWriter
+    @brief appends timestamped lines to a file from a background thread
+
+    Lines wait in a bounded queue. If the file falls behind, new lines
+    are counted & dropped until there is room, and if the writer fails
+    (e.g. the disk is full) lines are dropped from then on.
+    """
+
+    def __init__(self, path: str, capacity: int = LOG_FILE_QUEUE_LINES):
+        self.path = path
+        self.lines = queue.Queue(capacity)
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, text: str):
+        if self.error is not None:
+            return
+        with self.lock:
+            try:
+                if self.dropped:
+                    self.lines.put_nowait(f"... {self.dropped} lines dropped\n")
+                    self.dropped = 0
+                self.lines.put_nowait(f"{strftime('%H:%M:%S')} {text}\n")
+            except queue.Full:
+                self.dropped += 1
+
+    def run(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                while True:
+                    line = self.lines.get()
+                    if line is None:
+                        return
+                    f.write(line)
+                    # write out whatever else is waiting before flushing
+                    try:
+                        while True:
+                            line = self.lines.get_nowait()
+                            if line is None:
+                                return
+                            f.write(line)
+                    except queue.Empty:
+                        f.flush()
+        except OSError as e:
+            self.error = e
+
+    def close(self):
+        # the writer may stop while the queue is full, so don't block on it
+        while self.thread.is_alive():
+            try:
+                self.lines.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+
+
+class OperationLog:
+    """!@class OperationLog
+    @brief thread-safe message queue between operations & the log widget
+    """
+
+    def __init__(
+        self,
+        capacity: int = LOG_PENDING_LINES,
+        progress_interval: float = LOG_PROGRESS_INTERVAL,
+    ):
+        self.lock = threading.Lock()
+        self.pending = deque(maxlen=capacity)
+        self.progress_interval = progress_interval
+        # newest progress update not shown yet, as (operation, msg)
+        self.held = None
+        # operation to when its last update was shown
+        self.shown = {}
+        self.dropped = 0
+        self.file = None
+
+    def open(self, log_path: str):
+        """! @brief start copying messages to a log file"""
+        self.close()
+        self.file = LogFileWriter(log_path)
+
+    def write(self, msg, progress: str = None):
+        """! @brief queue a message, callable from any thread
+        @param progress optional name of the operation the message is a
+        progress update of. Updates are held back and replace each
+        other; the newest is shown when the operation's interval is up
+        or when any other message follows it. Every update still goes
+        to the log file
+        """
+        if self.file is not None:
+            self.file.write(plain_text(msg))
+        with self.lock:
+            if progress is None:
+                self._release()
+                self._append(msg)
+                return
+            if self.held is not None and self.held[0] != progress:
+                self._release()
+            self.held = (progress, msg)
+
+    def _append(self, msg):
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+        self.pending.append(msg)
+
+    def _release(self):
+        """! @brief queue the held progress update, lock held"""
+        if self.held is not None:
+            operation, msg = self.held
+            self.held = None
+            self.shown[operation] = monotonic()
+            self._append(msg)
+
+    def take(self) -> list:
+        """! @brief pop everything queued since the last call, along
+        with the held progress update if its operation's interval is up
+        """
+        with self.lock:
+            if self.held is not None:
+                shown = self.shown.get(self.held[0])
+                if shown is None or monotonic() - shown >= self.progress_interval:
+                    self._release()
+            out = list(self.pending)
+            self.pending.clear()
+            if self.dropped:
+                out.insert(0, f"... {self.dropped} lines dropped, see the log file")
+                self.dropped = 0
+        return out
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def session_log_path(directory: str = LOG_DIR) -> str:
+    return os.path.join(directory, f"stmflasher-{strftime('%Y%m%d-%H%M%S')}.log")
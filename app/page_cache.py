@@ -0,0 +1,174 @@
+#
+#   Session scoped cache of flash page contents
+#
+#   Sits on top of an STMInterface and serves repeat reads from
+#   memory. Anything which can change the flash goes through the
+#   cache so the affected pages are dropped (or marked blank after
+#   an erase) and only those are fetched from the device again.
+#
+
+import hashlib
+import os
+import threading
+
+from .flash_ops import (
+    BOOTLOADER_MAX_FRAME,
+    page_bounds,
+    page_of,
+    pages_for_range,
+    split_frames,
+)
+
+
+class CachedSTMInterface:
+    """!@class CachedSTMInterface
+    @brief STMInterface wrapper with a per-connection page cache
+
+    Pages are keyed by their index, see flash_ops.page_of. Each cached
+    page keeps its contents and a digest in a hash index so compares
+    against a local image don't need the page data itself.
+    Attributes not handled here are passed through to the interface.
+    """
+
+    def __init__(self, stm_device):
+        self.stm_device = stm_device
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.hashes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.stm_device, name)
+
+    ## Cache management
+
+    def reset(self):
+        """! @brief drop everything, call on connect or disconnect"""
+        with self.lock:
+            self.pages.clear()
+            self.hashes.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def page_of(self, address: int) -> int:
+        return page_of(self.device, address)
+
+    def pages_in(self, address: int, length: int) -> range:
+        """! @brief range of page indexes touched by an address range"""
+        return pages_for_range(self.device, address, length)
+
+    def invalidate(self, pages=None):
+        """! @brief drop pages from the cache
+        @param pages iterable of page indexes, or None for all pages
+        """
+        with self.lock:
+            if pages is None:
+                self.pages.clear()
+                self.hashes.clear()
+                return
+            for page in pages:
+                self.pages.pop(page, None)
+                self.hashes.pop(page, None)
+
+    def invalidate_range(self, address: int, length: int):
+        self.invalidate(self.pages_in(address, length))
+
+    def mark_blank(self, pages):
+        """! @brief record pages as erased without reading them back"""
+        blank = bytes([0xFF]) * self.device.flash_page_size
+        for page in pages:
+            self.store(page, blank)
+
+    def store(self, page: int, data: bytes):
+        data = bytes(data)
+        with self.lock:
+            self.pages[page] = data
+            self.hashes[page] = hashlib.sha1(data).digest()
+
+    def store_hash(self, page: int, digest: bytes):
+        """! @brief record a page digest without keeping its contents"""
+        with self.lock:
+            self.pages.pop(page, None)
+            self.hashes[page] = digest
+
+    def is_blank(self, page: int) -> bool:
+        """! @brief True only if the page is cached & known erased"""
+        data = self.pages.get(page)
+        return data is not None and data.count(0xFF) == len(data)
+
+    ## Reads
+
+    def fetch_page(self, page: int) -> bytes:
+        """! @brief return a page, reading it from the device on a miss"""
+        data = self.pages.get(page)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        device = self.device
+        out = bytearray()
+        start, end = page_bounds(device, page)
+        for address, size in split_frames(start, end - start, BOOTLOADER_MAX_FRAME):
+            success, rx = self.stm_device.readFromFlash(address, size)
+            if not success or rx is None or len(rx) != size:
+                return None
+            out.extend(rx)
+        self.store(page, out)
+        return self.pages[page]
+
+    def page_hash(self, page: int) -> bytes:
+        """! @brief digest of a page, reading it on a miss"""
+        if page not in self.hashes and self.fetch_page(page) is None:
+            return None
+        return self.hashes.get(page)
+
+    def readFromFlash(self, address: int, length: int):
+        """! @brief cache backed drop-in for STMInterface.readFromFlash
+        @return (success, data) as the interface does
+        """
+        if not self.device.flash_memory.is_valid(address) or length <= 0:
+            return self.stm_device.readFromFlash(address, length)
+
+        out = bytearray()
+        for page in self.pages_in(address, length):
+            data = self.fetch_page(page)
+            if data is None:
+                return False, None
+            page_start, page_end = page_bounds(self.device, page)
+            lo = max(address, page_start) - page_start
+            hi = min(address + length, page_end) - page_start
+            out.extend(data[lo:hi])
+        return len(out) == length, bytes(out)
+
+    ## Operations which modify the flash
+
+    def globalEraseFlash(self):
+        success = self.stm_device.globalEraseFlash()
+        if success:
+            self.mark_blank(range(self.device.flash_page_num))
+        else:
+            self.invalidate()
+        return success
+
+    def eraseFlashPages(self, pages):
+        pages = list(pages)
+        success = self.stm_device.eraseFlashPages(pages)
+        if success:
+            self.mark_blank(pages)
+        else:
+            self.invalidate(pages)
+        return success
+
+    def writeToFlash(self, address: int, data: bytes):
+        self.invalidate_range(address, len(data))
+        return self.stm_device.writeToFlash(address, data)
+
+    def writeApplicationFileToFlash(self, filepath: str, offset: int = 0):
+        start = self.device.flash_memory.start + offset
+        try:
+            self.invalidate_range(start, os.path.getsize(filepath))
+        except OSError:
+            self.invalidate()
+        return self.stm_device.writeApplicationFileToFlash(filepath, offset)
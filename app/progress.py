@@ -0,0 +1,106 @@
+#
+#   Progress channel between executor side operations and the UI
+#
+#   Operations running in an executor thread report progress through
+#   a plain (done, total) callback. The channel hands each report to
+#   the event loop thread-safely, keeps only the newest one and wakes
+#   the UI, which renders at most once per interval and straight away
+#   when the operation finishes. Operations which report nothing for a
+#   while (connect, erase) still get a slow redraw so animations move.
+#
+
+import asyncio
+from collections import namedtuple
+from time import monotonic
+
+RENDER_INTERVAL = 0.1  # min seconds between progress renders
+IDLE_INTERVAL = 0.25  # seconds between renders while nothing is reported
+
+ProgressEvent = namedtuple("ProgressEvent", ["done", "total", "unit"])
+
+
+class ProgressChannel:
+    """!@class ProgressChannel
+    @brief thread-safe, coalescing progress reports for one operation
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.latest = None
+        self.pages = {}
+        self.updated = asyncio.Event()
+        self.finished = False
+
+    def report(self, done: int, total: int, unit: str = "bytes"):
+        """! @brief push a progress report, callable from any thread"""
+        self.loop.call_soon_threadsafe(self._push, ProgressEvent(done, total, unit))
+
+    def units(self, unit: str):
+        """! @brief an on_progress callback which reports in the given unit"""
+        return lambda done, total: self.report(done, total, unit)
+
+    def report_page(self, page: int, state: int):
+        """! @brief push a page state change, callable from any thread"""
+        self.loop.call_soon_threadsafe(self._push_page, page, state)
+
+    def take_pages(self) -> dict:
+        """! @brief pop the page states reported since the last call"""
+        pages, self.pages = self.pages, {}
+        return pages
+
+    def _push(self, event: ProgressEvent):
+        self.latest = event
+        self.updated.set()
+
+    def _push_page(self, page: int, state: int):
+        self.pages[page] = state
+        self.updated.set()
+
+    def close(self):
+        """! @brief mark the operation finished, callable from any thread"""
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self.finished = True
+        self.updated.set()
+
+    async def events(self, interval: float = RENDER_INTERVAL, idle: float = None):
+        """! @brief async iterator of the newest progress event, no more
+        than once per interval. Ends as soon as the channel is closed
+        @param idle if set, the newest event (None before any) is
+        repeated after this many seconds without a report
+        """
+        last = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self.updated.wait(), idle)
+            except asyncio.TimeoutError:
+                last = monotonic()
+                yield self.latest
+                continue
+            self.updated.clear()
+            if self.finished:
+                return
+
+            wait = last + interval - monotonic()
+            if wait > 0:
+                try:
+                    # coalesce anything arriving in the meantime
+                    await asyncio.wait_for(self._wait_finished(), wait)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+            self.updated.clear()
+            last = monotonic()
+            yield self.latest
+
+    async def _wait_finished(self):
+        while not self.finished:
+            self.updated.clear()
+            await self.updated.wait()
+
+
+def format_progress(event: ProgressEvent) -> str:
+    if event is None or event.total == 0:
+        return ""
+    return f"{event.done}/{event.total} {event.unit} ({int(100 * event.done / event.total)}%)"
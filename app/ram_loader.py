@@ -0,0 +1,599 @@
+#
+#   RAM resident flash loader
+#
+#   The bootloader takes at most 256 bytes per write memory command,
+#   each with its own command, address & data round-trip. For big
+#   images a small loader is written into SRAM with write memory and
+#   started with go. It takes the image in large blocks at a higher
+#   baud, streamed back to back with a CRC-32 on every block, and
+#   programs the flash itself. The mode is opt in: it needs a loader
+#   binary to be given explicitly. If that can't be used, or the device
+#   can't take it, the upload goes through the bootloader as before.
+#
+#   Loader protocol, once started. Integers are little endian, every
+#   host frame ends with a CRC-32 (zlib) of the rest of the frame and
+#   every reply is two bytes, ACK or NACK then the frame's tag:
+#
+#       loader -> host  HELLO version:u8 max_block:u16
+#       host -> loader  'S'                             tag 'S'
+#       host -> loader  'B' baud:u32                    tag 'B', then switches
+#       host -> loader  'E' count:u16 page:u16*count    tag 'E' once erased
+#       host -> loader  'W' seq:u8 address:u32 length:u16 data     tag seq
+#       host -> loader  'R'                             tag 'R', then resets
+#
+#   Up to LOADER_WINDOW blocks are in flight, so the loader programs
+#   one buffer while the next arrives. After a bad frame the loader
+#   NACKs and drops input until the line has been idle for LOADER_IDLE,
+#   then the host resyncs with 'S' and resends from the first block
+#   not acknowledged. A block already in flash is acknowledged without
+#   programming it again, so resends are safe. If nothing arrives for
+#   BAUD_REVERT_TIME after a baud switch the loader goes back to the
+#   old baud.
+#
+#   No loader binary ships with this repo, they are built per target
+#   outside it. Like any image started with go, one starts with its
+#   stack pointer & reset vector, then LOADER_SIGNATURE. The simulator
+#   runs a stand-in, see bootloader_sim.loader_image.
+#
+#   run_from_ram uses the same write memory & go path for test builds
+#   linked to run from RAM: the image is written above the bootloader's
+#   reserved RAM and started, without erasing or wearing the flash.
+#
+
+import asyncio
+import bisect
+import hashlib
+import os
+import struct
+import zlib
+from collections import deque
+
+from .async_transport import (
+    BL_ACK,
+    BL_MAX_FRAME,
+    BL_NACK,
+    CMD_GO,
+    CMD_WRITE_MEMORY,
+    ERASE_TIMEOUT,
+    AsyncBootloader,
+    BootloaderError,
+)
+from .flash_ops import (
+    PAGE_OCCUPIED,
+    ProgressThrottle,
+    TransferError,
+    close_interface,
+    page_bounds,
+)
+from .image_loader import FORMAT_BIN, detect_format, load_segments
+from .flash_upload import UploadResult, merged_page, page_chunks, upload_segments
+
+LOADER_SIGNATURE = b"STMFLDR1"
+LOADER_SIGNATURE_OFFSET = 8  # after the initial stack pointer & reset vector
+LOADER_VERSION = 1
+BOOTLOADER_RAM_RESERVED = 0x200  # RAM the bootloader uses itself (AN2606)
+
+LOADER_BAUD = 921600  # common to CP210x, CH340 & FTDI adapters
+LOADER_BLOCK = 4096  # largest block sent, the loader may ask for less
+LOADER_WINDOW = 2  # blocks in flight, the loader double buffers
+LOADER_IDLE = 0.02  # idle line after which the loader drops a part frame
+HELLO_TIMEOUT = 0.5
+BAUD_REVERT_TIME = 1.0
+PROGRAM_TIME_PER_BYTE = 35e-6  # RM0008 tPROG max per half word
+
+LDR_HELLO = 0x5A
+LDR_SYNC = ord("S")
+LDR_BAUD = ord("B")
+LDR_ERASE = ord("E")
+LDR_WRITE = ord("W")
+LDR_RESET = ord("R")
+
+
+class LoaderUnavailable(Exception):
+    """!@class LoaderUnavailable
+    @brief the RAM loader can't be used. Raised before the loader is
+    started, so the device is still in the bootloader & the upload can
+    go the standard way
+    """
+
+
+def loader_frame(command: int, payload: bytes = b"") -> bytes:
+    body = bytes([command]) + bytes(payload)
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def read_loader(path: str) -> bytes:
+    """! @function read_loader
+    @brief read & check a loader binary
+    @raise LoaderUnavailable if there is no loader at path
+    """
+    try:
+        with open(path, "rb") as f:
+            image = f.read()
+    except OSError:
+        raise LoaderUnavailable(f"No loader binary at {path}")
+    end = LOADER_SIGNATURE_OFFSET + len(LOADER_SIGNATURE)
+    if image[LOADER_SIGNATURE_OFFSET:end] != LOADER_SIGNATURE:
+        raise LoaderUnavailable(f"{path} is not a flash loader")
+    return image
+
+
+def free_ram(device):
+    """! @function free_ram
+    @return (start, size) of the RAM a program can be loaded into,
+    the bootloader keeps the first BOOTLOADER_RAM_RESERVED bytes
+    """
+    return (
+        device.ram.start + BOOTLOADER_RAM_RESERVED,
+        device.ram.size - BOOTLOADER_RAM_RESERVED,
+    )
+
+
+async def write_ram(
+    bootloader: AsyncBootloader,
+    address: int,
+    data,
+    verify: bool = True,
+    on_progress=None,
+):
+    """! @function write_ram
+    @brief write data to RAM in bootloader frames
+    @param verify read each frame back. RAM can be rewritten, so a
+    frame which reads back wrong is resent
+    @param on_progress optional callback taking (done, total) bytes
+    @raise BootloaderError if a frame fails or keeps reading back wrong
+    """
+    view = memoryview(data)
+    progress = ProgressThrottle(on_progress, len(view))
+    for offset in range(0, len(view), BL_MAX_FRAME):
+        frame = view[offset : offset + BL_MAX_FRAME]
+        for _ in range(bootloader.policy.max_retries + 1):
+            await bootloader.write_memory(address + offset, frame)
+            if not verify:
+                break
+            if await bootloader.read_memory(address + offset, len(frame)) == frame:
+                break
+        else:
+            raise BootloaderError(f"RAM readback differs @ {hex(address + offset)}")
+        progress.update(offset + len(frame))
+
+
+def loader_blocks(device, pages, block_size: int):
+    """! @function loader_blocks
+    @brief split pages to program into blocks, never across a gap
+    @param pages sorted list of (page, data)
+    @return list of (address, data, pages finished once it is written)
+    """
+    ends = [page_bounds(device, page)[1] for page, _ in pages]
+    blocks = []
+    run_start = None
+    run = bytearray()
+    for page, data in pages + [(None, None)]:
+        start = None if page is None else page_bounds(device, page)[0]
+        if run and start != run_start + len(run):
+            for offset in range(0, len(run), block_size):
+                block = bytes(run[offset : offset + block_size])
+                end = run_start + offset + len(block)
+                blocks.append(
+                    (run_start + offset, block, bisect.bisect_right(ends, end))
+                )
+            run = bytearray()
+        if page is None:
+            break
+        if not run:
+            run_start = start
+        run.extend(data)
+    return blocks
+
+
+class RamLoader:
+    """!@class RamLoader
+    @brief host end of the loader protocol, over the transport of an
+    AsyncBootloader which has the device in its bootloader
+    """
+
+    def __init__(self, bootloader: AsyncBootloader):
+        self.bootloader = bootloader
+        self.transport = bootloader.transport
+        self.version = None
+        self.max_block = 0
+
+    async def start(self, device, image: bytes):
+        """! @brief write the loader into RAM and jump to it
+        @raise LoaderUnavailable if the device can't take the loader
+        @raise TransferError if the loader was started but didn't answer
+        """
+        bootloader = self.bootloader
+        address, size = free_ram(device)
+        if len(image) > size:
+            raise LoaderUnavailable(f"Loader needs {len(image)} bytes, {size} free")
+        try:
+            if not await bootloader.sync():
+                raise LoaderUnavailable("No answer from the bootloader")
+            if not bootloader.commands:
+                await bootloader.get()
+            if not {CMD_WRITE_MEMORY, CMD_GO} <= set(bootloader.commands):
+                raise LoaderUnavailable("Bootloader has no write memory & go")
+            await write_ram(bootloader, address, image)
+        except BootloaderError as e:
+            raise LoaderUnavailable(f"Unable to load the loader: {e}")
+
+        try:
+            await bootloader.go(address)
+        except BootloaderError:
+            # only the ack may be lost, the hello says if the loader runs
+            pass
+        try:
+            hello = await self.transport.read(4, HELLO_TIMEOUT)
+        except BootloaderError:
+            # a bootloader still running answers a sync, the loader won't
+            if await bootloader.sync():
+                raise LoaderUnavailable("Bootloader didn't start the loader")
+            raise TransferError("RAM loader didn't start, reset the board", address)
+        if hello[0] != LDR_HELLO:
+            raise TransferError("Unexpected RAM loader hello, reset the board", address)
+        self.version = hello[1]
+        self.max_block = struct.unpack("<H", hello[2:4])[0]
+        if self.max_block == 0:
+            raise TransferError("RAM loader has no buffer, reset the board", address)
+
+    async def reply(self, tag: int, timeout: float):
+        rx = await self.transport.read(2, timeout)
+        if rx[1] != tag:
+            raise BootloaderError(f"Loader replied for {hex(rx[1])}", tag)
+        if rx[0] == BL_NACK:
+            raise BootloaderError("Loader NACK", tag)
+        if rx[0] != BL_ACK:
+            raise BootloaderError(f"Unexpected loader response {hex(rx[0])}", tag)
+
+    async def command(self, command: int, payload: bytes = b"", timeout=None):
+        frame = loader_frame(command, payload)
+        await self.transport.write(frame)
+        if timeout is None:
+            timeout = self.bootloader.data_timeout(len(frame) + 2)
+        await self.reply(command, timeout)
+
+    async def resync(self):
+        """! @brief get back in step after a bad frame or lost reply"""
+        bootloader = self.bootloader
+        for _ in range(bootloader.policy.max_retries + 1):
+            await self.transport.drain(max(bootloader.rtt.timeout, 2 * LOADER_IDLE))
+            try:
+                await self.command(LDR_SYNC)
+                return
+            except BootloaderError:
+                continue
+        raise TransferError("Lost the RAM loader, reset the board")
+
+    async def retried(self, command: int, payload: bytes = b"", timeout=None):
+        """! @brief send a command, resyncing & resending on failure"""
+        bootloader = self.bootloader
+        for attempt in range(bootloader.policy.max_retries + 1):
+            if attempt:
+                bootloader.stats.retries += 1
+                await self.resync()
+            try:
+                return await self.command(command, payload, timeout)
+            except BootloaderError as e:
+                error = e
+        raise TransferError(f"RAM loader command failed: {error}")
+
+    async def set_baud(self, baud: int) -> bool:
+        """! @brief move the link to a higher baud
+        @return False if the link stayed at the old baud
+        """
+        bootloader = self.bootloader
+        old = bootloader.baud
+        await self.retried(LDR_BAUD, struct.pack("<I", baud))
+        # the ack's stop bit has to be out before the loader switches
+        await asyncio.sleep(LOADER_IDLE)
+        try:
+            bootloader.set_baud(baud)
+            await self.resync()
+            return True
+        except (OSError, ValueError, TransferError):
+            bootloader.set_baud(old)
+            await asyncio.sleep(BAUD_REVERT_TIME)
+            await self.resync()
+            return False
+
+    async def erase(self, pages):
+        pages = list(pages)
+        payload = struct.pack(f"<H{len(pages)}H", len(pages), *pages)
+        await self.retried(LDR_ERASE, payload, ERASE_TIMEOUT)
+
+    def block_timeout(self, length: int) -> float:
+        # the reply can queue behind the rest of the window
+        frame = LOADER_WINDOW * (length + 12)
+        return self.bootloader.data_timeout(frame) + length * PROGRAM_TIME_PER_BYTE
+
+    async def program(self, blocks, on_block=None):
+        """! @brief stream blocks to the loader
+        @param blocks list of (address, data)
+        @param on_block optional callback taking the index of each
+        block as it is acknowledged
+        """
+        bootloader = self.bootloader
+        in_flight = deque()
+        sent = 0
+        done = 0
+        failed = None
+        attempts = 0
+        while done < len(blocks):
+            while sent < len(blocks) and len(in_flight) < LOADER_WINDOW:
+                address, data = blocks[sent]
+                header = struct.pack("<BIH", sent & 0xFF, address, len(data))
+                await self.transport.write(loader_frame(LDR_WRITE, header + data))
+                bootloader.stats.frames += 1
+                in_flight.append(sent)
+                sent += 1
+
+            index = in_flight[0]
+            address, data = blocks[index]
+            try:
+                await self.reply(index & 0xFF, self.block_timeout(len(data)))
+            except BootloaderError as e:
+                attempts = attempts + 1 if failed == index else 1
+                failed = index
+                if attempts > bootloader.policy.max_retries:
+                    bootloader.stats.failures += 1
+                    raise TransferError(
+                        f"Error writing flash through the loader: {e}", address
+                    )
+                bootloader.stats.retries += 1
+                await self.resync()
+                in_flight.clear()
+                sent = index
+                continue
+
+            in_flight.popleft()
+            done += 1
+            if on_block is not None:
+                on_block(index)
+
+    async def reset(self):
+        """! @brief reset the device, it comes back up in the bootloader"""
+        await self.retried(LDR_RESET)
+
+
+def loader_upload(
+    flash,
+    segments,
+    on_progress=None,
+    sparse: bool = False,
+    on_page=None,
+    *,
+    port: str,
+    baud: int,
+    loader_path: str,
+    loader_baud: int = LOADER_BAUD,
+    bootloader_factory=None,
+) -> UploadResult:
+    """! @function loader_upload
+    @brief erase & program the pages the segments touch through the
+    RAM loader, then reconnect to the bootloader
+
+    Takes the same arguments as upload_segments plus the port & baud
+    flash is connected on. The interface's port is closed for the
+    session and flash is connected again afterwards, also when the
+    loader turns out to be unavailable.
+    @param port, baud port & baud flash is connected on
+    @param loader_path loader binary built for the target
+    @param loader_baud baud to stream the image at, None to keep baud
+    @param bootloader_factory optional callable taking (port, baud,
+    loop) and returning an AsyncBootloader, defaults to open_serial
+    @raise LoaderUnavailable before anything on the device has changed
+    @return UploadResult, frames counting loader blocks
+    """
+    image = read_loader(loader_path)
+    device = flash.device
+    if getattr(device, "ram", None) is None:
+        raise LoaderUnavailable("Device RAM is unknown")
+    factory = bootloader_factory or AsyncBootloader.open_serial
+    result = UploadResult()
+    pages = [
+        (page, merged_page(flash, page, chunks))
+        for page, chunks in page_chunks(flash, segments)
+    ]
+    result.pages_total = len(pages)
+    progress = ProgressThrottle(on_progress, len(pages))
+
+    async def session():
+        try:
+            bootloader = factory(port, baud, asyncio.get_running_loop())
+        except (OSError, ValueError, ImportError) as e:
+            # ImportError: pyserial isn't installed
+            raise LoaderUnavailable(f"Unable to open {port}: {e}")
+        loader = RamLoader(bootloader)
+        try:
+            await loader.start(device, image)
+            if loader_baud and loader_baud != baud:
+                await loader.set_baud(loader_baud)
+            await loader.erase([page for page, _ in pages])
+
+            size = min(LOADER_BLOCK, loader.max_block)
+            blocks = loader_blocks(device, pages, size)
+            finished = [0]
+
+            def on_block(index: int):
+                _, data, pages_done = blocks[index]
+                result.frames_written += 1
+                result.bytes_written += len(data)
+                if on_page is not None:
+                    for page, _ in pages[finished[0] : pages_done]:
+                        on_page(page, PAGE_OCCUPIED)
+                finished[0] = max(finished[0], pages_done)
+                progress.update(finished[0])
+
+            # the pages are freshly erased, blank blocks needn't be sent
+            indexes = []
+            for i, (address, data, _) in enumerate(blocks):
+                if sparse and data.count(0xFF) == len(data):
+                    result.frames_skipped += 1
+                    result.bytes_skipped += len(data)
+                else:
+                    indexes.append(i)
+            await loader.program(
+                [blocks[i][:2] for i in indexes], lambda n: on_block(indexes[n])
+            )
+            await loader.reset()
+        finally:
+            # the line rate is shared by every handle on the port
+            bootloader.set_baud(baud)
+            bootloader.close()
+
+    # one handle on the port at a time, not every platform shares it
+    close_interface(flash)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(session())
+    except TransferError:
+        flash.invalidate([page for page, _ in pages])
+        raise
+    finally:
+        loop.close()
+        # hand the port back, to a bootloader the loader has reset or
+        # to the one which never started it
+        connected = flash.connectAndReadInfo(port, baud=baud, readOptBytes=False)
+    if not connected:
+        raise TransferError("Unable to reconnect after the RAM loader")
+    progress.update(len(pages))
+    for page, data in pages:
+        flash.store_hash(page, hashlib.sha1(data).digest())
+        result.pages_written.append(page)
+    return result
+
+
+def accelerated_upload(
+    flash,
+    segments,
+    on_progress=None,
+    sparse: bool = False,
+    on_page=None,
+    on_fallback=None,
+    **kwargs,
+) -> UploadResult:
+    """! @function accelerated_upload
+    @brief upload through the RAM loader, or through the bootloader
+    if the loader can't be used
+    @param on_fallback optional callback taking the LoaderUnavailable
+    @param kwargs port, baud, loader_path & the loader options of
+    loader_upload
+    """
+    try:
+        return loader_upload(flash, segments, on_progress, sparse, on_page, **kwargs)
+    except LoaderUnavailable as e:
+        if on_fallback is not None:
+            on_fallback(e)
+    return upload_segments(flash, segments, on_progress, sparse, on_page)
+
+
+def load_ram_image(filepath: str, device):
+    """! @function load_ram_image
+    @brief read an image to run from RAM. Raw binaries are placed at
+    the start of free RAM, other formats at their own addresses with
+    any gaps between segments zero filled
+    @raise TransferError if any of the image is outside the free RAM,
+    checked before the gaps are filled
+    @return (address, image bytes)
+    """
+    start, size = free_ram(device)
+    fmt = detect_format(filepath)
+    if fmt == FORMAT_BIN:
+        length = os.path.getsize(filepath)
+        if length > size:
+            raise TransferError(
+                f"Image of {length} bytes doesn't fit the {size} bytes of free RAM",
+                start,
+            )
+        with open(filepath, "rb") as f:
+            return start, f.read()
+    segments = load_segments(filepath, fmt)
+    if not segments:
+        raise TransferError(f"No data in {filepath}")
+    for seg in segments:
+        if seg.address < start or seg.address + len(seg.data) > start + size:
+            raise TransferError(
+                f"Image has {len(seg.data)} bytes outside the free RAM"
+                f" {hex(start)}-{hex(start + size)}",
+                seg.address,
+            )
+    address = segments[0].address
+    image = bytearray(segments[-1].address + len(segments[-1].data) - address)
+    for seg in segments:
+        image[seg.address - address : seg.address - address + len(seg.data)] = seg.data
+    return address, bytes(image)
+
+
+def check_ram_image(device, address: int, image: bytes):
+    """! @function check_ram_image
+    @brief check an image fits the free RAM & its vector table points
+    into RAM, as go takes the stack pointer & reset vector from it
+    @raise TransferError if it can't be run from RAM
+    """
+    start, size = free_ram(device)
+    if address < start or address + len(image) > start + size:
+        raise TransferError(
+            f"Image of {len(image)} bytes doesn't fit the {size} bytes of free RAM"
+            f" from {hex(start)}",
+            address,
+        )
+    if len(image) < 8:
+        raise TransferError("Image has no vector table", address)
+    stack, reset = struct.unpack_from("<II", image)
+    ram_end = device.ram.start + device.ram.size
+    if not device.ram.start < stack <= ram_end:
+        raise TransferError(f"Initial stack {hex(stack)} isn't in RAM", address)
+    if not address <= reset & ~1 < address + len(image):
+        raise TransferError(
+            f"Reset vector {hex(reset)} isn't in the image, link it for {hex(address)}",
+            address,
+        )
+
+
+def run_from_ram(
+    device,
+    address: int,
+    image: bytes,
+    on_progress=None,
+    *,
+    port: str,
+    baud: int,
+    bootloader_factory=None,
+):
+    """! @function run_from_ram
+    @brief write an image into RAM and start it with go. The flash is
+    left alone & the bootloader stops answering until the next reset
+    @param device device of the connected interface, for its RAM
+    @param address where the image runs, from load_ram_image
+    @param on_progress optional callback taking (done, total) bytes
+    @param port, baud port & baud the device is connected on. The port
+    is opened here, close any interface holding it first
+    @param bootloader_factory as for loader_upload
+    @raise TransferError if the image can't be run or the write fails
+    """
+    check_ram_image(device, address, image)
+    factory = bootloader_factory or AsyncBootloader.open_serial
+
+    async def session():
+        try:
+            bootloader = factory(port, baud, asyncio.get_running_loop())
+        except (OSError, ValueError, ImportError) as e:
+            raise TransferError(f"Unable to open {port}: {e}", address)
+        try:
+            # the port was reopened, make sure the bootloader still answers
+            if not await bootloader.sync():
+                raise TransferError("No answer from the bootloader", address)
+            # frames are checksummed & acked, a readback would double the time
+            await write_ram(bootloader, address, image, False, on_progress)
+            await bootloader.go(address)
+        except BootloaderError as e:
+            raise TransferError(f"Unable to run from RAM: {e}", address)
+        finally:
+            bootloader.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(session())
+    finally:
+        loop.close()
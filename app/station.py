@@ -0,0 +1,220 @@
+#
+#   Multi-port flashing station
+#
+#   Runs one STMInterface session per serial port, each on its own
+#   worker thread, so a tray of boards takes about as long as a single
+#   board. Sessions share the same operation code as the TUI.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from ..SerialFlasher.StmDevice import STMInterface
+
+from .flash_ops import close_interface, mapped_file
+from .flash_upload import upload_segments
+from .flash_verify import rewrite_pages, verify_segments
+from .image_loader import FORMAT_BIN, detect_format, load_segments
+from .page_cache import CachedSTMInterface
+from .transfer import RetryingSTMInterface
+
+STATUS_IDLE = "idle"
+STATUS_CONNECTING = "connecting"
+STATUS_WRITING = "writing"
+STATUS_VERIFYING = "verifying"
+STATUS_PASS = "pass"
+STATUS_FAIL = "fail"
+
+
+class StationImage:
+    """!@class StationImage
+    @brief an image loaded once and shared read-only by every session
+
+    Raw binaries are mapped and placed at offset from each device's
+    flash start, other formats carry their own addresses.
+    """
+
+    def __init__(self, filepath: str, offset: int = 0):
+        self.filepath = filepath
+        self.offset = offset
+        self.format = detect_format(filepath)
+        self.mapping = None
+        self.loaded = None
+
+    def __enter__(self):
+        if self.format == FORMAT_BIN:
+            self.mapping = mapped_file(self.filepath)
+            self.image = self.mapping.__enter__()
+        else:
+            self.loaded = load_segments(self.filepath, self.format)
+        return self
+
+    def __exit__(self, *exc):
+        if self.mapping is not None:
+            self.image = None
+            self.mapping.__exit__(*exc)
+            self.mapping = None
+
+    def segments(self, device) -> list:
+        if self.format == FORMAT_BIN:
+            return [(device.flash_memory.start + self.offset, self.image)]
+        return self.loaded
+
+    @property
+    def length(self) -> int:
+        if self.format == FORMAT_BIN:
+            return len(self.image)
+        return sum(len(s.data) for s in self.loaded)
+
+
+class PortSession:
+    """!@class PortSession
+    @brief one board on one port: connect, program, verify
+    """
+
+    def __init__(self, port: str, baud: int, interface_factory=STMInterface):
+        self.port = port
+        self.baud = baud
+        self.interface_factory = interface_factory
+        self.status = STATUS_IDLE
+        self.error = None
+        self.device_name = ""
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.verify = None
+        self.link = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or monotonic()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        """! @return programmed bytes per second so far"""
+        return self.bytes_done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def retries(self) -> int:
+        return 0 if self.link is None else self.link.stats.retries
+
+    @property
+    def done(self) -> bool:
+        return self.status in (STATUS_PASS, STATUS_FAIL)
+
+    @property
+    def passed(self) -> bool:
+        return self.status == STATUS_PASS
+
+    def run(self, image: StationImage, sparse: bool = True, on_update=None):
+        """! @brief program & verify the board, blocking
+        @param image StationImage shared with the other sessions
+        @param on_update optional callback taking this session, called
+        from the worker thread whenever the session state changes
+        """
+
+        def update(status: str = None):
+            if status is not None:
+                self.status = status
+            if on_update is not None:
+                on_update(self)
+
+        self.started = monotonic()
+        stm_device = None
+        try:
+            update(STATUS_CONNECTING)
+            stm_device = self.interface_factory()
+            if not stm_device.connectAndReadInfo(
+                self.port, baud=self.baud, readOptBytes=False
+            ):
+                raise ConnectionError(f"Unable to connect on {self.port}")
+            self.device_name = stm_device.device.name
+            self.link = RetryingSTMInterface(stm_device)
+            flash = CachedSTMInterface(self.link)
+            segments = image.segments(stm_device.device)
+            self.bytes_total = image.length
+
+            def written(done: int, total: int):
+                # progress is reported in pages, scale it to bytes
+                self.bytes_done = self.bytes_total * done // max(total, 1)
+                update()
+
+            update(STATUS_WRITING)
+            self.result = upload_segments(
+                flash, segments, on_progress=written, sparse=sparse
+            )
+            self.bytes_done = self.bytes_total
+
+            update(STATUS_VERIFYING)
+            self.verify = verify_segments(flash, segments)
+            if not self.verify.ok:
+                bad_pages = self.verify.bad_pages
+                rewrite_pages(flash, segments, bad_pages, sparse)
+                self.verify = verify_segments(flash, segments, pages=bad_pages)
+
+            if not self.verify.ok:
+                raise ValueError(f"Verify failed: {self.verify}")
+            self.finished = monotonic()
+            update(STATUS_PASS)
+        except Exception as e:
+            self.error = e
+            self.finished = monotonic()
+            update(STATUS_FAIL)
+        finally:
+            # free the port so the next run on it can open it
+            if stm_device is not None:
+                close_interface(stm_device)
+        return self
+
+
+class FlashStation:
+    """!@class FlashStation
+    @brief flash the same image onto boards on many ports at once
+    """
+
+    def __init__(self, ports, baud, interface_factory=STMInterface):
+        """! @param baud one baud for every port, or a dict of port to baud"""
+        bauds = baud if isinstance(baud, dict) else {p: baud for p in ports}
+        self.sessions = [PortSession(p, bauds[p], interface_factory) for p in ports]
+
+    def run(self, image: StationImage, sparse: bool = True, on_update=None) -> list:
+        """! @brief run every session in parallel, blocking until all finish
+        @return list of PortSession
+        """
+        with ThreadPoolExecutor(
+            max_workers=max(len(self.sessions), 1), thread_name_prefix="station"
+        ) as pool:
+            futures = [
+                pool.submit(session.run, image, sparse, on_update)
+                for session in self.sessions
+            ]
+            for future in futures:
+                future.result()
+        return self.sessions
+
+    @property
+    def passed(self) -> int:
+        return sum(1 for s in self.sessions if s.passed)
+
+    @property
+    def failed(self) -> int:
+        return sum(1 for s in self.sessions if s.status == STATUS_FAIL)
+
+
+def format_session(session: PortSession) -> str:
+    """! @function format_session
+    @brief one line status of a session
+    """
+    line = (
+        f"{session.port:<16} {session.status:<10} "
+        f"{session.bytes_done:>8}/{session.bytes_total:<8} "
+        f"{session.throughput / 1024:6.1f} KB/s {session.elapsed:6.1f}s "
+        f"{session.retries:>4} retries"
+    )
+    if session.error is not None:
+        line += f"  {session.error}"
+    return line
@@ -0,0 +1,157 @@
+#
+#   Shared fixtures for the app tests
+#
+#   SimulatedInterface stands in for a connected STMInterface on top
+#   of the bootloader simulator's target memory, so the flash code is
+#   checked against the F1's flash rules without a serial link. Link
+#   faults are injected per call. Code which talks the protocol itself
+#   gets the simulator on a pty, with the same target behind it.
+#
+
+import os
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+
+from ..async_transport import AsyncBootloader, AsyncSerialTransport
+from ..bootloader_sim import (
+    BOOTLOADER_VERSION,
+    FLASH_START,
+    RAM_START,
+    BootloaderSimulator,
+    SimulatedTarget,
+)
+from ..page_cache import CachedSTMInterface
+
+SIM_BAUD = 115200
+
+
+class MemoryRegion:
+    """!@class MemoryRegion
+    @brief start, size & is_valid as the device model's memories have
+    """
+
+    def __init__(self, start: int, size: int):
+        self.start = start
+        self.size = size
+
+    def is_valid(self, address: int) -> bool:
+        return self.start <= address < self.start + self.size
+
+
+class SimulatedInterface:
+    """!@class SimulatedInterface
+    @brief the STMInterface calls the app makes, served from a
+    SimulatedTarget
+
+    read_errors / write_errors raise that many OSErrors, as a serial
+    timeout does, before calls succeed again. Reads of bad_pages fail.
+    """
+
+    def __init__(self, target: SimulatedTarget = None, connect_ok: bool = True):
+        self.target = target or SimulatedTarget()
+        self.connect_ok = connect_ok
+        self.read_errors = 0
+        self.write_errors = 0
+        self.bad_pages = set()
+        self.reads = 0
+        self.writes = 0
+        self.erased = []
+        self.port = None
+        self.baud = None
+        self.closed = False
+        density = self.target.density
+        self.device = SimpleNamespace(
+            name="STM32F10xxxMedium-density",
+            flash_memory=MemoryRegion(FLASH_START, density.flash_size),
+            flash_page_size=density.page_size,
+            flash_page_num=self.target.page_num,
+            ram=MemoryRegion(RAM_START, density.ram_size),
+        )
+
+    def page_of(self, address: int) -> int:
+        return (address - FLASH_START) // self.device.flash_page_size
+
+    def connectAndReadInfo(self, port: str, baud: int = None, readOptBytes=False):
+        self.port = port
+        self.baud = baud
+        return self.connect_ok
+
+    def disconnect(self):
+        self.closed = True
+
+    def getDeviceId(self) -> int:
+        return self.target.density.pid
+
+    def getDeviceBootloaderVersion(self) -> int:
+        return BOOTLOADER_VERSION
+
+    def readFromFlash(self, address: int, length: int):
+        self.reads += 1
+        if self.read_errors:
+            self.read_errors -= 1
+            raise OSError("read timeout")
+        if self.page_of(address) in self.bad_pages:
+            return False, None
+        data = self.target.read(address, length)
+        return data is not None, data
+
+    def writeToFlash(self, address: int, data) -> bool:
+        self.writes += 1
+        if self.write_errors:
+            self.write_errors -= 1
+            raise OSError("write timeout")
+        return self.target.write(address, bytes(data))
+
+    def eraseFlashPages(self, pages) -> bool:
+        pages = list(pages)
+        self.erased.append(pages)
+        return self.target.erase_pages(pages)
+
+    def globalEraseFlash(self) -> bool:
+        self.erased.append(None)
+        self.target.mass_erase()
+        return True
+
+
+def open_pty(port: str, baud: int, loop) -> AsyncBootloader:
+    """! @function open_pty
+    @brief bootloader_factory for the simulator's pty. Ptys refuse even
+    parity, so the port is opened raw and keeps the rate it has
+    """
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+    owner = SimpleNamespace(close=partial(os.close, fd))
+    return AsyncBootloader(AsyncSerialTransport(fd, loop, owner=owner), baud)
+
+
+@pytest.fixture
+def sim():
+    with BootloaderSimulator("medium", SIM_BAUD) as sim:
+        yield sim
+
+
+@pytest.fixture
+def sim_device(sim):
+    """! @brief SimulatedInterface onto the pty simulator's target"""
+    return SimulatedInterface(sim.target)
+
+
+@pytest.fixture
+def pty_factory():
+    return open_pty
+
+
+@pytest.fixture
+def target():
+    return SimulatedTarget()
+
+
+@pytest.fixture
+def stm_device(target):
+    return SimulatedInterface(target)
+
+
+@pytest.fixture
+def flash(stm_device):
+    return CachedSTMInterface(stm_device)
@@ -0,0 +1,119 @@
+#
+#   Baud negotiation tests
+#
+
+from time import sleep
+
+from ..async_transport import BITS_PER_BYTE
+from ..auto_baud import (
+    STANDARD_BAUDS,
+    BaudProbe,
+    BaudRecord,
+    candidate_bauds,
+    negotiate_baud,
+    probe_baud,
+)
+from .conftest import SimulatedInterface
+
+PORT = "/dev/ttyUSB0"
+
+
+class NoisyLink(SimulatedInterface):
+    """! @brief a link whose reads take their wire time and fail above
+    max_baud
+    """
+
+    max_baud = 115200
+
+    def connectAndReadInfo(self, port: str, baud: int = None, readOptBytes=False):
+        if baud > self.max_baud:
+            self.read_errors = 1
+        return super().connectAndReadInfo(port, baud)
+
+    def readFromFlash(self, address: int, length: int):
+        sleep(length * BITS_PER_BYTE / self.baud)
+        return super().readFromFlash(address, length)
+
+
+def test_candidate_bauds():
+    assert candidate_bauds(9600, 921600) == list(STANDARD_BAUDS)
+    assert candidate_bauds(19200, 115200) == [19200, 38400, 57600, 115200]
+
+
+def test_record_round_trip(tmp_path):
+    path = str(tmp_path / "sub" / "baud_record.json")
+    record = BaudRecord(path)
+    assert record.get(PORT, adapter="0403:6001:A1") is None
+
+    probe = BaudProbe(460800)
+    probe.bytes, probe.elapsed = 4096, 0.5
+    record.update(PORT, probe, adapter="0403:6001:A1")
+    record.save()
+
+    record = BaudRecord(path)
+    assert record.get(PORT, adapter="0403:6001:A1") == 460800
+    # a different cable on the same port starts over
+    assert record.get(PORT, adapter="1a86:7523:") is None
+
+
+def test_unreadable_record_is_empty(tmp_path):
+    path = tmp_path / "baud_record.json"
+    path.write_text("{not json")
+    assert BaudRecord(str(path)).records == {}
+
+
+def test_probe_reliable():
+    probe = BaudProbe(115200)
+    assert not probe.reliable
+    assert str(probe) == "115200bps: no connection"
+
+    probe.connected, probe.frames = True, 4
+    assert probe.reliable
+    probe.errors = 1
+    assert not probe.reliable
+    assert str(probe).startswith("115200bps: 1/4 errors")
+
+
+def test_probe_baud(target):
+    boards = []
+
+    def factory():
+        boards.append(SimulatedInterface(target))
+        return boards[-1]
+
+    probe = probe_baud(PORT, 57600, frames=4, interface_factory=factory)
+    assert probe.reliable
+    assert (probe.frames, probe.bytes) == (4, 4 * 256)
+    assert boards[0].baud == 57600 and boards[0].closed
+
+    probe = probe_baud(
+        PORT, 57600, interface_factory=lambda: SimulatedInterface(connect_ok=False)
+    )
+    assert not probe.connected and probe.frames == 0
+
+
+def test_negotiate_stops_at_first_unreliable_rate():
+    resets, probes = [], []
+    best = negotiate_baud(
+        PORT,
+        bauds=[230400, 57600, 115200],
+        frames=2,
+        on_probe=probes.append,
+        interface_factory=NoisyLink,
+        reset=resets.append,
+    )
+    assert best.baud == 115200
+    assert [p.baud for p in probes] == [57600, 115200, 230400]
+    assert not probes[-1].reliable
+    # reset before each probe and once more to leave it waiting
+    assert resets == [PORT] * (len(probes) + 1)
+
+
+def test_negotiate_nothing_reliable():
+    best = negotiate_baud(
+        PORT,
+        bauds=[57600],
+        interface_factory=lambda: SimulatedInterface(connect_ok=False),
+        reset=lambda port: None,
+    )
+    assert best is None
@@ -0,0 +1,109 @@
+#
+#   Protocol tests against the simulated bootloader
+#
+#   Everything here runs over a pty, no board needed.
+#
+
+import asyncio
+import os
+import termios
+
+import pytest
+
+from ..async_transport import (
+    AsyncBootloader,
+    AsyncSerialTransport,
+    BootloaderError,
+    CMD_READ_MEMORY,
+)
+from ..bootloader_sim import FLASH_START
+
+BAUD = 115200  # the sim fixture's rate
+
+
+def set_rate(fd: int, speed: int):
+    attrs = termios.tcgetattr(fd)
+    attrs[4] = attrs[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+
+def run(sim, session):
+    """! @brief run session(bootloader, fd) on a fresh host handle"""
+
+    async def main():
+        fd = os.open(sim.port, os.O_RDWR | os.O_NOCTTY)
+        bootloader = AsyncBootloader(
+            AsyncSerialTransport(fd, asyncio.get_running_loop()), BAUD
+        )
+        try:
+            return await session(bootloader, fd)
+        finally:
+            bootloader.close()
+            os.close(fd)
+
+    return asyncio.run(main())
+
+
+def test_read_write_round_trip(sim):
+    data = bytes(range(256))
+
+    async def session(bootloader, fd):
+        assert await bootloader.sync()
+        await bootloader.get()
+        await bootloader.write_memory(FLASH_START + 0x400, data)
+        return await bootloader.read_memory(FLASH_START + 0x400, len(data))
+
+    assert run(sim, session) == data
+    assert sim.target.flash[0x400:0x500] == data
+
+
+def test_second_sync_is_nacked(sim):
+    async def session(bootloader, fd):
+        assert await bootloader.sync()
+        await bootloader.transport.write(b"\x7f")
+        return await bootloader.transport.read(1)
+
+    assert run(sim, session) == b"\x1f"
+
+
+def test_baud_locked_at_sync(sim):
+    async def session(bootloader, fd):
+        assert await bootloader.sync()
+        set_rate(fd, termios.B57600)
+        # the bootloader stays at the rate it synced at
+        assert not await bootloader.sync()
+        with pytest.raises(BootloaderError):
+            await bootloader.get_id()
+
+        sim.reset()
+        bootloader.transport.flush_input()
+        assert await bootloader.sync()
+        return await bootloader.get_id()
+
+    assert run(sim, session) == sim.target.density.pid
+    assert sim.line_baud == 57600
+
+
+def test_reprogram_fails_with_same_data(sim):
+    data = b"\x12\x34" * 8
+    assert sim.target.write(FLASH_START, data)
+    assert not sim.target.write(FLASH_START, data)
+    # clearing to zero is the one write programmed flash takes
+    assert sim.target.write(FLASH_START, bytes(len(data)))
+
+
+def test_failed_program_keeps_earlier_half_words(sim):
+    assert sim.target.write(FLASH_START + 4, b"\x00\x00")
+    assert not sim.target.write(FLASH_START, b"\xaa\xbb\xcc\xdd\xee\xff\x11\x22")
+    assert sim.target.flash[:8] == b"\xaa\xbb\xcc\xdd\x00\x00\xff\xff"
+
+
+def test_part_command_dropped_on_idle_line(sim):
+    async def session(bootloader, fd):
+        assert await bootloader.sync()
+        await bootloader.send_command(CMD_READ_MEMORY)
+        # give up before sending the address
+        await asyncio.sleep(0.1)
+        return await bootloader.read_memory(FLASH_START, 16)
+
+    assert run(sim, session) == b"\xff" * 16
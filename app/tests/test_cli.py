@@ -0,0 +1,103 @@
+#
+#   Command line tests
+#
+
+import json
+import os
+
+import pytest
+
+from .. import cli
+from ..bootloader_sim import FLASH_START
+from .conftest import SimulatedInterface
+
+
+@pytest.fixture
+def board(target, monkeypatch):
+    """! @brief every STMInterface the cli makes talks to the same target"""
+    board = SimulatedInterface(target)
+    monkeypatch.setattr(cli, "STMInterface", lambda: board)
+    return board
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(os.urandom(2500))
+    return path
+
+
+def device_args(command: str, *argv) -> list:
+    return [command, "-p", "/dev/ttyUSB0", "-b", "115200", *argv]
+
+
+def test_upload_then_verify(board, image, tmp_path):
+    metrics = tmp_path / "metrics.json"
+    argv = device_args("upload", str(image), "--metrics-file", str(metrics))
+    assert cli.main(argv) == cli.EXIT_OK
+    assert board.target.read(FLASH_START, 2500) == image.read_bytes()
+    assert (board.port, board.baud) == ("/dev/ttyUSB0", 115200)
+    with open(metrics) as f:
+        assert json.load(f)["commands"]["write"]["calls"] > 0
+
+    assert cli.main(device_args("verify", str(image))) == cli.EXIT_OK
+    image.write_bytes(bytes(2500))
+    assert cli.main(device_args("verify", str(image))) == cli.EXIT_FAIL
+
+
+def test_diff_upload_writes_changed_pages(board, image, tmp_path):
+    record = str(tmp_path / "record.json")
+    argv = device_args("upload", str(image), "--diff", "--record", record)
+    assert cli.main(argv) == cli.EXIT_OK
+    writes = board.writes
+
+    data = bytearray(image.read_bytes())
+    data[0] ^= 0xFF
+    image.write_bytes(bytes(data))
+    assert cli.main(argv) == cli.EXIT_OK
+    # one page rewritten, in at most a couple of frames
+    assert 0 < board.writes - writes < writes
+    assert board.target.read(FLASH_START, 2500) == bytes(data)
+
+
+def test_loader_needs_a_binary(board, image, capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main(device_args("upload", str(image), "--loader"))
+    assert e.value.code == cli.EXIT_USAGE
+    assert "BIN" in capsys.readouterr().err
+
+
+def test_connect_failure(target, image, monkeypatch):
+    board = SimulatedInterface(target, connect_ok=False)
+    monkeypatch.setattr(cli, "STMInterface", lambda: board)
+    assert cli.main(device_args("upload", str(image))) == cli.EXIT_FAIL
+
+
+def test_invalid_baud(board):
+    argv = ["erase", "-p", "/dev/ttyUSB0", "-b", "10"]
+    assert cli.main(argv) == cli.EXIT_FAIL
+    assert board.port is None
+
+
+def test_erase(board):
+    board.target.write(FLASH_START, b"\x00\x00\x00\x00")
+    assert cli.main(device_args("erase")) == cli.EXIT_OK
+    assert board.erased == [None]
+    assert board.target.read(FLASH_START, 4) == b"\xff" * 4
+
+
+def test_dump_range(board, tmp_path, capsys):
+    board.target.write(FLASH_START + 1024, b"\x12\x34\x56\x78")
+    out = tmp_path / "dump.bin"
+    argv = device_args("dump", str(out), "-o", "0x400", "-l", "4")
+    assert cli.main(argv) == cli.EXIT_OK
+    assert out.read_bytes() == b"\x12\x34\x56\x78"
+    assert os.path.exists(str(out) + ".crc")
+    assert len(capsys.readouterr().out.strip()) == 8
+
+    argv = device_args("dump", str(out), "-o", "0x400", "-l", "0x200000")
+    assert cli.main(argv) == cli.EXIT_USAGE
+
+
+def test_station_needs_ports(image):
+    assert cli.main(["station", "--ports", " , ", str(image)]) == cli.EXIT_USAGE
@@ -0,0 +1,125 @@
+#
+#   Bulk flash read & scan tests against the simulated target
+#
+
+import os
+import threading
+
+import pytest
+
+from ..bootloader_sim import FLASH_START
+from ..flash_ops import (
+    PAGE_BLANK,
+    PAGE_ERROR,
+    PAGE_OCCUPIED,
+    FlashReader,
+    TransferError,
+    scan_flash_pages,
+    split_frames,
+)
+
+
+def test_frames_cover_range():
+    assert list(split_frames(FLASH_START, 600)) == [
+        (FLASH_START, 256),
+        (FLASH_START + 256, 256),
+        (FLASH_START + 512, 88),
+    ]
+
+
+def test_read_all(stm_device, target):
+    target.write(FLASH_START, os.urandom(3000))
+    reader = FlashReader(stm_device, FLASH_START, 3000)
+    assert reader.read_all() == target.flash[:3000]
+    assert stm_device.reads == 12
+
+
+def test_sink_runs_off_the_reading_thread(stm_device):
+    threads = set()
+    FlashReader(stm_device, FLASH_START, 2048).read(
+        lambda address, data: threads.add(threading.get_ident())
+    )
+    assert threads and threading.get_ident() not in threads
+
+
+def test_final_progress_always_reported(stm_device):
+    reports = []
+    reader = FlashReader(
+        stm_device,
+        FLASH_START,
+        1000,
+        on_progress=lambda done, total: reports.append((done, total)),
+        progress_interval=60,
+    )
+    reader.read_all()
+    assert reports[-1] == (1000, 1000)
+    assert len(reports) == 2
+
+
+def test_sink_error_stops_read(stm_device):
+    def sink(address, data):
+        raise ValueError("disk full")
+
+    with pytest.raises(ValueError):
+        FlashReader(stm_device, FLASH_START, 64 * 1024).read(sink)
+    assert stm_device.reads < 256
+
+
+def test_unreadable_frames_reported_in_order(stm_device):
+    stm_device.bad_pages = {1}
+    seen = []
+    reader = FlashReader(
+        stm_device,
+        FLASH_START,
+        3072,
+        on_error=lambda address, size: seen.append(("error", address)),
+    )
+    reader.read(lambda address, data: seen.append(("frame", address)))
+    assert [kind for kind, _ in seen] == ["frame"] * 4 + ["error"] * 4 + ["frame"] * 4
+    assert reader.bytes_read == 3072
+
+
+def test_dump_to_file(stm_device, target, tmp_path):
+    target.write(FLASH_START, bytes(range(256)) * 8)
+    path = str(tmp_path / "dump.bin")
+
+    reader = FlashReader(stm_device, FLASH_START, 4096)
+    assert reader.read_to_file(path) == 4096
+    with open(path, "rb") as f:
+        assert f.read() == bytes(target.flash[:4096])
+    assert os.listdir(tmp_path) == ["dump.bin"]
+
+
+def test_failed_dump_leaves_no_file(stm_device, tmp_path):
+    path = str(tmp_path / "dump.bin")
+    stm_device.bad_pages = {2}
+
+    with pytest.raises(TransferError):
+        FlashReader(stm_device, FLASH_START, 4096).read_to_file(path)
+    assert os.listdir(tmp_path) == []
+
+
+def test_scan_marks_occupied_pages(stm_device, target):
+    target.write(FLASH_START + 1024 * 3 + 100, b"\x00")
+    target.write(FLASH_START + 1024 * 64, b"\x12\x34")
+    pages = {}
+
+    result = scan_flash_pages(stm_device, on_page=pages.__setitem__)
+    assert [p for p in range(result.page_num) if result.is_occupied(p)] == [3, 64]
+    assert result.occupied == 2
+    assert result.blank == target.page_num - 2
+    assert len(pages) == target.page_num
+    assert pages[3] == PAGE_OCCUPIED and pages[4] == PAGE_BLANK
+
+
+def test_scan_unreadable_page_is_unknown(stm_device, target):
+    target.write(FLASH_START + 1024 * 5, b"\x00\x00")
+    stm_device.bad_pages = {5, 6}
+    pages = {}
+
+    result = scan_flash_pages(stm_device, on_page=pages.__setitem__)
+    assert result.errors == {5, 6}
+    assert not result.is_occupied(5)
+    assert result.occupied == 0
+    assert result.blank == target.page_num - 2
+    assert pages[5] == pages[6] == PAGE_ERROR
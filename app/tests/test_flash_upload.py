@@ -0,0 +1,96 @@
+#
+#   Upload tests against the simulated target
+#
+
+import os
+
+import pytest
+
+from ..bootloader_sim import FLASH_START
+from ..flash_ops import TransferError
+from ..flash_upload import ErasePlan, FlashRecord, diff_segments, upload_segments
+
+PAGE = 1024
+
+
+def test_diff_writes_changed_pages_only(flash, stm_device, target):
+    image = bytearray(os.urandom(PAGE * 4))
+    upload_segments(flash, [(FLASH_START, image)])
+    image[PAGE * 2 + 5] ^= 0xFF
+    flash.reset()
+
+    result = diff_segments(flash, [(FLASH_START, image)])
+    assert result.pages_written == [2]
+    assert result.pages_skipped == [0, 1, 3]
+    assert stm_device.erased[-1] == [2]
+    assert target.flash[: len(image)] == image
+
+
+def test_diff_keeps_the_rest_of_a_partial_page(flash, target):
+    target.write(FLASH_START, b"\x11\x22" * 8)
+    result = diff_segments(flash, [(FLASH_START + 100, b"\x33\x44")])
+    assert result.pages_written == [0]
+    assert target.flash[:16] == b"\x11\x22" * 8
+    assert target.flash[100:102] == b"\x33\x44"
+
+
+def test_diff_against_record_skips_readback(flash, stm_device, tmp_path):
+    path = str(tmp_path / "record.json")
+    image = os.urandom(PAGE * 2)
+    diff_segments(flash, [(FLASH_START, image)], FlashRecord(path), "dev")
+
+    flash.reset()
+    reads = stm_device.reads
+    result = diff_segments(flash, [(FLASH_START, image)], FlashRecord(path), "dev")
+    assert result.pages_skipped == [0, 1]
+    assert stm_device.reads == reads
+
+
+def test_record_forgets_pages_of_a_failed_upload(flash, stm_device, tmp_path):
+    path = str(tmp_path / "record.json")
+    diff_segments(flash, [(FLASH_START, b"\x01" * PAGE)], FlashRecord(path), "dev")
+
+    stm_device.eraseFlashPages = lambda pages: False
+    with pytest.raises(TransferError):
+        diff_segments(flash, [(FLASH_START, b"\x02" * PAGE)], FlashRecord(path), "dev")
+    assert FlashRecord(path).get("dev", 0) is None
+
+
+def test_erase_plan_batches_sorted_pages():
+    plan = ErasePlan([9, 3, 4, 3, 70], batch_size=2)
+    assert len(plan) == 4
+    assert list(plan.batches()) == [[3, 4], [9, 70]]
+
+
+def test_upload_erases_only_touched_pages(flash, stm_device, target):
+    target.write(FLASH_START + PAGE * 10, b"\x5a\x5a")
+    segments = [(FLASH_START + 100, b"\x01" * 2000), (FLASH_START + PAGE * 40, b"\x02")]
+
+    result = upload_segments(flash, segments)
+    assert stm_device.erased == [[0, 1, 2, 40]]
+    assert result.pages_written == [0, 1, 2, 40]
+    assert target.flash[PAGE * 10 : PAGE * 10 + 2] == b"\x5a\x5a"
+
+
+def test_upload_outside_flash_rejected(flash, stm_device):
+    with pytest.raises(TransferError):
+        upload_segments(flash, [(FLASH_START + 128 * PAGE - 1, b"\x01\x02")])
+    assert stm_device.erased == []
+
+
+def test_sparse_skips_blank_frames(flash, stm_device, target):
+    image = b"\x01" * 256 + b"\xff" * 512 + b"\x02" * 256
+
+    result = upload_segments(flash, [(FLASH_START, image)], sparse=True)
+    assert (result.frames_written, result.frames_skipped) == (2, 2)
+    assert result.bytes_skipped == 512
+    assert stm_device.writes == 2
+    assert target.flash[:PAGE] == image
+
+
+def test_sparse_writes_every_frame_when_unsure(flash, stm_device):
+    # page not known to be erased, e.g. the erase wasn't seen by the cache
+    flash.mark_blank = lambda pages: None
+    result = upload_segments(flash, [(FLASH_START, b"\xff" * PAGE)], sparse=True)
+    assert result.frames_skipped == 0
+    assert stm_device.writes == 4
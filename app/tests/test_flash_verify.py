@@ -0,0 +1,20 @@
+#
+#   Verify tests against the simulated target
+#
+
+from ..bootloader_sim import FLASH_START
+from ..flash_verify import verify_segments
+
+
+def test_unreadable_page_marked_bad(flash, stm_device, target):
+    image = bytes(range(256)) * 16
+    target.write(FLASH_START, image)
+
+    stm_device.bad_pages = {1}
+    result = verify_segments(flash, [(FLASH_START, image)])
+    assert not result.ok
+    assert result.bad_pages == [1]
+    assert result.unread == [1]
+
+    stm_device.bad_pages = set()
+    assert verify_segments(flash, [(FLASH_START, image)]).ok
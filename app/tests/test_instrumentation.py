@@ -0,0 +1,99 @@
+#
+#   Link instrumentation tests
+#
+
+import json
+
+import pytest
+
+from ..async_transport import BITS_PER_BYTE
+from ..bootloader_sim import FLASH_START
+from ..instrumentation import (
+    READ_RX,
+    READ_TX,
+    WRITE_RX,
+    WRITE_TX,
+    Histogram,
+    InstrumentedSTMInterface,
+    LinkMetrics,
+)
+
+
+def test_histogram_buckets():
+    hist = Histogram(bounds=(0.01, 0.1))
+    for value in (0.005, 0.05, 0.05, 3.0):
+        hist.observe(value)
+    assert hist.counts == [1, 2, 1]
+    assert hist.cumulative() == [(0.01, 1), (0.1, 3), (float("inf"), 4)]
+    assert hist.quantile(0.5) == 0.1
+    assert hist.quantile(1.0) == 3.0
+    assert hist.sum == pytest.approx(3.105)
+    assert Histogram().quantile(0.5) == 0.0
+
+
+def test_record_counts_wire_time():
+    metrics = LinkMetrics(baud=115200)
+    metrics.record("read", 0.02, 9, 259, True)
+    metrics.record("read", 0.01, 9, 0, False)
+    metrics.retry("read")
+
+    stats = metrics.stats("read")
+    assert (stats.calls, stats.errors, stats.retries) == (2, 1, 1)
+    assert (stats.bytes_tx, stats.bytes_rx) == (18, 259)
+    assert stats.wire_time == pytest.approx(277 * BITS_PER_BYTE / 115200)
+    assert stats.ack_wait == pytest.approx(0.03 - stats.wire_time)
+
+
+def test_interface_counts_commands(stm_device):
+    metrics = LinkMetrics()
+    wrapped = InstrumentedSTMInterface(stm_device, metrics)
+    assert wrapped.connectAndReadInfo("/dev/null", 115200)
+    assert metrics.baud == 115200
+
+    assert wrapped.eraseFlashPages([0])
+    assert wrapped.writeToFlash(FLASH_START, b"\x01\x02\x03\x04")
+    ok, data = wrapped.readFromFlash(FLASH_START, 4)
+    assert ok and bytes(data) == b"\x01\x02\x03\x04"
+
+    stm_device.bad_pages.add(0)
+    assert wrapped.readFromFlash(FLASH_START, 4)[0] is False
+
+    commands = dict(metrics.snapshot())
+    assert commands["write"]["bytes_tx"] == WRITE_TX + 4
+    assert commands["write"]["bytes_rx"] == WRITE_RX
+    assert commands["read"]["calls"] == 2
+    assert commands["read"]["errors"] == 1
+    # a failed read gets nothing back
+    assert commands["read"]["bytes_tx"] == 2 * READ_TX
+    assert commands["read"]["bytes_rx"] == READ_RX + 4
+    assert commands["erase"]["calls"] == 1
+    # anything else passes straight through
+    assert wrapped.device is stm_device.device
+
+
+def test_interface_records_raised_errors(stm_device):
+    metrics = LinkMetrics()
+    wrapped = InstrumentedSTMInterface(stm_device, metrics)
+    stm_device.read_errors = 1
+    with pytest.raises(OSError):
+        wrapped.readFromFlash(FLASH_START, 4)
+    assert dict(metrics.snapshot())["read"]["errors"] == 1
+
+
+def test_openmetrics_and_save(tmp_path):
+    metrics = LinkMetrics(baud=115200)
+    metrics.record("write", 0.004, 265, 3, True)
+    text = metrics.to_openmetrics()
+    assert text.endswith("# EOF\n")
+    assert 'stm_command_latency_seconds_bucket{command="write",le="0.005"} 1' in text
+    assert 'stm_command_latency_seconds_count{command="write"} 1' in text
+    assert 'stm_command_sent_bytes_total{command="write"} 265' in text
+
+    paths = metrics.save_session(str(tmp_path))
+    assert [p[-5:] for p in paths] == [".json", ".prom"]
+    with open(paths[0]) as f:
+        saved = json.load(f)
+    assert saved["baud"] == 115200
+    assert saved["commands"]["write"]["calls"] == 1
+    with open(paths[1]) as f:
+        assert f.read() == text
@@ -0,0 +1,82 @@
+#
+#   Operation log tests
+#
+
+from ..op_log import LogFileWriter, OperationLog
+
+
+def test_ring_drops_oldest_lines():
+    log = OperationLog(capacity=4)
+    for i in range(10):
+        log.write(f"line {i}")
+    assert log.take() == [
+        "... 6 lines dropped, see the log file",
+        "line 6",
+        "line 7",
+        "line 8",
+        "line 9",
+    ]
+    assert log.take() == []
+
+
+def test_progress_coalesced_to_newest():
+    log = OperationLog(progress_interval=60)
+    log.write("Reading flash: 10%", progress="read")
+    log.write("Reading flash: 20%", progress="read")
+    assert log.take() == ["Reading flash: 20%"]
+
+    # held back until the interval is up
+    log.write("Reading flash: 30%", progress="read")
+    log.write("Reading flash: 40%", progress="read")
+    assert log.take() == []
+
+
+def test_message_releases_held_progress():
+    log = OperationLog(progress_interval=60)
+    log.write("Uploading: 1/4", progress="upload")
+    log.take()
+    log.write("Uploading: 4/4", progress="upload")
+    log.write("Upload complete")
+    assert log.take() == ["Uploading: 4/4", "Upload complete"]
+
+
+def test_operations_not_merged():
+    log = OperationLog(progress_interval=60)
+    log.write("Uploading: 4/4", progress="upload")
+    log.write("Verifying: 1/4", progress="verify")
+    assert log.take() == ["Uploading: 4/4", "Verifying: 1/4"]
+
+
+def test_every_line_reaches_the_file(tmp_path):
+    path = str(tmp_path / "logs" / "session.log")
+    log = OperationLog(progress_interval=60)
+    log.open(path)
+    for i in range(5):
+        log.write(f"Reading flash: {i}", progress="read")
+    log.write("done")
+    log.close()
+    with open(path) as f:
+        lines = [line.split(" ", 1)[1] for line in f.read().splitlines()]
+    assert lines == [f"Reading flash: {i}" for i in range(5)] + ["done"]
+
+
+def test_lines_dropped_once_writer_failed(tmp_path):
+    writer = LogFileWriter(str(tmp_path), capacity=8)
+    # a directory can't be opened as the log, so the writer stops
+    writer.thread.join()
+    assert isinstance(writer.error, OSError)
+    for i in range(100):
+        writer.write(f"line {i}")
+    assert writer.lines.qsize() == 0
+    writer.close()
+
+
+def test_lines_dropped_while_file_behind(tmp_path):
+    writer = LogFileWriter(str(tmp_path / "session.log"), capacity=2)
+    # stop the writer so nothing drains the queue, as a stalled disk would
+    writer.lines.put(None)
+    writer.thread.join()
+    for i in range(5):
+        writer.write(f"line {i}")
+    assert writer.lines.qsize() == 2
+    assert writer.dropped == 3
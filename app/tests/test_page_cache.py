@@ -0,0 +1,76 @@
+#
+#   Page cache tests against the simulated target
+#
+
+import hashlib
+
+from ..bootloader_sim import FLASH_START
+from ..flash_upload import diff_segments, upload_segments
+
+PAGE = 1024
+
+
+def test_repeat_reads_served_from_cache(flash, stm_device, target):
+    target.write(FLASH_START + 10, b"\x01\x02")
+    assert flash.readFromFlash(FLASH_START, 16) == (
+        True,
+        b"\xff" * 10 + b"\x01\x02" + b"\xff" * 4,
+    )
+    reads = stm_device.reads
+    assert flash.readFromFlash(FLASH_START + 8, 8)[0]
+    assert stm_device.reads == reads
+    assert (flash.hits, flash.misses) == (1, 1)
+
+
+def test_read_across_pages(flash, target):
+    data = bytes(range(200))
+    target.write(FLASH_START + PAGE - 100, data)
+    assert flash.readFromFlash(FLASH_START + PAGE - 100, 200) == (True, data)
+    assert flash.misses == 2
+
+
+def test_write_drops_the_page(flash, stm_device):
+    flash.fetch_page(0)
+    assert flash.writeToFlash(FLASH_START, b"\x00\x00")
+    reads = stm_device.reads
+    assert flash.readFromFlash(FLASH_START, 2) == (True, b"\x00\x00")
+    assert stm_device.reads > reads
+
+
+def test_erase_marks_pages_blank(flash, stm_device, target):
+    target.write(FLASH_START, b"\x00" * 16)
+    assert flash.eraseFlashPages([0])
+    assert flash.is_blank(0)
+    reads = stm_device.reads
+    assert flash.readFromFlash(FLASH_START, 16) == (True, b"\xff" * 16)
+    assert stm_device.reads == reads
+
+
+def test_failed_erase_drops_the_page(flash, stm_device):
+    flash.fetch_page(0)
+    stm_device.eraseFlashPages = lambda pages: False
+    assert not flash.eraseFlashPages([0])
+    assert 0 not in flash.pages and 0 not in flash.hashes
+
+
+def test_programmed_pages_keep_only_a_digest(flash):
+    image = bytes(range(256)) * 8
+    upload_segments(flash, [(FLASH_START, image)])
+    assert flash.pages == {}
+    assert flash.page_hash(1) == hashlib.sha1(image[PAGE:]).digest()
+
+
+def test_diff_compares_the_hash_index(flash, stm_device):
+    image = bytes(range(256)) * 8
+    upload_segments(flash, [(FLASH_START, image)])
+    reads = stm_device.reads
+    result = diff_segments(flash, [(FLASH_START, image)])
+    assert result.pages_skipped == [0, 1]
+    assert stm_device.reads == reads
+
+
+def test_reset_drops_everything(flash):
+    flash.fetch_page(0)
+    flash.reset()
+    assert flash.pages == {} and flash.hashes == {}
+    assert (flash.hits, flash.misses) == (0, 0)
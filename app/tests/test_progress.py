@@ -0,0 +1,98 @@
+#
+#   Progress channel tests
+#
+
+import asyncio
+import threading
+
+from ..progress import ProgressChannel, ProgressEvent, format_progress
+
+
+def collect(feed, **events):
+    """! @brief run feed(channel) on a worker thread and gather the
+    events the UI side would render
+    """
+
+    async def main():
+        channel = ProgressChannel(asyncio.get_running_loop())
+        worker = threading.Thread(target=feed, args=(channel,))
+        worker.start()
+        seen = [event async for event in channel.events(**events)]
+        worker.join()
+        return seen, channel
+
+    return asyncio.run(main())
+
+
+def test_reports_coalesced_to_newest():
+    def feed(channel):
+        for done in range(0, 1001, 10):
+            channel.report(done, 1000)
+        channel.close()
+
+    seen, _ = collect(feed, interval=60)
+    # the first report renders straight away, the rest are dropped by
+    # the close which ends the stream without waiting out the interval
+    assert len(seen) <= 1
+    assert all(event.total == 1000 for event in seen)
+
+
+def test_renders_newest_each_interval():
+    def feed(channel):
+        for done in range(1, 6):
+            channel.report(done, 5, "pages")
+            threading.Event().wait(0.05)
+        channel.close()
+
+    seen, _ = collect(feed, interval=0.01)
+    assert seen
+    assert seen[-1] == ProgressEvent(5, 5, "pages")
+    assert [event.done for event in seen] == sorted(event.done for event in seen)
+
+
+def test_idle_repeats_latest():
+    def feed(channel):
+        channel.report(3, 10)
+        threading.Event().wait(0.3)
+        channel.close()
+
+    seen, _ = collect(feed, interval=0.01, idle=0.05)
+    assert len(seen) > 2
+    assert set(seen) == {ProgressEvent(3, 10, "bytes")}
+
+
+def test_idle_before_any_report_yields_none():
+    def feed(channel):
+        threading.Event().wait(0.15)
+        channel.close()
+
+    seen, _ = collect(feed, idle=0.05)
+    assert seen and set(seen) == {None}
+
+
+def test_page_states_taken_once():
+    def feed(channel):
+        channel.report_page(1, 2)
+        channel.report_page(1, 3)
+        channel.report_page(4, 2)
+        channel.close()
+
+    _, channel = collect(feed)
+    assert channel.take_pages() == {1: 3, 4: 2}
+    assert channel.take_pages() == {}
+
+
+def test_units_callback():
+    def feed(channel):
+        channel.units("pages")(2, 8)
+        threading.Event().wait(0.05)
+        channel.close()
+
+    seen, _ = collect(feed, interval=0)
+    assert seen == [ProgressEvent(2, 8, "pages")]
+
+
+def test_format_progress():
+    assert format_progress(ProgressEvent(256, 1024, "bytes")) == "256/1024 bytes (25%)"
+    assert format_progress(ProgressEvent(0, 0, "bytes")) == ""
+    assert format_progress(None) == ""
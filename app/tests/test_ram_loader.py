@@ -0,0 +1,159 @@
+#
+#   RAM loader & run from RAM tests against the simulated bootloader
+#
+
+import asyncio
+import os
+import struct
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from ..async_transport import AsyncBootloader
+from ..bootloader_sim import FLASH_START, RAM_START, loader_image
+from ..flash_ops import TransferError
+from ..page_cache import CachedSTMInterface
+from ..ram_loader import (
+    LoaderUnavailable,
+    accelerated_upload,
+    check_ram_image,
+    free_ram,
+    loader_upload,
+    read_loader,
+    run_from_ram,
+)
+
+
+@pytest.fixture
+def loader_path(tmp_path):
+    path = str(tmp_path / "loader.bin")
+    with open(path, "wb") as f:
+        f.write(loader_image())
+    return path
+
+
+def test_loader_programs_pages(sim, sim_device, pty_factory, loader_path):
+    flash = CachedSTMInterface(sim_device)
+    image = os.urandom(2048 + 100)
+
+    result = loader_upload(
+        flash,
+        [(FLASH_START, image)],
+        port=sim.port,
+        baud=sim.baud,
+        loader_path=loader_path,
+        loader_baud=None,
+        bootloader_factory=pty_factory,
+    )
+    assert result.pages_written == [0, 1, 2]
+    assert sim.target.flash[: len(image)] == image
+    # the interface is handed the port back once the loader has reset
+    assert sim_device.closed and sim_device.port == sim.port
+
+
+def test_not_a_loader(tmp_path):
+    path = str(tmp_path / "app.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(1024))
+    with pytest.raises(LoaderUnavailable):
+        read_loader(path)
+
+
+def test_missing_loader_falls_back(flash, target, tmp_path):
+    fallbacks = []
+    image = os.urandom(1024)
+
+    accelerated_upload(
+        flash,
+        [(FLASH_START, image)],
+        on_fallback=fallbacks.append,
+        port="/dev/null",
+        baud=115200,
+        loader_path=str(tmp_path / "loader.bin"),
+    )
+    assert isinstance(fallbacks[0], LoaderUnavailable)
+    assert target.flash[:1024] == image
+
+
+def test_missing_pyserial_falls_back(flash, stm_device, target, loader_path):
+    def factory(port, baud, loop):
+        raise ModuleNotFoundError("No module named 'serial'")
+
+    fallbacks = []
+    image = os.urandom(1024)
+    accelerated_upload(
+        flash,
+        [(FLASH_START, image)],
+        on_fallback=fallbacks.append,
+        port="/dev/ttyUSB0",
+        baud=115200,
+        loader_path=loader_path,
+        bootloader_factory=factory,
+    )
+    assert isinstance(fallbacks[0], LoaderUnavailable)
+    assert stm_device.port == "/dev/ttyUSB0"
+    assert target.flash[:1024] == image
+
+
+def ram_image(address: int, size: int = 512) -> bytes:
+    """! @return an image linked to run from address"""
+    stack = RAM_START + 0x1000
+    return struct.pack("<II", stack, address + 0x41) + os.urandom(size - 8)
+
+
+def test_run_from_ram_syncs_first(sim, sim_device, pty_factory):
+    address = free_ram(sim_device.device)[0]
+    image = ram_image(address)
+
+    # a fresh simulator hasn't seen a sync byte yet
+    run_from_ram(
+        sim_device.device,
+        address,
+        image,
+        port=sim.port,
+        baud=sim.baud,
+        bootloader_factory=pty_factory,
+    )
+    assert sim.target.read(address, len(image)) == image
+    assert sim.target.jumped_to == address
+
+
+def test_ram_image_must_be_linked_for_ram(sim_device):
+    address = free_ram(sim_device.device)[0]
+    with pytest.raises(TransferError):
+        check_ram_image(sim_device.device, address, ram_image(address + 0x1000))
+
+
+def test_port_opened_with_modem_lines_released(monkeypatch):
+    events = []
+    read_fd, write_fd = os.pipe()
+
+    class Serial:
+        def __init__(self, **kwargs):
+            self.port = None
+
+        def __setattr__(self, name, value):
+            events.append((name, value))
+            super().__setattr__(name, value)
+
+        def open(self):
+            events.append(("open", self.port))
+
+        def fileno(self):
+            return read_fd
+
+        def close(self):
+            os.close(read_fd)
+
+    serial = SimpleNamespace(
+        Serial=Serial, EIGHTBITS=8, PARITY_EVEN="E", STOPBITS_ONE=1
+    )
+    monkeypatch.setitem(sys.modules, "serial", serial)
+
+    async def main():
+        AsyncBootloader.open_serial("/dev/ttyUSB0", 115200).close()
+
+    asyncio.run(main())
+    os.close(write_fd)
+    assert events[-3:] == [("dtr", False), ("rts", False), ("open", "/dev/ttyUSB0")]
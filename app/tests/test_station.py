@@ -0,0 +1,109 @@
+#
+#   Flashing station tests
+#
+
+import os
+
+import pytest
+
+from ..bootloader_sim import FLASH_START
+from ..station import (
+    STATUS_FAIL,
+    STATUS_PASS,
+    FlashStation,
+    PortSession,
+    StationImage,
+    format_session,
+)
+from .conftest import SimulatedInterface
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(os.urandom(3000))
+    return str(path)
+
+
+def boards(**kwargs):
+    """! @return interface_factory handing out SimulatedInterfaces, and
+    the list they are collected in
+    """
+    made = []
+
+    def factory():
+        board = SimulatedInterface(**kwargs)
+        made.append(board)
+        return board
+
+    return factory, made
+
+
+def test_session_programs_and_verifies(image_path):
+    factory, made = boards()
+    seen = []
+    with StationImage(image_path, offset=1024) as image:
+        session = PortSession("/dev/ttyUSB0", 115200, factory)
+        session.run(image, on_update=lambda s: seen.append(s.status))
+
+    assert session.passed, session.error
+    assert session.bytes_done == session.bytes_total == 3000
+    assert session.device_name == "STM32F10xxxMedium-density"
+    board = made[0]
+    assert (board.port, board.baud) == ("/dev/ttyUSB0", 115200)
+    with open(image_path, "rb") as f:
+        assert board.target.read(FLASH_START + 1024, 3000) == f.read()
+    assert board.closed
+    assert seen[0] == "connecting" and seen[-1] == STATUS_PASS
+
+
+def test_session_retries_link_errors(image_path):
+    factory, made = boards()
+
+    def flaky():
+        board = factory()
+        board.write_errors = 1
+        board.read_errors = 1
+        return board
+
+    with StationImage(image_path) as image:
+        session = PortSession("/dev/ttyUSB0", 115200, flaky).run(image)
+    assert session.passed, session.error
+    assert session.retries >= 2
+
+
+def test_connect_failure_fails_and_closes(image_path):
+    factory, made = boards(connect_ok=False)
+    with StationImage(image_path) as image:
+        session = PortSession("/dev/ttyUSB1", 115200, factory).run(image)
+    assert session.status == STATUS_FAIL
+    assert isinstance(session.error, ConnectionError)
+    assert made[0].closed
+    assert "Unable to connect" in format_session(session)
+
+
+class DeadPort(SimulatedInterface):
+    """! @brief a board which never answers on /dev/ttyUSB1"""
+
+    def connectAndReadInfo(self, port: str, baud: int = None, readOptBytes=False):
+        return super().connectAndReadInfo(port, baud) and port != "/dev/ttyUSB1"
+
+
+def test_station_runs_every_port(image_path):
+    made = []
+
+    def factory():
+        board = DeadPort()
+        made.append(board)
+        return board
+
+    ports = ["/dev/ttyUSB0", "/dev/ttyUSB1", "/dev/ttyUSB2"]
+    bauds = dict(zip(ports, (115200, 57600, 115200)))
+    station = FlashStation(ports, bauds, factory)
+    with StationImage(image_path) as image:
+        sessions = station.run(image)
+
+    assert [s.passed for s in sessions] == [True, False, True]
+    assert (station.passed, station.failed) == (2, 1)
+    assert [s.baud for s in sessions] == [115200, 57600, 115200]
+    assert len(made) == 3 and all(board.closed for board in made)
@@ -0,0 +1,88 @@
+#
+#   Frame retry tests against the simulated target's flash rules
+#
+
+import pytest
+
+from ..bootloader_sim import FLASH_START
+from ..instrumentation import InstrumentedSTMInterface, LinkMetrics
+from ..transfer import RetryingSTMInterface, RetryPolicy
+
+
+def retrying(stm_device):
+    return RetryingSTMInterface(stm_device, RetryPolicy(base=0.0))
+
+
+def test_read_retried_after_link_error(stm_device):
+    stm_device.read_errors = 2
+    flash = retrying(stm_device)
+    assert flash.readFromFlash(FLASH_START, 16) == (True, b"\xff" * 16)
+    assert flash.stats.retries == 2
+
+
+def test_part_programmed_write_not_resent(stm_device, target):
+    target.write(FLASH_START + 8, b"\x00\x00")
+    assert not retrying(stm_device).writeToFlash(FLASH_START, b"\x55" * 16)
+    assert stm_device.writes == 1
+
+
+def test_programming_error_not_retried(stm_device):
+    def broken(address, data):
+        raise TypeError("bad frame")
+
+    stm_device.writeToFlash = broken
+    with pytest.raises(TypeError):
+        retrying(stm_device).writeToFlash(FLASH_START, b"\x55" * 16)
+
+
+class Port:
+    """!@class Port
+    @brief the pyserial attributes find_port looks for
+    """
+
+    def __init__(self):
+        self.timeout = 5.0
+        self.baudrate = 115200
+
+    def read(self, n: int = 1) -> bytes:
+        return b""
+
+
+def test_frame_timeout_follows_rtt(stm_device):
+    stm_device.ser = Port()
+    seen = []
+    read = stm_device.readFromFlash
+
+    def timed_read(address, length):
+        seen.append(stm_device.ser.timeout)
+        return read(address, length)
+
+    stm_device.readFromFlash = timed_read
+    flash = retrying(InstrumentedSTMInterface(stm_device, LinkMetrics()))
+    for _ in range(4):
+        assert flash.readFromFlash(FLASH_START, 16)[0]
+
+    # the port's own timeout until there is an estimate, then the estimate
+    assert seen[0] == 5.0
+    assert seen[-1] == flash.rtt["read"].timeout < 5.0
+    assert stm_device.ser.timeout == 5.0
+
+
+def test_retry_uses_port_timeout(stm_device):
+    stm_device.ser = Port()
+    flash = retrying(stm_device)
+    assert flash.readFromFlash(FLASH_START, 16)[0]
+
+    seen = []
+    read = stm_device.readFromFlash
+
+    def failing_read(address, length):
+        seen.append(stm_device.ser.timeout)
+        if len(seen) == 1:
+            raise OSError("read timeout")
+        return read(address, length)
+
+    stm_device.readFromFlash = failing_read
+    estimate = flash.rtt["read"].timeout
+    assert flash.readFromFlash(FLASH_START, 16)[0]
+    assert seen == [estimate, 5.0]
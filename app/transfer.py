@@ -0,0 +1,223 @@
+#
+#   Reliable frame transfers
+#
+#   A noisy link should cost a retried frame, not a redone transfer.
+#   RetryingSTMInterface wraps an STMInterface so each failed read or
+#   write frame is retried on its own with a bounded backoff. The time
+#   each frame takes feeds a per-command RTT estimate, which sets the
+#   serial port's read timeout for the first try of the next frame and
+#   scales the backoff. Retries run with the port's own timeout.
+#
+
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+MIN_TIMEOUT = 0.02  # USB-UART adapters add a few ms of latency at best
+MAX_TIMEOUT = 1.0  # the bootloader's own ack timeout, never wait longer
+MAX_RETRIES = 3  # retries per frame before the frame fails
+BACKOFF_BASE = 0.005  # seconds, doubled each retry
+BACKOFF_MAX = 0.25
+
+
+class RttEstimator:
+    """!@class RttEstimator
+    @brief smoothed round-trip time & deviation of a link, giving a
+    timeout which tracks the link (RFC 6298 style)
+    """
+
+    def __init__(
+        self,
+        initial: float = MAX_TIMEOUT,
+        min_timeout: float = MIN_TIMEOUT,
+        max_timeout: float = MAX_TIMEOUT,
+    ):
+        self.initial = initial
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = 0.0
+        self.samples = 0
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+
+    @property
+    def timeout(self) -> float:
+        if self.srtt is None:
+            return self.initial
+        return min(max(self.srtt + 4 * self.rttvar, self.min_timeout), self.max_timeout)
+
+
+class RetryPolicy:
+    """!@class RetryPolicy
+    @brief bounded retries with exponential backoff
+    """
+
+    def __init__(
+        self,
+        max_retries: int = MAX_RETRIES,
+        base: float = BACKOFF_BASE,
+        max_delay: float = BACKOFF_MAX,
+    ):
+        self.max_retries = max_retries
+        self.base = base
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, rtt: float = 0.0) -> float:
+        """! @return seconds to wait before retry number attempt (from 0),
+        never less than a round-trip so late bytes have drained
+        """
+        return min(max(self.base, rtt) * (2**attempt), self.max_delay)
+
+
+class TransferStats:
+    """!@class TransferStats
+    @brief frame & retry counts for a link
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.retries = 0
+        self.failures = 0
+
+    def __str__(self):
+        return f"{self.frames} frames, {self.retries} retries, {self.failures} failed"
+
+
+def find_port(stm_device):
+    """! @function find_port
+    @brief the serial port an STMInterface talks through, looked up by
+    its pyserial attributes through any wrappers around the interface
+    @return the port, or None if there isn't one open
+    """
+    while stm_device is not None:
+        attrs = getattr(stm_device, "__dict__", {})
+        for value in attrs.values():
+            if all(hasattr(value, a) for a in ("timeout", "baudrate", "read")):
+                return value
+        stm_device = attrs.get("stm_device")
+    return None
+
+
+class RetryingSTMInterface:
+    """!@class RetryingSTMInterface
+    @brief STMInterface wrapper which retries failed frames
+
+    Reads and writes are retried per frame, everything else passes
+    straight through to the wrapped interface. A write is only resent
+    if reading the frame back shows it didn't land at all, as rewriting
+    programmed flash fails even with the same data. A frame which
+    partly landed fails straight away, its page has to be erased first.
+    """
+
+    def __init__(self, stm_device, policy: RetryPolicy = None, metrics=None):
+        self.stm_device = stm_device
+        self.policy = policy or RetryPolicy()
+        # optional LinkMetrics to count retries per command in
+        self.metrics = metrics
+        # reads & writes take different times, a write programs flash
+        self.rtt = {"read": RttEstimator(), "write": RttEstimator()}
+        self.stats = TransferStats()
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the wrapper
+        return getattr(self.stm_device, name)
+
+    @contextmanager
+    def _timeout(self, command: str, adaptive: bool):
+        """! @brief set the port's read timeout from the command's RTT
+        estimate for one frame, putting the port's own back after
+        """
+        rtt = self.rtt[command]
+        port = find_port(self.stm_device) if adaptive else None
+        if port is None or rtt.srtt is None:
+            yield
+            return
+        saved = port.timeout
+        port.timeout = rtt.timeout
+        try:
+            yield
+        finally:
+            port.timeout = saved
+
+    def _attempt(self, command: str, func, *args, adaptive: bool = True):
+        start = monotonic()
+        try:
+            with self._timeout(command, adaptive):
+                result = func(*args)
+        except OSError:
+            # serial errors (SerialException is an OSError) & timeouts
+            # are a failed frame like any other
+            return None
+        self.rtt[command].sample(monotonic() - start)
+        return result
+
+    def _backoff(self, attempt: int, command: str):
+        self.stats.retries += 1
+        if self.metrics is not None:
+            self.metrics.retry(command)
+        sleep(self.policy.delay(attempt, self.rtt[command].srtt or 0.0))
+
+    def readFromFlash(self, address: int, length: int):
+        """! @brief drop-in for STMInterface.readFromFlash with retries
+        @return (success, data) as the interface does
+        """
+        self.stats.frames += 1
+        for attempt in range(self.policy.max_retries + 1):
+            if attempt:
+                self._backoff(attempt - 1, "read")
+            result = self._attempt(
+                "read",
+                self.stm_device.readFromFlash,
+                address,
+                length,
+                adaptive=not attempt,
+            )
+            if result is not None:
+                success, rx = result
+                if success and rx is not None and len(rx) == length:
+                    return result
+        self.stats.failures += 1
+        return False, None
+
+    def _read_back(self, address: int, length: int) -> bytes:
+        """! @return the frame as it is on the device, None if unknown"""
+        result = self._attempt(
+            "read", self.stm_device.readFromFlash, address, length, adaptive=False
+        )
+        if result is None or not result[0] or result[1] is None:
+            return None
+        return bytes(result[1])
+
+    def writeToFlash(self, address: int, data):
+        """! @brief drop-in for STMInterface.writeToFlash with retries"""
+        self.stats.frames += 1
+        for attempt in range(self.policy.max_retries + 1):
+            if attempt:
+                self._backoff(attempt - 1, "write")
+                current = self._read_back(address, len(data))
+                if current == bytes(data):
+                    # the ack was lost rather than the write
+                    return True
+                if current is not None and current.count(0xFF) != len(current):
+                    # part programmed, resending can only fail (PGERR)
+                    break
+            if self._attempt(
+                "write",
+                self.stm_device.writeToFlash,
+                address,
+                data,
+                adaptive=not attempt,
+            ):
+                return True
+        self.stats.failures += 1
+        return False